@@ -0,0 +1,39 @@
+import argparse
+
+from evaluation.nlvr import compute_stats, compute_one_run_accuracy, compute_agreement
+from evaluation.common import aggregate_with_voting
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare NLVR evaluation results of a model variant (e.g. quantized) against a reference run',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-s', '--seed',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        'reference_results_file',
+        type=str,
+    )
+    parser.add_argument(
+        'results_file',
+        type=str,
+    )
+
+    args = parser.parse_args()
+
+    for name, results_file in (('Reference', args.reference_results_file), ('Candidate', args.results_file)):
+        one_run_accuracy = compute_one_run_accuracy(results_file, seed=args.seed) * 100
+        voting_accuracy = aggregate_with_voting(compute_stats(results_file)) * 100
+        print(f'{name} one run accuracy: {one_run_accuracy:.1f}')
+        print(f'{name} voting accuracy: {voting_accuracy:.1f}')
+
+    agreement, num_compared, num_reference = compute_agreement(args.reference_results_file, args.results_file)
+    print(f'Prediction agreement: {agreement * 100:.1f} over {num_compared} of {num_reference} reference predictions')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -29,6 +29,17 @@ def aggregate_with_voting(stats: List[Dict[str, Any]]) -> float:
     return accuracy_mean
 
 
+def summarize_agreement(agreements: List[bool], num_reference: int, reference_results_file: str,
+                        results_file: str) -> Tuple[float, int, int]:
+    """ The fraction of agreeing predictions, the number of predictions compared and the number of reference
+        predictions, raising a ValueError if the results have no predictions in common with the reference
+    """
+    if len(agreements) == 0:
+        raise ValueError(f'None of the {num_reference} predictions of {reference_results_file} '
+                         f'have a counterpart in {results_file}')
+    return float(np.mean(agreements)), len(agreements), num_reference
+
+
 def build_figure(results: Dict[str, Dict[str, Any]]) -> plt.Figure:
     fig, ax = plt.subplots()
 
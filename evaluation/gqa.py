@@ -0,0 +1,33 @@
+from typing import List, Tuple
+
+import yaml
+
+from evaluation.common import summarize_agreement
+
+
+def compute_agreement(reference_results_file: str, results_file: str) -> Tuple[float, int, int]:
+    """ The agreement of the predictions of two GQA runs on the prompts and programs both of them have results for
+
+    Returns
+    -------
+    Tuple[float, int, int]
+        The fraction of agreeing predictions, the number of predictions compared and the number of reference
+        predictions, see summarize_agreement
+    """
+    with open(reference_results_file, 'r') as f:
+        reference_results = yaml.safe_load(f)
+    with open(results_file, 'r') as f:
+        prompts = {prompt['id']: prompt for prompt in yaml.safe_load(f)}
+
+    agreements: List[bool] = []
+    num_reference = 0
+    for reference_prompt in reference_results:
+        programs = prompts[reference_prompt['id']]['programs'] if reference_prompt['id'] in prompts else []
+        for k, reference_program in enumerate(reference_prompt['programs']):
+            if 'results' not in reference_program:
+                continue
+            num_reference += 1
+            if k < len(programs) and 'results' in programs[k]:
+                agreements.append(reference_program['results']['prediction'] == programs[k]['results']['prediction'])
+
+    return summarize_agreement(agreements, num_reference, reference_results_file, results_file)
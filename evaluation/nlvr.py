@@ -1,9 +1,11 @@
 from collections import defaultdict, Counter
-from typing import List, Dict, Any, Hashable
+from typing import List, Dict, Any, Hashable, Tuple
 
 import numpy as np
 import yaml
 
+from evaluation.common import summarize_agreement
+
 
 def compute_stats(results_file: str) -> List[Dict[str, Any]]:
     with open(results_file, 'r') as f:
@@ -65,3 +67,31 @@ def compute_one_run_accuracy(results_file: str, seed: int) -> float:
 
     accuracy = np.mean(correct)
     return accuracy
+
+
+def compute_agreement(reference_results_file: str, results_file: str) -> Tuple[float, int, int]:
+    """ The agreement of the predictions of two runs on the prompts, programs and pairs both of them have results for
+
+    Returns
+    -------
+    Tuple[float, int, int]
+        The fraction of agreeing predictions, the number of predictions compared and the number of reference
+        predictions, see summarize_agreement
+    """
+    with open(reference_results_file, 'r') as f:
+        reference_results = yaml.safe_load(f)
+    with open(results_file, 'r') as f:
+        prompts = {prompt['id']: prompt for prompt in yaml.safe_load(f)}
+
+    agreements: List[bool] = []
+    num_reference = 0
+    for reference_prompt in reference_results:
+        programs = prompts[reference_prompt['id']]['programs'] if reference_prompt['id'] in prompts else []
+        for k, reference_program in enumerate(reference_prompt['programs']):
+            results = programs[k].get('results', {}) if k < len(programs) else {}
+            for pair_id, reference_result in reference_program.get('results', {}).items():
+                num_reference += 1
+                if pair_id in results:
+                    agreements.append(reference_result['prediction'] == results[pair_id]['prediction'])
+
+    return summarize_agreement(agreements, num_reference, reference_results_file, results_file)
@@ -0,0 +1,54 @@
+import argparse
+
+from modules.model_store import ModelStore
+
+MODEL_NAMES = [
+    "google/owlvit-base-patch32",
+    "dandelin/vilt-b32-finetuned-vqa",
+    "openai/clip-vit-large-patch14",
+    "facebook/maskformer-swin-base-ade",
+    "runwayml/stable-diffusion-inpainting",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Manage the local model store used with --model-store',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-r', '--root',
+        type=str,
+        default=None,
+        help='the store directory, defaults to <VISPROG_CACHE_DIR>/models',
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='download models into the store')
+    add_parser.add_argument(
+        'model_names',
+        type=str,
+        nargs='*',
+        default=MODEL_NAMES,
+    )
+    add_parser.add_argument(
+        '--variant',
+        type=str,
+        default=None,
+        help='store the weights of this variant, such as fp16, instead of the main float32 weights where available',
+    )
+    subparsers.add_parser('list', help='list the models in the store')
+
+    args = parser.parse_args()
+    store = ModelStore(args.root)
+
+    if args.command == 'add':
+        for model_name in args.model_names:
+            print(f'Adding {model_name} to {store.root}')
+            store.add(model_name, variant=args.variant)
+    elif args.command == 'list':
+        for model_name in MODEL_NAMES:
+            print(f'{model_name}: {"present" if model_name in store else "missing"}')
+
+
+if __name__ == '__main__':
+    main()
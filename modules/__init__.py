@@ -1,4 +1,9 @@
 from .visprog_module import VisProgModule, ExecutionError
+from .image_buffer import ImageBuffer
+from .regions import Boxes, Mask
+from .tiled import TiledImage
+from .inference_policy import InferencePolicy
+from .model_store import ModelStore
 from .bgblur import BGBlur
 from .colorpop import ColorPop
 from .count import Count
@@ -1,10 +1,13 @@
 import re
-from typing import Any, Dict
+from typing import Any, Dict, Union
 
 import numpy as np
 from PIL import Image, ImageFilter
 import PIL
 
+from modules.image_buffer import ImageBuffer, as_array, as_pil
+from modules.regions import Boxes, PackedMask, as_mask, mask_box
+from modules.tiled import TiledImage, mask_rows
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
@@ -12,6 +15,30 @@ class BGBlur(VisProgModule):
     pattern = re.compile(r"(?P<output>\S*)\s*=\s*BGBLUR\s*"
                          r"\(\s*image\s*=\s*(?P<image>\S*)\s*"
                          r",\s*object\s*=\s*(?P<object>\S*)\s*\)")
+    accepts_image_buffers = True
+
+    def __init__(self, radius: float = 5., downscale: int = 2):
+        """
+        Parameters
+        ----------
+        radius : float
+            The radius of the Gaussian blur at full resolution
+
+        downscale : int
+            The factor the background is downscaled by before blurring with a proportionally smaller radius,
+            1 blurs at full resolution
+        """
+        super().__init__()
+        self.radius = radius
+        self.downscale = downscale
+
+    def blur(self, image: Image.Image) -> Image.Image:
+        if self.downscale <= 1:
+            return image.filter(ImageFilter.GaussianBlur(radius=self.radius))
+        small_size = (max(1, image.width // self.downscale), max(1, image.height // self.downscale))
+        small = image.resize(small_size, Image.BOX)
+        small = small.filter(ImageFilter.GaussianBlur(radius=self.radius / self.downscale))
+        return small.resize(image.size, Image.BILINEAR)
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -37,28 +64,67 @@ class BGBlur(VisProgModule):
                               'object': match.group('object')
                           })
 
-    def perform_module_function(self, image: Image.Image, object: np.ndarray) -> Image.Image:
+    def perform_module_function(self, image: Union[ImageBuffer, TiledImage, Image.Image],
+                                object: Union[np.ndarray, PackedMask, Boxes]) -> Union[TiledImage, Image.Image]:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
-            The original image
+        image : Union[ImageBuffer, TiledImage, Image.Image]
+            The original image, tiled images are processed strip by strip
 
-        object : np.ndarray
-            The object binary mask
+        object : Union[np.ndarray, PackedMask, Boxes]
+            The object binary mask, or the object boxes
 
         Returns
         -------
-        Image.Image
+        Union[TiledImage, Image.Image]
             The color popped image
         """
-        blured_image = np.array(image.filter(ImageFilter.GaussianBlur(radius=5)))
-        image_array = np.array(image)
-        image_array[~object] = blured_image[~object]
-        return PIL.Image.fromarray(image_array)
-
-    def html(self, output: Image.Image, image: Image.Image, object: np.ndarray) -> Dict[str, Any]:
+        if isinstance(image, TiledImage):
+            return self.perform_tiled(image, object)
+
+        image_array = as_array(image)
+        with self.buffer_pool.scratch(image_array.shape[:2], bool) as background, \
+                self.buffer_pool.scratch(image_array.shape) as output:
+            np.logical_not(as_mask(object, image_array.shape[1::-1]), out=background)
+            np.copyto(output, image_array)
+            box = mask_box(background)
+            if box is not None:
+                # blur only the background and the margin the blur kernel reaches from it
+                x1, y1, x2, y2 = box
+                margin = int(np.ceil(3 * self.radius))
+                window_x1, window_y1 = max(x1 - margin, 0), max(y1 - margin, 0)
+                window = (window_x1, window_y1, min(x2 + margin, image_array.shape[1]),
+                          min(y2 + margin, image_array.shape[0]))
+                blurred = np.asarray(self.blur(as_pil(image).crop(window)))
+                np.copyto(output[y1:y2, x1:x2], blurred[y1 - window_y1:y2 - window_y1, x1 - window_x1:x2 - window_x1],
+                          where=background[y1:y2, x1:x2, None])
+            # PIL copies RGB arrays, so the scratch arrays can be reused as soon as the image is made
+            return PIL.Image.fromarray(output)
+
+    def perform_tiled(self, image: TiledImage, object: Union[np.ndarray, PackedMask, Boxes]) -> TiledImage:
+        """ Blur the background strip by strip, reading the rows the blur reaches around each strip with it so that
+            the seams between strips do not show
+        """
+        halo = int(np.ceil(3 * self.radius)) + 2 * max(self.downscale, 1)
+        writer = image.create_like()
+        for y1, y2 in image.strips():
+            rows = image.read_rows(y1, y2)
+            background = ~mask_rows(object, image.size, y1, y2)
+            box = mask_box(background)
+            if box is not None:
+                x1, x2 = box[0], box[2]
+                window_x1, window_y1 = max(x1 - halo, 0), max(y1 - halo, 0)
+                window = image.read_rows(window_y1, y2 + halo)[:, window_x1:min(x2 + halo, image.width)]
+                blurred = np.asarray(self.blur(Image.fromarray(window)))
+                np.copyto(rows[:, x1:x2], blurred[y1 - window_y1:y2 - window_y1, x1 - window_x1:x2 - window_x1],
+                          where=background[:, x1:x2, None])
+            writer.write(rows)
+        return writer.finish()
+
+    def html(self, output: Union[TiledImage, Image.Image], image: Union[ImageBuffer, TiledImage, Image.Image],
+             object: Union[np.ndarray, PackedMask, Boxes]) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
@@ -74,10 +140,13 @@ class BGBlur(VisProgModule):
         str
             The HTML to display the output
         """
-        image_array = np.array(image)
+        if isinstance(image, TiledImage):  # never decode a whole tiled image
+            return {'input': image, 'output': output}
+        image_array = as_array(image)
+        object = as_mask(object, image_array.shape[1::-1])
 
         return {
-            'background': PIL.Image.fromarray(image_array * (~object[..., None])),
-            'foreground': PIL.Image.fromarray(image_array * object[..., None]),
+            'background': self.buffer_pool.masked_image(image_array, object, inside=False),
+            'foreground': self.buffer_pool.masked_image(image_array, object),
             'output': output
         }
@@ -0,0 +1,85 @@
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+class BufferPool:
+    """ Scratch numpy arrays keyed by shape and dtype, borrowed by modules and given back when they are done.
+
+    A borrowed array has arbitrary contents and must not be referenced after it is released. Released arrays are kept
+    for the next borrow of the same shape and dtype, up to max_bytes in total, evicting the arrays of the least
+    recently released shape first. All modules share VisProgModule.buffer_pool unless another pool is attached.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.free: Dict[Tuple[Tuple[int, ...], np.dtype], List[np.ndarray]] = OrderedDict()
+        self.free_bytes = 0
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def borrow(self, shape: Tuple[int, ...], dtype: np.dtype = np.uint8) -> np.ndarray:
+        key = (tuple(shape), np.dtype(dtype))
+        with self.lock:
+            self.stats['borrows'] += 1
+            arrays = self.free.get(key)
+            if arrays:
+                self.stats['reuses'] += 1
+                array = arrays.pop()
+                self.free_bytes -= array.nbytes
+                return array
+        array = np.empty(key[0], dtype=key[1])
+        with self.lock:
+            self.stats['allocated_bytes'] += array.nbytes
+        return array
+
+    def release(self, array: np.ndarray):
+        key = (array.shape, array.dtype)
+        with self.lock:
+            self.free.setdefault(key, []).append(array)
+            self.free.move_to_end(key)
+            self.free_bytes += array.nbytes
+            while self.free_bytes > self.max_bytes:
+                oldest_key, arrays = next(iter(self.free.items()))
+                self.free_bytes -= arrays.pop(0).nbytes
+                self.stats['evictions'] += 1
+                if not arrays:
+                    del self.free[oldest_key]
+            self.stats['peak_pooled_bytes'] = max(self.stats['peak_pooled_bytes'], self.free_bytes)
+
+    @contextmanager
+    def scratch(self, shape: Tuple[int, ...], dtype: np.dtype = np.uint8) -> Iterator[np.ndarray]:
+        """ Borrow an array for the duration of the with block """
+        array = self.borrow(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.release(array)
+
+    def masked_image(self, image_array: np.ndarray, mask: np.ndarray, inside: bool = True) -> Image.Image:
+        """ The image with the pixels outside of the mask, or inside it if inside is False, set to black """
+        with self.scratch(image_array.shape, image_array.dtype) as output:
+            # PIL copies RGB arrays, so the scratch array can be reused as soon as the image is made
+            np.copyto(output, image_array)
+            np.copyto(output, 0, where=(np.logical_not(mask) if inside else np.asarray(mask, dtype=bool))[..., None])
+            return Image.fromarray(output)
+
+    def attach(self, modules: list):
+        """ Make the modules borrow their scratch arrays from this pool """
+        for module in modules:
+            module.buffer_pool = self
+
+    def report(self) -> Dict[str, float]:
+        """ The reuse rate of the borrows, the bytes allocated on misses and the bytes held by the pool """
+        return dict(
+            borrows=self.stats['borrows'],
+            reuse_rate=self.stats['reuses'] / self.stats['borrows'] if self.stats['borrows'] else 0.,
+            allocated_mb=self.stats['allocated_bytes'] / 2 ** 20,
+            pooled_mb=self.free_bytes / 2 ** 20,
+            peak_pooled_mb=self.stats['peak_pooled_bytes'] / 2 ** 20,
+            evictions=self.stats['evictions'],
+        )
@@ -0,0 +1,186 @@
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+from PIL import Image
+
+from modules.image_buffer import ImageBuffer
+from modules.regions import Boxes, PackedMask
+
+
+def default_cache_dir(*subdirs: str) -> str:
+    """ The on-disk cache directory, VISPROG_CACHE_DIR or ~/.cache/visprog """
+    root = os.environ.get('VISPROG_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'visprog'))
+    return os.path.join(root, *subdirs)
+
+
+def versioned_cache_path(kind: str, model_name: str, extension: str, cache_dir: Optional[str] = None) -> str:
+    """ The cache file of a converted model, invalidated when torch or transformers are upgraded """
+    import torch
+    import transformers
+
+    cache_dir = cache_dir or default_cache_dir(kind)
+    file_name = re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)
+    return os.path.join(cache_dir, f'{file_name}-torch{torch.__version__}-transformers{transformers.__version__}'
+                                   f'.{extension}')
+
+
+def atomic_save(save: Callable[[str], Any], path: str):
+    """ Save through a temporary file so that concurrent processes never read a partially written file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    save(temporary_path)
+    os.replace(temporary_path, path)
+
+
+def fingerprint(*values: Any) -> str:
+    """ Compute a content hash of images, arrays and plain values
+
+    Parameters
+    ----------
+    values : Any
+        PIL images, image buffers, numpy arrays, boxes, packed masks or values with a stable repr
+        (str, int, tuples, ...)
+
+    Returns
+    -------
+    str
+        The hex digest identifying the values
+    """
+    digest = hashlib.sha1()
+    for value in values:
+        if isinstance(value, ImageBuffer):  # hashed like the equivalent RGB PIL image
+            digest.update(f'RGB{value.size}'.encode())
+            digest.update(np.ascontiguousarray(value.array).tobytes())
+        elif isinstance(value, Image.Image):
+            digest.update(f'{value.mode}{value.size}'.encode())
+            digest.update(value.tobytes())
+        elif isinstance(value, Boxes):
+            digest.update(f'Boxes{len(value)}'.encode())
+            digest.update(np.ascontiguousarray(value.array).tobytes())
+            if value.scores is not None:
+                digest.update(np.ascontiguousarray(value.scores).tobytes())
+        elif isinstance(value, PackedMask):
+            digest.update(f'PackedMask{value.shape}'.encode())
+            digest.update(value.bits.tobytes())
+        elif isinstance(value, np.ndarray):
+            digest.update(f'{value.dtype}{value.shape}'.encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        else:
+            digest.update(repr(value).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """ A small in-memory least-recently-used cache """
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class InferenceCache:
+    """ A persistent cache of module outputs shared by processes and runs.
+
+    Entries live in a SQLite database in WAL mode, so several worker processes can read and write it concurrently,
+    with an in-memory LRU tier in front. When the database grows beyond max_size_bytes, the least recently
+    accessed entries are evicted. Keys are built by VisProgModule from the module's cache identity (model id,
+    revision and configuration) and its inputs, so upgrading a model invalidates its entries.
+    """
+    eviction_interval = 64
+
+    def __init__(self, path: Optional[str] = None, max_size_bytes: int = 2 ** 30, memory_size: int = 256):
+        self.path = path or default_cache_dir('inference.sqlite')
+        self.max_size_bytes = max_size_bytes
+        self.memory = LRUCache(memory_size)
+        self.lock = threading.Lock()
+        self.puts_since_eviction = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                '(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                                'accessed REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        value = pickle.loads(row[0])
+        self.memory.put(key, value)
+        return value
+
+    def put(self, key: str, value: Any):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.memory.put(key, value)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                                    (key, blob, len(blob), time.time()))
+            self.puts_since_eviction += 1
+            if self.puts_since_eviction >= self.eviction_interval:
+                self.puts_since_eviction = 0
+                self.evict()
+
+    def evict(self):
+        """ Delete the least recently accessed entries until the database is below its size limit """
+        total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        excess = total_size - self.max_size_bytes
+        evicted_keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            if excess <= 0:
+                break
+            evicted_keys.append((key,))
+            excess -= size
+        self.connection.executemany('DELETE FROM entries WHERE key = ?', evicted_keys)
+
+    def attach(self, modules: list):
+        """ Make the modules look up and store their outputs in this cache """
+        for module in modules:
+            module.inference_cache = self
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,10 +1,13 @@
 import re
-from typing import Any, Dict
+from typing import Any, Dict, Union
 
 import numpy as np
 from PIL import Image
 import PIL
 
+from modules.image_buffer import ImageBuffer, as_array, as_pil
+from modules.regions import Boxes, PackedMask, as_mask, mask_box
+from modules.tiled import TiledImage, mask_rows
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
@@ -12,6 +15,7 @@ class ColorPop(VisProgModule):
     pattern = re.compile(r"(?P<output>\S*)\s*=\s*COLORPOP\s*"
                          r"\(\s*image\s*=\s*(?P<image>\S*)\s*"
                          r",\s*object\s*=\s*(?P<object>\S*)\s*\)")
+    accepts_image_buffers = True
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -37,29 +41,49 @@ class ColorPop(VisProgModule):
                               'object': match.group('object')
                           })
 
-    def perform_module_function(self, image: Image.Image, object: np.ndarray) -> Image.Image:
+    def perform_module_function(self, image: Union[ImageBuffer, TiledImage, Image.Image],
+                                object: Union[np.ndarray, PackedMask, Boxes]) -> Union[TiledImage, Image.Image]:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
-            The original image
+        image : Union[ImageBuffer, TiledImage, Image.Image]
+            The original image, tiled images are processed strip by strip
 
-        object : np.ndarray
-            The object binary mask
+        object : Union[np.ndarray, PackedMask, Boxes]
+            The object binary mask, or the object boxes
 
         Returns
         -------
-        Image.Image
+        Union[TiledImage, Image.Image]
             The color popped image
         """
-        image_array = np.array(image)
-        image_grayscale = np.array(image.convert('L').convert('RGB'))
-        mask = object[..., None].repeat(3, axis=-1)
-        image_array = np.where(mask, image_array, image_grayscale)
-        return PIL.Image.fromarray(image_array)
-
-    def html(self, output: Image.Image, image: Image.Image, object: np.ndarray) -> Dict[str, Any]:
+        if isinstance(image, TiledImage):
+            return self.perform_tiled(image, object)
+
+        image_array = as_array(image)
+        mask = as_mask(object, image_array.shape[1::-1])
+        with self.buffer_pool.scratch(image_array.shape) as output:
+            output[...] = np.asarray(as_pil(image).convert('L'))[..., None]
+            # only the bounding box of the object keeps its colors
+            box = mask_box(mask)
+            if box is not None:
+                x1, y1, x2, y2 = box
+                np.copyto(output[y1:y2, x1:x2], image_array[y1:y2, x1:x2], where=mask[y1:y2, x1:x2, None])
+            # PIL copies RGB arrays, so the scratch array can be reused as soon as the image is made
+            return PIL.Image.fromarray(output)
+
+    def perform_tiled(self, image: TiledImage, object: Union[np.ndarray, PackedMask, Boxes]) -> TiledImage:
+        writer = image.create_like()
+        for y1, y2 in image.strips():
+            rows = image.read_rows(y1, y2)
+            gray = np.asarray(Image.fromarray(rows).convert('L'))
+            np.copyto(rows, gray[..., None], where=~mask_rows(object, image.size, y1, y2)[..., None])
+            writer.write(rows)
+        return writer.finish()
+
+    def html(self, output: Union[TiledImage, Image.Image], image: Union[ImageBuffer, TiledImage, Image.Image],
+             object: Union[np.ndarray, PackedMask, Boxes]) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
@@ -75,10 +99,13 @@ class ColorPop(VisProgModule):
         str
             The HTML to display the output
         """
-        image_array = np.array(image)
+        if isinstance(image, TiledImage):  # never decode a whole tiled image
+            return {'input': image, 'output': output}
+        image_array = as_array(image)
+        object = as_mask(object, image_array.shape[1::-1])
 
         return {
-            'background': PIL.Image.fromarray(image_array * (~object[..., None])),
-            'foreground': PIL.Image.fromarray(image_array * object[..., None]),
+            'background': self.buffer_pool.masked_image(image_array, object, inside=False),
+            'foreground': self.buffer_pool.masked_image(image_array, object),
             'output': output
         }
@@ -0,0 +1,37 @@
+import os
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import BatchFeature
+
+from modules.caching import default_cache_dir
+
+
+def enable_compile_cache(cache_dir: Optional[str] = None):
+    """ Persist the compiled graphs on disk so that later processes start warm """
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir or default_cache_dir('inductor'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+
+
+def compile_model(model: torch.nn.Module, dynamic: Optional[bool] = None) -> torch.nn.Module:
+    """ Wrap the model in torch.compile, backed by the persistent compile cache """
+    enable_compile_cache()
+    return torch.compile(model, dynamic=dynamic)
+
+
+def pad_pixels_to_bucket(encoding: BatchFeature, multiple: int = 64) -> BatchFeature:
+    """ Pad pixel_values and pixel_mask to a multiple of the bucket size.
+
+    Images of slightly different sizes then share the same input shape, which avoids recompiling the model.
+    The padding is masked out through pixel_mask, like the padding the processors add to batches.
+    """
+    height, width = encoding['pixel_values'].shape[-2:]
+    pad_height, pad_width = -height % multiple, -width % multiple
+    if pad_height or pad_width:
+        encoding['pixel_values'] = F.pad(encoding['pixel_values'], (0, pad_width, 0, pad_height))
+        encoding['pixel_mask'] = F.pad(encoding['pixel_mask'], (0, pad_width, 0, pad_height))
+    return encoding
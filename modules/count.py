@@ -1,8 +1,9 @@
 import re
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Tuple, Union
 
 from PIL import Image
 
+from modules.regions import Boxes
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
@@ -33,7 +34,7 @@ class Count(VisProgModule):
                               'boxes': match.group('box')
                           })
 
-    def perform_module_function(self, boxes: Tuple[Tuple[float,...],...]) -> int:
+    def perform_module_function(self, boxes: Union[Boxes, Tuple[Tuple[float,...],...]]) -> int:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
@@ -49,9 +50,9 @@ class Count(VisProgModule):
         Image.Image
             The color popped image
         """
-        return len(boxes)
+        return len(Boxes.from_any(boxes))
 
-    def html(self, output: Any, boxes: Tuple[Tuple[float,...],...]) -> Dict[str, Any]:
+    def html(self, output: Any, boxes: Union[Boxes, Tuple[Tuple[float,...],...]]) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
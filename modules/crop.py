@@ -1,10 +1,13 @@
 import re
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Tuple, Union
 
 import numpy as np
 import PIL
 from PIL import Image, ImageFilter
 
+from modules.image_buffer import ImageBuffer
+from modules.regions import Boxes
+from modules.tiled import TiledImage
 from modules.visprog_module import ParsedStep, VisProgModule
 
 
@@ -14,6 +17,8 @@ class Crop(VisProgModule):
         r"\(\s*image\s*=\s*(?P<image>\S*)\s*"
         r",\s*box\s*=\s*(?P<box>\S*)\s*\)"
     )
+    # crops are views of the input image that only copy pixels when they are needed
+    accepts_image_buffers = True
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """Parse step and return list of input values/variable names
@@ -38,9 +43,20 @@ class Crop(VisProgModule):
             input_var_names={"image": match.group("image"), "box": match.group("box")},
         )
 
+    @staticmethod
+    def crop_image(
+        image: Union[ImageBuffer, TiledImage, Image.Image], box: Tuple[float, ...]
+    ) -> Union[ImageBuffer, TiledImage]:
+        """Crop a view of an in-memory image, or copy the box of a tiled image strip by strip"""
+        if isinstance(image, TiledImage):
+            return image.crop(box)
+        return ImageBuffer.wrap(image).crop(box)
+
     def perform_module_function(
-        self, image: Image.Image, box: Tuple[Tuple[float, ...], ...]
-    ) -> Image.Image:
+        self,
+        image: Union[ImageBuffer, TiledImage, Image.Image],
+        box: Union[Boxes, Tuple[Tuple[float, ...], ...]],
+    ) -> Union[ImageBuffer, TiledImage, Image.Image]:
         """Perform the color pop operation on the image using the object mask
 
         Parameters
@@ -57,10 +73,13 @@ class Crop(VisProgModule):
             The color popped image
         """
         # If there is a crop, crop it, if not, return the image as is...
-        return image.crop(box[0]) if len(box) > 0 else image
+        return self.crop_image(image, box[0]) if len(box) > 0 else image
 
     def html(
-        self, output: Image.Image, image: Image.Image, box: Tuple[float, ...]
+        self,
+        output: Union[ImageBuffer, TiledImage, Image.Image],
+        image: Union[ImageBuffer, TiledImage, Image.Image],
+        box: Tuple[float, ...],
     ) -> Dict[str, Any]:
         """Generate HTML to display the output
 
@@ -69,8 +88,8 @@ class Crop(VisProgModule):
         inputs : Dict[str, Any]
             The input variables and their values
 
-        output : Image.Image
-            The output image
+        output : Union[ImageBuffer, TiledImage, Image.Image]
+            The output image, kept as a view until the details are rendered, see ProgramResult.rendered_details
 
         Returns
         -------
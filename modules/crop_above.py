@@ -1,9 +1,12 @@
 import re
-from typing import Tuple
+from typing import Tuple, Union
 
 from PIL import Image
 
 from modules import Crop
+from modules.image_buffer import ImageBuffer
+from modules.regions import Boxes
+from modules.tiled import TiledImage
 
 
 class CropAbove(Crop):
@@ -14,8 +17,10 @@ class CropAbove(Crop):
     )
 
     def perform_module_function(
-        self, image: Image.Image, box: Tuple[Tuple[float, ...], ...]
-    ) -> Image.Image:
+        self,
+        image: Union[ImageBuffer, TiledImage, Image.Image],
+        box: Union[Boxes, Tuple[Tuple[float, ...], ...]],
+    ) -> Union[ImageBuffer, TiledImage, Image.Image]:
         """Perform the color pop operation on the image using the object mask
 
         Parameters
@@ -37,6 +42,6 @@ class CropAbove(Crop):
 
         # check that boinding box dimensions are valid
         if above_box[0] < above_box[2] and above_box[1] < above_box[3] and len(box) > 0:
-            return image.crop(above_box)
+            return self.crop_image(image, above_box)
         else:
             return image
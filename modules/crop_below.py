@@ -1,9 +1,12 @@
 import re
-from typing import Tuple
+from typing import Tuple, Union
 
 from PIL import Image
 
 from modules import Crop
+from modules.image_buffer import ImageBuffer
+from modules.regions import Boxes
+from modules.tiled import TiledImage
 
 
 class CropBelow(Crop):
@@ -14,8 +17,10 @@ class CropBelow(Crop):
     )
 
     def perform_module_function(
-        self, image: Image.Image, box: Tuple[Tuple[float, ...], ...]
-    ) -> Image.Image:
+        self,
+        image: Union[ImageBuffer, TiledImage, Image.Image],
+        box: Union[Boxes, Tuple[Tuple[float, ...], ...]],
+    ) -> Union[ImageBuffer, TiledImage, Image.Image]:
         """Perform the color pop operation on the image using the object mask
 
         Parameters
@@ -35,6 +40,6 @@ class CropBelow(Crop):
         original_box = box[0] if len(box) > 0 else (0, 0, image.width, image.height)
         below_box = (0, original_box[3], image.width, image.height)
         if below_box[0] < below_box[2] and below_box[1] < below_box[3] and len(box) > 0:
-            return image.crop(below_box)
+            return self.crop_image(image, below_box)
         else:
             return image
@@ -1,9 +1,12 @@
 import re
-from typing import Tuple
+from typing import Tuple, Union
 
 from PIL import Image
 
 from modules import Crop
+from modules.image_buffer import ImageBuffer
+from modules.regions import Boxes
+from modules.tiled import TiledImage
 
 
 class CropLeft(Crop):
@@ -14,8 +17,10 @@ class CropLeft(Crop):
     )
 
     def perform_module_function(
-        self, image: Image.Image, box: Tuple[Tuple[float, ...], ...]
-    ) -> Image.Image:
+        self,
+        image: Union[ImageBuffer, TiledImage, Image.Image],
+        box: Union[Boxes, Tuple[Tuple[float, ...], ...]],
+    ) -> Union[ImageBuffer, TiledImage, Image.Image]:
         """Perform the color pop operation on the image using the object mask
 
         Parameters
@@ -36,6 +41,6 @@ class CropLeft(Crop):
         left_box = (0, 0, original_box[0], image.height)
         # check that bounding box dimensions are valid
         if left_box[0] < left_box[2] and left_box[1] < left_box[3] and len(box) > 0:
-            return image.crop(left_box)
+            return self.crop_image(image, left_box)
         else:
             return image
@@ -1,9 +1,12 @@
 import re
-from typing import Tuple
+from typing import Tuple, Union
 
 from PIL import Image
 
 from modules import Crop
+from modules.image_buffer import ImageBuffer
+from modules.regions import Boxes
+from modules.tiled import TiledImage
 
 
 class CropRight(Crop):
@@ -14,8 +17,10 @@ class CropRight(Crop):
     )
 
     def perform_module_function(
-        self, image: Image.Image, box: Tuple[Tuple[float, ...], ...]
-    ) -> Image.Image:
+        self,
+        image: Union[ImageBuffer, TiledImage, Image.Image],
+        box: Union[Boxes, Tuple[Tuple[float, ...], ...]],
+    ) -> Union[ImageBuffer, TiledImage, Image.Image]:
         """Perform the color pop operation on the image using the object mask
 
         Parameters
@@ -36,6 +41,6 @@ class CropRight(Crop):
         right_box = (original_box[2], 0, image.width, image.height)
         # check that boinding box dimensions are valid
         if right_box[0] < right_box[2] and right_box[1] < right_box[3] and len(box) > 0:
-            return image.crop(right_box)
+            return self.crop_image(image, right_box)
         else:
             return image
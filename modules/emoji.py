@@ -1,13 +1,16 @@
 import os
 import re
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 from PIL import Image, ImageFilter
 import PIL
-import augly.image as imaugs
 from augly.utils.constants import SMILEY_EMOJI_DIR
 
+from modules.caching import LRUCache
+from modules.image_buffer import ImageBuffer, as_array
+from modules.regions import Boxes
+from modules.tiled import TiledImage
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
@@ -16,6 +19,18 @@ class Emoji(VisProgModule):
                          r"\(\s*image\s*=\s*(?P<image>\S*)\s*"
                          r",\s*object\s*=\s*(?P<object>\S*)\s*"
                          r",\s*emoji\s*=\s*'(?P<emoji>\S*)'\s*\)")
+    accepts_image_buffers = True
+
+    def __init__(self, cache_size: int = 64):
+        """
+        Parameters
+        ----------
+        cache_size : int
+            The number of resized emoji assets kept in memory
+        """
+        super().__init__()
+        self.emoji_images: Dict[str, Image.Image] = {}
+        self.assets = LRUCache(cache_size)
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -58,37 +73,107 @@ class Emoji(VisProgModule):
         """
         return os.path.join(SMILEY_EMOJI_DIR, f"{emoji}.png")
 
-    def perform_module_function(self, image: Image.Image, boxes: Tuple[Tuple[float, ...], ...],
-                                emoji: str) -> Image.Image:
+    def load_emoji(self, emoji: str) -> Image.Image:
+        """ The RGBA emoji image, decoded once """
+        if emoji not in self.emoji_images:
+            with Image.open(self.get_emoji_path(emoji)) as emoji_image:
+                self.emoji_images[emoji] = emoji_image.convert('RGBA')
+        return self.emoji_images[emoji]
+
+    def get_asset(self, emoji: str, size: Tuple[int, int]) -> np.ndarray:
+        """ The (H, W, 4) RGBA pixels of the emoji resized to size (width, height) """
+        key = (emoji, size)
+        asset = self.assets.get(key)
+        if asset is None:
+            asset = np.asarray(self.load_emoji(emoji).resize(size))
+            self.assets.put(key, asset)
+        return asset
+
+    def get_placements(self, boxes: Union[Boxes, Tuple[Tuple[float, ...], ...]], emoji: str
+                       ) -> List[Tuple[int, int, int, int]]:
+        """ The position and size (left, top, width, height) of the emoji on each box, like augly's overlay_emoji:
+            as tall as the box and centered on it horizontally
+        """
+        emoji_image = self.load_emoji(emoji)
+        boxes = Boxes.from_any(boxes).array.astype(np.float64)
+        emoji_heights = np.maximum(1, (boxes[:, 3] - boxes[:, 1]).astype(np.int64))
+        emoji_widths = np.maximum(1, (emoji_image.width * emoji_heights / emoji_image.height).astype(np.int64))
+        lefts = ((boxes[:, 0] + boxes[:, 2] - (boxes[:, 3] - boxes[:, 1])) * 0.5).astype(np.int64)
+        tops = boxes[:, 1].astype(np.int64)
+        return list(zip(lefts.tolist(), tops.tolist(), emoji_widths.tolist(), emoji_heights.tolist()))
+
+    def paste_layer(self, layer: np.ndarray, emoji: str, placements: List[Tuple[int, int, int, int]], row: int = 0
+                    ) -> Optional[Tuple[int, int, int, int]]:
+        """ Paste the emojis into an RGBA layer that covers the image rows from row on, later emojis cover earlier
+            ones, and return the box (x1, y1, x2, y2) of the layer they cover or None
+        """
+        height, width = layer.shape[:2]
+        union = None
+        for left, top, emoji_width, emoji_height in placements:
+            top -= row
+            layer_x1, layer_y1 = max(left, 0), max(top, 0)
+            layer_x2, layer_y2 = min(left + emoji_width, width), min(top + emoji_height, height)
+            if layer_x1 >= layer_x2 or layer_y1 >= layer_y2:
+                continue
+            asset = self.get_asset(emoji, (emoji_width, emoji_height))
+            asset = asset[layer_y1 - top:layer_y2 - top, layer_x1 - left:layer_x2 - left]
+            np.copyto(layer[layer_y1:layer_y2, layer_x1:layer_x2], asset, where=asset[..., 3:] > 0)
+            union = (layer_x1, layer_y1, layer_x2, layer_y2) if union is None else \
+                (min(union[0], layer_x1), min(union[1], layer_y1), max(union[2], layer_x2), max(union[3], layer_y2))
+        return union
+
+    @staticmethod
+    def blend(output: np.ndarray, layer: np.ndarray, box: Optional[Tuple[int, int, int, int]]):
+        """ Alpha blend the box (x1, y1, x2, y2) of the RGBA layer over the output in place """
+        if box is None:
+            return
+        x1, y1, x2, y2 = box
+        alpha = layer[y1:y2, x1:x2, 3:].astype(np.uint16)
+        output[y1:y2, x1:x2] = (layer[y1:y2, x1:x2, :3] * alpha + output[y1:y2, x1:x2] * (255 - alpha) + 127) // 255
+
+    def perform_module_function(self, image: Union[ImageBuffer, TiledImage, Image.Image],
+                                boxes: Union[Boxes, Tuple[Tuple[float, ...], ...]],
+                                emoji: str) -> Union[TiledImage, Image.Image]:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
-            The original image
+        image : Union[ImageBuffer, TiledImage, Image.Image]
+            The original image, tiled images are processed strip by strip
 
-        boxes : np.ndarray
-            The object bounding box
+        boxes : Union[Boxes, Tuple[Tuple[float, ...], ...]]
+            The object bounding boxes, each one is covered by the emoji
 
         emoji : str
             The emoji to overlay on the image
 
         Returns
         -------
-        Image.Image
+        Union[TiledImage, Image.Image]
             The color popped image
         """
-        # TODO: which box we should use?
-        x1, y1, x2, y2 = boxes[0]
-        x_pos = (x1 + x2 - (y2 - y1)) * 0.5 / image.size[0]   # to center the emoji horizontally
-        y_pos = y1 / image.size[1]
-        aug_image = imaugs.overlay_emoji(image, emoji_path=self.get_emoji_path(emoji),
-                                         x_pos=x_pos, y_pos=y_pos,
-                                         emoji_size=(y2 - y1) / image.size[1])
-        return aug_image
-
-    def html(self, output: Image.Image, image: Image.Image, boxes: Tuple[Tuple[float, ...], ...],
-             emoji: str) -> Dict[str, Any]:
+        placements = self.get_placements(boxes, emoji)
+        if isinstance(image, TiledImage):
+            writer = image.create_like()
+            for y1, y2 in image.strips():
+                output = image.read_rows(y1, y2)
+                layer = np.zeros((y2 - y1, image.width, 4), dtype=np.uint8)
+                self.blend(output, layer, self.paste_layer(layer, emoji, placements, row=y1))
+                writer.write(output)
+            return writer.finish()
+
+        # paste the emojis of all boxes into one RGBA layer and alpha blend it over the image once
+        image_array = as_array(image)
+        with self.buffer_pool.scratch((*image_array.shape[:2], 4)) as layer, \
+                self.buffer_pool.scratch(image_array.shape) as output:
+            layer.fill(0)
+            np.copyto(output, image_array)
+            self.blend(output, layer, self.paste_layer(layer, emoji, placements))
+            # PIL copies RGB arrays, so the scratch arrays can be reused as soon as the image is made
+            return PIL.Image.fromarray(output)
+
+    def html(self, output: Union[TiledImage, Image.Image], image: Union[ImageBuffer, TiledImage, Image.Image],
+             boxes: Union[Boxes, Tuple[Tuple[float, ...], ...]], emoji: str) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
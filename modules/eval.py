@@ -11,6 +11,8 @@ class Eval(VisProgModule):
         r"(?P<output>\S*)\s*=\s*EVAL\s*"
         r"\(\s*expr\s*=\s*[\"\'](?P<expr>.*)[\"\']\s*\)"
     )
+    # expressions pass values through, image variables stay buffers
+    accepts_image_buffers = True
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """Parse step and return list of input values/variable names
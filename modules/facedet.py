@@ -1,23 +1,61 @@
 import re
-from typing import Any, Dict, Tuple
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import face_detection
 import numpy as np
 from PIL import Image, ImageDraw
-import torch
 
+from modules.caching import LRUCache, fingerprint
+from modules.image_buffer import ImageBuffer, as_array, as_pil
+from modules.inference_policy import InferencePolicy
+from modules.regions import Boxes
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
 class FaceDet(VisProgModule):
     pattern = re.compile(r"(?P<output>\S*)\s*=\s*FACEDET\s*"
                          r"\(\s*image\s*=\s*(?P<image>\S*)\s*\)")
+    accepts_image_buffers = True
+    # tiled images are analysed on their downscaled proxy
+    runs_on_proxy = True
 
-    def __init__(self, device: str = "cpu", confidence_threshold: float = 0.1, nms_iou_threshold: float = 0.1):
+    def __init__(self, device: str = "cpu", confidence_threshold: float = 0.1, nms_iou_threshold: float = 0.1,
+                 detection_resolution: Optional[int] = None, cache_size: int = 32,
+                 policy: Optional[InferencePolicy] = None):
+        """
+        Parameters
+        ----------
+        device : str
+            The device to run the detector on
+
+        confidence_threshold : float
+            The minimum confidence of a detected face
+
+        nms_iou_threshold : float
+            The IoU threshold of the non-maximum suppression
+
+        detection_resolution : Optional[int]
+            If given, images whose longest side exceeds this value are downscaled before detection
+            and the boxes are scaled back to the original coordinates
+
+        cache_size : int
+            The number of images whose detections are kept, keyed by image content
+
+        policy : Optional[InferencePolicy]
+            How to run the forward passes, the default policy if None
+        """
         super().__init__()
+        self.policy = policy or InferencePolicy()
         self.detector = face_detection.build_detector(
             "DSFDDetector", confidence_threshold=confidence_threshold,
             nms_iou_threshold=nms_iou_threshold, device=device)
+        self.confidence_threshold = confidence_threshold
+        self.nms_iou_threshold = nms_iou_threshold
+        self.detector.net = self.policy.prepare_model(self.detector.net)
+        self.device = device
+        self.detection_resolution = detection_resolution
+        self.cache = LRUCache(cache_size)
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -42,24 +80,73 @@ class FaceDet(VisProgModule):
                               'image': match.group('image')
                           })
 
-    def perform_module_function(self, image: Image.Image) -> Tuple[Tuple[float,...],...]:
+    def perform_module_function(self, image: Union[ImageBuffer, Image.Image]) -> Boxes:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
+        image : Union[ImageBuffer, Image.Image]
             The original image
 
         Returns
         -------
-        Tuple[float,...]
-            The box of the object in the image (x1, y1, x2, y2)
+        Boxes
+            The boxes of the faces in the image (x1, y1, x2, y2) and their confidences
         """
-        image = np.array(image)
-        boxes: torch.Tensor = self.detector.detect(image)
-        return tuple((xmin, ymin, xmax, ymax) for xmin, ymin, xmax, ymax, detection_confidence in boxes)
+        return self.detect_batch([image])[0]
 
-    def html(self, output: Tuple[Tuple[float,...],...], image: Image.Image) -> Dict[str, Any]:
+    def get_detection_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        if self.detection_resolution is None or max(size) <= self.detection_resolution:
+            return size
+        scale = self.detection_resolution / max(size)
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+    def detect_batch(self, images: List[Union[ImageBuffer, Image.Image]]) -> List[Boxes]:
+        """ Detect faces in several images, running the detector once per group of equally sized inputs
+
+        Parameters
+        ----------
+        images : List[Union[ImageBuffer, Image.Image]]
+            The images to detect faces in
+
+        Returns
+        -------
+        List[Boxes]
+            The face boxes (x1, y1, x2, y2) of each image, in original image coordinates, and their confidences
+        """
+        results: List[Optional[Boxes]] = [None] * len(images)
+        keys = [fingerprint(image, self.detection_resolution) for image in images]
+        groups = defaultdict(list)
+        for i, (image, key) in enumerate(zip(images, keys)):
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[i] = cached
+                continue
+            detection_size = self.get_detection_size(image.size)
+            if detection_size != image.size:
+                image = as_pil(image).resize(detection_size, Image.BILINEAR)
+            groups[detection_size].append((i, as_array(image)))
+
+        for (width, height), members in groups.items():
+            batch = np.stack([image_array for _, image_array in members])
+            # the detector converts its outputs to numpy itself, so it cannot run under bfloat16 autocast
+            with self.policy.inference(self.device, mixed_precision=False):
+                batch_boxes: List[np.ndarray] = self.detector.batched_detect(batch)
+            for (i, _), boxes in zip(members, batch_boxes):
+                boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 5)
+                results[i] = Boxes(boxes[:, :4], boxes[:, 4]).scale(images[i].size[0] / width,
+                                                                    images[i].size[1] / height)
+                self.cache.put(keys[i], results[i])
+        return results
+
+    def cache_identity(self) -> Optional[tuple]:
+        return ("DSFDDetector", self.confidence_threshold, self.nms_iou_threshold, self.detection_resolution,
+                self.policy.bfloat16)
+
+    def rescale_output(self, output: Boxes, from_size: Tuple[int, int], to_size: Tuple[int, int]) -> Boxes:
+        return Boxes.from_any(output).scale(to_size[0] / from_size[0], to_size[1] / from_size[1])
+
+    def html(self, output: Boxes, image: Union[ImageBuffer, Image.Image]) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
@@ -67,7 +154,7 @@ class FaceDet(VisProgModule):
         inputs : Dict[str, Any]
             The input variables and their values
 
-        output : Tuple[Tuple[float,...],...]
+        output : Boxes
             The output boxes
 
         Returns
@@ -75,6 +162,7 @@ class FaceDet(VisProgModule):
         Dict[str, Any]
             The HTML to display
         """
+        image = as_pil(image)
         bbox_drawn_image = image.copy()
         draw = ImageDraw.Draw(bbox_drawn_image)
         for box in output:
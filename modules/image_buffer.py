@@ -0,0 +1,169 @@
+from typing import Callable, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class ImageBuffer:
+    """ An RGB image in the program state that caches its PIL, numpy and torch representations.
+
+    A crop of a buffer is a view: it stores the uncropped root buffer and its box in root coordinates, crops of crops
+    compose into a single box, and pixels are only copied when the PIL image of a crop is requested. A crop of a crop
+    also keeps the bounds of the parent crop, the parts of the box outside of them are black like in PIL. The numpy
+    view of a crop that lies inside its bounds and its root is a slice of the root array. Arrays are read-only, copy
+    them before writing.
+    """
+
+    def __init__(self, image: Union[Image.Image, np.ndarray], root: Optional['ImageBuffer'] = None,
+                 box: Optional[Tuple[int, int, int, int]] = None, bounds: Optional[Tuple[int, int, int, int]] = None):
+        self._pil = image if isinstance(image, Image.Image) else None
+        self._array = image if isinstance(image, np.ndarray) else None
+        self._tensor = None
+        self.root = root
+        self.box = box
+        self.bounds = bounds
+
+    @classmethod
+    def wrap(cls, image: Union['ImageBuffer', Image.Image, np.ndarray]) -> 'ImageBuffer':
+        return image if isinstance(image, ImageBuffer) else cls(image)
+
+    @classmethod
+    def view(cls, root: 'ImageBuffer', box: Tuple[int, int, int, int],
+             bounds: Optional[Tuple[int, int, int, int]] = None) -> 'ImageBuffer':
+        return cls(None, root=root, box=box, bounds=bounds)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        if self.box is not None:
+            return self.box[2] - self.box[0], self.box[3] - self.box[1]
+        if self._pil is not None:
+            return self._pil.size
+        return self._array.shape[1], self._array.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    @property
+    def offset(self) -> Tuple[int, int]:
+        """ The position (x, y) of this image in its root image """
+        return (0, 0) if self.box is None else self.box[:2]
+
+    @property
+    def visible_box(self) -> Optional[Tuple[int, int, int, int]]:
+        """ The part (x1, y1, x2, y2) of the box of a crop, in root coordinates, whose pixels come from the root """
+        if self.box is None or self.bounds is None:
+            return self.box
+        return (max(self.box[0], self.bounds[0]), max(self.box[1], self.bounds[1]),
+                min(self.box[2], self.bounds[2]), min(self.box[3], self.bounds[3]))
+
+    @property
+    def clipped(self) -> bool:
+        """ Whether the crop reaches outside of the parent crop it was taken from """
+        return self.box is not None and self.visible_box != self.box
+
+    @property
+    def array(self) -> np.ndarray:
+        """ The read-only (H, W, 3) uint8 pixels """
+        if self._array is None:
+            if self.root is None:
+                image = self._pil if self._pil.mode == 'RGB' else self._pil.convert('RGB')
+                self._array = np.asarray(image)
+            elif not self.clipped:
+                self._array = self.crop_array(self.root.array, self.box)
+            else:
+                self._array = self.crop_clipped_array(self.root.array, self.box, self.visible_box)
+            self._array.flags.writeable = False
+        return self._array
+
+    @property
+    def pil(self) -> Image.Image:
+        """ The PIL image, crops remember their root image as crop_parent and their position in it as crop_offset """
+        if self._pil is None:
+            self._pil = Image.fromarray(self.array)
+            if self.root is not None and not self.clipped:
+                self._pil.crop_parent = self.root.pil
+                self._pil.crop_offset = self.offset
+        return self._pil
+
+    @property
+    def tensor(self) -> torch.Tensor:
+        """ The (3, H, W) uint8 pixels """
+        if self._tensor is None:
+            self._tensor = torch.from_numpy(np.array(self.array)).permute(2, 0, 1)
+        return self._tensor
+
+    @staticmethod
+    def crop_array(array: np.ndarray, box: Tuple[int, int, int, int]) -> np.ndarray:
+        """ Slice the box out of the array, padding the parts outside of the array with black like PIL """
+        x1, y1, x2, y2 = box
+        height, width = array.shape[:2]
+        if x1 >= 0 and y1 >= 0 and x2 <= width and y2 <= height:
+            return array[y1:y2, x1:x2]
+        output = np.zeros((y2 - y1, x2 - x1, *array.shape[2:]), dtype=array.dtype)
+        inside_x1, inside_y1 = max(x1, 0), max(y1, 0)
+        inside_x2, inside_y2 = min(x2, width), min(y2, height)
+        if inside_x1 < inside_x2 and inside_y1 < inside_y2:
+            output[inside_y1 - y1:inside_y2 - y1, inside_x1 - x1:inside_x2 - x1] = \
+                array[inside_y1:inside_y2, inside_x1:inside_x2]
+        return output
+
+    @classmethod
+    def crop_clipped_array(cls, array: np.ndarray, box: Tuple[int, int, int, int],
+                           visible_box: Tuple[int, int, int, int]) -> np.ndarray:
+        """ Slice the box out of the array with everything outside of visible_box black """
+        x1, y1, x2, y2 = box
+        output = np.zeros((y2 - y1, x2 - x1, *array.shape[2:]), dtype=array.dtype)
+        visible_x1, visible_y1, visible_x2, visible_y2 = visible_box
+        if visible_x1 < visible_x2 and visible_y1 < visible_y2:
+            output[visible_y1 - y1:visible_y2 - y1, visible_x1 - x1:visible_x2 - x1] = \
+                cls.crop_array(array, visible_box)
+        return output
+
+    def crop(self, box: Sequence[float]) -> 'ImageBuffer':
+        """ A view of the box (x1, y1, x2, y2) of this image, rounded to pixels like PIL's crop """
+        x1, y1, x2, y2 = (int(round(value)) for value in box)
+        offset_x, offset_y = self.offset
+        # the pixels of a crop of a crop are those of the parent crop, black outside of it
+        return ImageBuffer.view(self.root or self, (x1 + offset_x, y1 + offset_y, x2 + offset_x, y2 + offset_y),
+                                bounds=self.visible_box)
+
+    def to_root(self, boxes: np.ndarray) -> np.ndarray:
+        """ Translate (N, 4) boxes from the coordinates of this image to those of its root image """
+        offset_x, offset_y = self.offset
+        return np.asarray(boxes, dtype=np.float32).reshape(-1, 4) + np.array([offset_x, offset_y] * 2, np.float32)
+
+    def from_root(self, boxes: np.ndarray) -> np.ndarray:
+        """ Translate (N, 4) boxes from the coordinates of the root image to those of this image """
+        offset_x, offset_y = self.offset
+        return np.asarray(boxes, dtype=np.float32).reshape(-1, 4) - np.array([offset_x, offset_y] * 2, np.float32)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return np.array(self.array, dtype=dtype)
+
+
+class DeferredImage:
+    """ An image of the step details that is only drawn when the details are displayed, so that html adds no
+        pixel copies to a program run
+    """
+
+    def __init__(self, draw: Callable[[], Image.Image]):
+        self.draw = draw
+
+    @property
+    def pil(self) -> Image.Image:
+        return self.draw()
+
+
+def as_pil(image: Union[ImageBuffer, DeferredImage, Image.Image]) -> Image.Image:
+    return image.pil if isinstance(image, (ImageBuffer, DeferredImage)) else image
+
+
+def as_array(image: Union[ImageBuffer, Image.Image]) -> np.ndarray:
+    """ The (H, W, 3) uint8 pixels of the image, read-only and cached for buffers """
+    return image.array if isinstance(image, ImageBuffer) else np.asarray(image.convert('RGB'))
@@ -0,0 +1,73 @@
+import contextlib
+from dataclasses import dataclass
+from typing import ContextManager, Optional
+
+import torch
+
+
+@dataclass
+class InferencePolicy:
+    """ How the model-backed modules run their forward passes
+
+    Attributes
+    ----------
+    num_threads : Optional[int]
+        The number of intra-op threads torch uses, torch's default if None
+
+    num_interop_threads : Optional[int]
+        The number of inter-op threads torch uses, torch's default if None
+
+    bfloat16 : bool
+        Whether to autocast the forward passes to bfloat16
+
+    channels_last : bool
+        Whether to store the convolution weights of the models in channels_last memory format
+    """
+    num_threads: Optional[int] = None
+    num_interop_threads: Optional[int] = None
+    bfloat16: bool = False
+    channels_last: bool = False
+
+    presets = {
+        'default': dict(),
+        'bf16': dict(bfloat16=True, channels_last=True),
+    }
+
+    @classmethod
+    def from_name(cls, name: str, num_threads: Optional[int] = None) -> 'InferencePolicy':
+        return cls(num_threads=num_threads, **cls.presets[name])
+
+    def apply_threads(self):
+        if self.num_threads is not None and torch.get_num_threads() != self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        if self.num_interop_threads is not None and torch.get_num_interop_threads() != self.num_interop_threads:
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError:  # can only be set before any inter-op parallel work has started
+                pass
+
+    def prepare_model(self, model: torch.nn.Module) -> torch.nn.Module:
+        """ Put the model in eval mode and apply the memory format of the policy """
+        self.apply_threads()
+        model = model.eval()
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def inference(self, device: str = "cpu", mixed_precision: bool = True) -> ContextManager:
+        """ The context to run forward passes in
+
+        Parameters
+        ----------
+        device : str
+            The device the model runs on
+
+        mixed_precision : bool
+            Whether the caller can handle bfloat16 outputs, callers that convert outputs to numpy
+            outside of their control should pass False
+        """
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.bfloat16 and mixed_precision:
+            stack.enter_context(torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16))
+        return stack
@@ -1,5 +1,7 @@
 import re
-from typing import Any, Dict, Tuple
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 from PIL import Image, ImageDraw
@@ -7,6 +9,14 @@ import PIL
 import torch
 from transformers import OwlViTProcessor, OwlViTForObjectDetection
 
+from modules.caching import LRUCache
+from modules.image_buffer import DeferredImage, ImageBuffer, as_array, as_pil
+from modules.inference_policy import InferencePolicy
+from modules.model_loading import load_model, model_revision
+from modules.model_store import ModelStore, from_pretrained
+from modules.onnx_backend import example_image
+from modules.preprocessing import FastImagePreprocessor
+from modules.regions import Boxes
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
@@ -14,14 +24,57 @@ class Loc(VisProgModule):
     pattern = re.compile(r"(?P<output>\S*)\s*=\s*LOC\s*"
                          r"\(\s*image\s*=\s*(?P<image>\S*)\s*"
                          r",\s*object\s*=\s*'(?P<object>.*)'\s*\)")
+    # crops stay views, pixels are only converted for the processor that needs them
+    accepts_image_buffers = True
+    # tiled images are analysed on their downscaled proxy
+    runs_on_proxy = True
+
+    def __init__(self, device: str = "cpu", threshold: float = 0.1, policy: Optional[InferencePolicy] = None,
+                 quantize: bool = False, backend: str = "torch", compile: bool = False,
+                 store: Optional[ModelStore] = None, fast_preprocessing: bool = False, crop_reuse: bool = False,
+                 crop_max_rescale: float = 2.0, crop_min_visible: float = 0.5, feature_cache_size: int = 8):
+        """
+        Parameters
+        ----------
+        crop_reuse : bool
+            Whether to locate objects in crops made by the Crop modules from the cached patch features of the image
+            they were cropped from, instead of running the image encoder on the crop
 
-    def __init__(self, device: str = "cpu", threshold: float = 0.1):
+        crop_max_rescale : float
+            Crops that are more than this many times smaller than their parent along an axis, and so would be
+            upsampled that much more by a full inference, fall back to full inference
+
+        crop_min_visible : float
+            The fraction of a parent box that has to lie inside the crop for the box to be kept
+
+        feature_cache_size : int
+            The number of images whose patch features are kept for crop reuse
+        """
         super().__init__()
-        self.processor = OwlViTProcessor.from_pretrained("google/owlvit-base-patch32")
-        self.model = OwlViTForObjectDetection.from_pretrained("google/owlvit-base-patch32")
-        self.model = self.model.to(device)
+        if crop_reuse and backend != "torch":
+            raise ValueError("Crop reuse needs the patch features of the torch backend")
+        self.policy = policy or InferencePolicy()
+        self.processor = from_pretrained(OwlViTProcessor, "google/owlvit-base-patch32", store)
+        self.fast_image_processor = FastImagePreprocessor(self.processor.image_processor) if fast_preprocessing \
+            else None
+        self.model = load_model(OwlViTForObjectDetection, "google/owlvit-base-patch32", device=device, policy=self.policy,
+                                quantize=quantize, backend=backend, output_names=('logits', 'pred_boxes'),
+                                compile=compile, store=store, example_inputs=self.example_inputs)
         self.device = device
         self.threshold = threshold
+        self.quantize = quantize
+        self.backend = backend
+        self.crop_reuse = crop_reuse
+        self.crop_max_rescale = crop_max_rescale
+        self.crop_min_visible = crop_min_visible
+        self.image_features = LRUCache(feature_cache_size)
+        self.crop_stats = Counter()
+
+    def example_inputs(self) -> List[Dict[str, torch.Tensor]]:
+        """ Processor outputs with different image sizes and numbers of queries to export the model with """
+        return [self.processor(text=["a red car"], images=example_image(640, 480), return_tensors="pt"),
+                self.processor(text=["a dog", "the umbrella on the left"], images=example_image(360, 540, seed=1),
+                               return_tensors="pt")]
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -49,12 +102,12 @@ class Loc(VisProgModule):
                               'image': match.group('image')
                           })
 
-    def perform_module_function(self, image: Image.Image, object: str) -> Tuple[Tuple[float,...],...]:
+    def perform_module_function(self, image: Union[ImageBuffer, Image.Image], object: str) -> Boxes:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
+        image : Union[ImageBuffer, Image.Image]
             The original image
 
         object : str
@@ -62,18 +115,102 @@ class Loc(VisProgModule):
 
         Returns
         -------
-        Tuple[float,...]
-            The box of the object in the image (x1, y1, x2, y2)
+        Boxes
+            The boxes of the object in the image (x1, y1, x2, y2) and their scores
+        """
+        if self.crop_reuse:
+            return self.locate_reusing_parent(image, object)
+
+        if self.fast_image_processor is not None:
+            inputs = self.processor.tokenizer(text=[object], padding="max_length", return_tensors="pt")
+            inputs.update(self.fast_image_processor([as_array(image)]))
+            inputs = inputs.to(self.device)
+        else:
+            inputs = self.processor(text=[object], images=as_pil(image), return_tensors="pt").to(self.device)
+        with self.policy.inference(self.device):
+            outputs = self.model(**inputs)
+            target_sizes = torch.Tensor([image.size[::-1]])
+            results = self.processor.post_process_object_detection(outputs=outputs, target_sizes=target_sizes,
+                                                                   threshold=self.threshold)
+        return Boxes(results[0]['boxes'].detach().float().cpu().numpy(),
+                     results[0]['scores'].detach().float().cpu().numpy())
+
+    def locate_reusing_parent(self, image: Union[ImageBuffer, Image.Image], object: str) -> Boxes:
+        """ Locate the object in the parent of a crop and keep the boxes inside the crop, or in the image itself
+            if it is not a crop or is too small a part of its parent
+        """
+        if isinstance(image, ImageBuffer):
+            # the root shows the parts of a clipped crop of a crop that are black in the crop itself
+            parent, offset = (None, None) if image.clipped else (image.root, image.offset)
+        else:
+            parent, offset = getattr(image, "crop_parent", None), getattr(image, "crop_offset", None)
+        if parent is None or max(parent.width / image.width, parent.height / image.height) > self.crop_max_rescale:
+            self.crop_stats["full"] += 1
+            return self.locate_with_features(image, object)
+
+        self.crop_stats["reused"] += 1
+        boxes = self.locate_with_features(parent, object)
+        left, top = offset
+        clipped = boxes.translate(-left, -top).clip(image.size)
+        keep = clipped.area() >= self.crop_min_visible * np.maximum(boxes.area(), 1e-6)
+        return clipped[keep]
+
+    def locate_with_features(self, image: Union[ImageBuffer, Image.Image], object: str) -> Boxes:
+        """ Locate the object with the class and box heads of the model, reusing the patch features of the image
+            and the query independent box predictions if the image was seen recently
+
+        Returns
+        -------
+        Boxes
+            The boxes (x1, y1, x2, y2) in image coordinates and their scores
         """
-        inputs = self.processor(text=[object], images=image, return_tensors="pt").to(self.device)
-        outputs = self.model(**inputs)
-        target_sizes = torch.Tensor([image.size[::-1]])
-        results = self.processor.post_process_object_detection(outputs=outputs, target_sizes=target_sizes,
-                                                               threshold=self.threshold)
-        boxes = results[0]['boxes'].detach().cpu().numpy()
-        return tuple(tuple(box) for box in boxes)
-
-    def html(self, output: Tuple[Tuple[float,...],...], image: Image.Image, object: str) -> Dict[str, Any]:
+        entry = self.image_features.get(id(image))
+        with self.policy.inference(self.device):
+            if entry is None or entry[0] is not image:
+                if self.fast_image_processor is not None:
+                    pixel_values = self.fast_image_processor([as_array(image)])["pixel_values"]
+                else:
+                    pixel_values = self.processor.image_processor(as_pil(image), return_tensors="pt")["pixel_values"]
+                feature_map = self.model.image_embedder(pixel_values=pixel_values.to(self.device))[0]
+                batch_size, num_patches_height, num_patches_width, hidden_dim = feature_map.shape
+                image_feats = feature_map.reshape(batch_size, num_patches_height * num_patches_width, hidden_dim)
+                entry = (image, image_feats, self.model.box_predictor(image_feats, feature_map))
+                self.image_features.put(id(image), entry)
+            _, image_feats, pred_boxes = entry
+
+            text = self.processor.tokenizer(text=[object], padding="max_length", return_tensors="pt").to(self.device)
+            query_embeds = self.model.owlvit.get_text_features(**text)[:, None]
+            query_mask = text["input_ids"][None, :, 0] > 0
+            logits = self.model.class_predictor(image_feats, query_embeds, query_mask)[0]
+            results = self.processor.post_process_object_detection(
+                outputs=SimpleNamespace(logits=logits, pred_boxes=pred_boxes),
+                target_sizes=torch.Tensor([image.size[::-1]]), threshold=self.threshold)
+        return Boxes(results[0]["boxes"].detach().float().cpu().numpy(),
+                     results[0]["scores"].detach().float().cpu().numpy())
+
+    def cache_identity(self) -> Optional[tuple]:
+        return ("google/owlvit-base-patch32", model_revision(self.model), self.threshold, self.quantize, self.backend,
+                self.policy.bfloat16, self.fast_image_processor is not None, self.crop_reuse, self.crop_max_rescale,
+                self.crop_min_visible)
+
+    def rescale_output(self, output: Boxes, from_size: Tuple[int, int], to_size: Tuple[int, int]) -> Boxes:
+        return Boxes.from_any(output).scale(to_size[0] / from_size[0], to_size[1] / from_size[1])
+
+    def outputs_agree(self, output: Boxes, exact_output: Boxes, iou_threshold: float = 0.5) -> bool:
+        """ Whether both outputs have the same number of boxes and each reused box overlaps a distinct exact box """
+        if len(output) != len(exact_output):
+            return False
+        ious = Boxes.from_any(output).iou(exact_output)
+        unmatched = np.ones(len(exact_output), dtype=bool)
+        for box_ious in ious:
+            box_ious = np.where(unmatched, box_ious, -1.)
+            best = int(np.argmax(box_ious))
+            if box_ious[best] < iou_threshold:
+                return False
+            unmatched[best] = False
+        return True
+
+    def html(self, output: Boxes, image: Union[ImageBuffer, Image.Image], object: str) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
@@ -81,7 +218,7 @@ class Loc(VisProgModule):
         inputs : Dict[str, Any]
             The input variables and their values
 
-        output : Tuple[Tuple[float,...],...]
+        output : Boxes
             The output boxes
 
         Returns
@@ -89,13 +226,15 @@ class Loc(VisProgModule):
         Dict[str, Any]
             The HTML to display
         """
-        bbox_drawn_image = image.copy()
-        draw = ImageDraw.Draw(bbox_drawn_image)
-        for box in output:
-            draw.rectangle(box, outline="red", width=3)
+        def draw_boxes() -> Image.Image:
+            bbox_drawn_image = as_pil(image).copy()
+            draw = ImageDraw.Draw(bbox_drawn_image)
+            for box in output:
+                draw.rectangle(box, outline="red", width=3)
+            return bbox_drawn_image
 
         return {
             'prompt': object,
             'image': image,
-            'image_with_bbox': bbox_drawn_image,
+            'image_with_bbox': DeferredImage(draw_boxes),
         }
@@ -0,0 +1,99 @@
+from typing import Callable, Dict, Optional, Sequence, Type
+
+import torch
+from transformers import AutoConfig, PreTrainedModel
+
+from modules.compilation import compile_model
+from modules.inference_policy import InferencePolicy
+from modules.model_store import ModelStore, directory_revision, from_pretrained, load_pretrained_model
+from modules.onnx_backend import OnnxModel
+from modules.quantization import load_quantized
+
+BACKENDS = ('torch', 'onnx')
+
+
+def model_revision(model: Callable) -> Optional[str]:
+    """ The hub commit the model weights were loaded from, or for models loaded from a local directory such as a
+        model store, a digest of the directory's weight files. None if neither is known
+    """
+    revision = getattr(model.config, '_commit_hash', None)
+    if revision is None:
+        revision = directory_revision(getattr(model.config, '_name_or_path', ''))
+    return revision
+
+
+def load_model(model_class: Type[PreTrainedModel], model_name: str, device: str = "cpu",
+               policy: Optional[InferencePolicy] = None, quantize: bool = False, backend: str = 'torch',
+               output_names: Sequence[str] = ('logits',), compile: bool = False,
+               dynamic: Optional[bool] = None, store: Optional[ModelStore] = None,
+               example_inputs: Optional[Callable[[], Sequence[Dict[str, torch.Tensor]]]] = None) -> Callable:
+    """ Load the model of a module for the requested execution backend
+
+    Parameters
+    ----------
+    model_class : Type[PreTrainedModel]
+        The transformers class of the model
+
+    model_name : str
+        The name of the pretrained model
+
+    device : str
+        The device to run the model on
+
+    policy : Optional[InferencePolicy]
+        The inference policy, the default policy if None
+
+    quantize : bool
+        Whether to dynamically quantize the linear layers to INT8, torch backend on cpu without bfloat16 only
+
+    backend : str
+        'torch' to run the transformers model, 'onnx' to run an exported graph with onnxruntime on cpu
+
+    output_names : Sequence[str]
+        The model outputs the module uses, only needed by the onnx backend
+
+    compile : bool
+        Whether to wrap the model in torch.compile, torch backend only
+
+    dynamic : Optional[bool]
+        Passed to torch.compile, modules whose input shapes cannot be bucketed should pass True
+
+    store : Optional[ModelStore]
+        The local model store to load the weights from, the hub if None
+
+    example_inputs : Optional[Callable[[], Sequence[Dict[str, torch.Tensor]]]]
+        Makes processor outputs of at least two different shapes, the onnx backend exports the model on the first
+        and checks the graph against torch on the others. Only needed by the onnx backend
+
+    Returns
+    -------
+    Callable
+        The model, called with the processor outputs as keyword arguments
+    """
+    policy = policy or InferencePolicy()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if (quantize or backend == 'onnx') and device != "cpu":
+        raise ValueError(f"Quantized and onnx models only run on cpu, got device {device}")
+    if (quantize or compile) and backend != 'torch':
+        raise ValueError("Quantization and compilation are only supported by the torch backend")
+    if quantize and policy.bfloat16:
+        raise ValueError("Quantized linear layers only take float32 inputs, they do not support bfloat16 policies")
+    if backend == 'onnx' and policy.bfloat16:
+        raise ValueError("The onnx backend exports and runs models in float32, it does not support bfloat16 policies")
+    if backend == 'onnx' and example_inputs is None:
+        raise ValueError("The onnx backend needs example inputs to export the model")
+
+    if backend == 'onnx':
+        return OnnxModel(lambda: load_pretrained_model(model_class, model_name, store), model_name,
+                         from_pretrained(AutoConfig, model_name, store), output_names, example_inputs,
+                         num_threads=policy.num_threads, num_interop_threads=policy.num_interop_threads)
+
+    if quantize:
+        model = load_quantized(model_class, model_name, store=store)
+    else:
+        model = load_pretrained_model(model_class, model_name, store)
+    model = policy.prepare_model(model.to(device))
+    if compile:
+        model = compile_model(model, dynamic=dynamic)
+    return model
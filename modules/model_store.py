@@ -0,0 +1,199 @@
+import hashlib
+import os
+import re
+import sys
+from typing import Any, Dict, List, Optional, Type
+
+import torch
+
+from modules.caching import atomic_save, default_cache_dir
+
+WEIGHT_EXTENSIONS = ('.safetensors', '.bin')
+
+
+class ModelStore:
+    """ A local directory of pretrained models stored as safetensors.
+
+    Loading from the store never touches the network, and safetensors files are memory-mapped,
+    so processes loading the same model share the page cache.
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or default_cache_dir('models')
+
+    def model_path(self, model_name: str) -> str:
+        return os.path.join(self.root, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+
+    def __contains__(self, model_name: str) -> bool:
+        return os.path.isdir(self.model_path(model_name))
+
+    def add(self, model_name: str, variant: Optional[str] = None) -> str:
+        """ Download the configuration, vocabulary and weights of a model into the store
+
+        Parameters
+        ----------
+        model_name : str
+            The hub repository of the model
+
+        variant : Optional[str]
+            The weights variant to store, such as 'fp16', the main weights if None or where a folder has no weights
+            of the variant. Only one variant is stored, see select_weight_files
+        """
+        from huggingface_hub import HfApi, snapshot_download
+
+        weight_files = select_weight_files(HfApi().list_repo_files(model_name), variant)
+        return snapshot_download(model_name, local_dir=self.model_path(model_name),
+                                 allow_patterns=['*.json', '*.txt', '*.model', *weight_files])
+
+    def weight_files(self, model_name: str) -> List[str]:
+        """ The weight files of a model in the store, relative to its directory """
+        model_path = self.model_path(model_name)
+        return sorted(os.path.relpath(os.path.join(directory, name), model_path)
+                      for directory, _, names in os.walk(model_path) for name in names
+                      if name.endswith(WEIGHT_EXTENSIONS))
+
+    def variant(self, model_name: str) -> Optional[str]:
+        """ The weights variant the model was stored with, None for the main weights """
+        variants = {weight_variant(path) for path in self.weight_files(model_name)} - {None}
+        return min(variants) if variants else None
+
+    def from_pretrained(self, cls: Type, model_name: str, **kwargs: Any) -> Any:
+        """ Load a processor, configuration or model class from the store """
+        if model_name not in self:
+            raise FileNotFoundError(f"{model_name} is not in the model store {self.root}, "
+                                    f"add it with: python model_store.py add {model_name}")
+        return cls.from_pretrained(self.model_path(model_name), local_files_only=True, **kwargs)
+
+    def load_model(self, cls: Type, model_name: str, **kwargs: Any) -> Any:
+        """ Load model weights without initializing them first, from memory-mapped safetensors unless the model
+            was stored with pytorch .bin weights because it has no safetensors
+        """
+        defaults: Dict[str, Any] = {'low_cpu_mem_usage': True}
+        if not any(path.endswith('.bin') for path in self.weight_files(model_name)):
+            defaults['use_safetensors'] = True
+        variant = self.variant(model_name)
+        if variant is not None:
+            defaults['variant'] = variant
+        return self.from_pretrained(cls, model_name, **{**defaults, **kwargs})
+
+
+def weight_variant(path: str) -> Optional[str]:
+    """ The variant of a weight file: 'fp16' for model.fp16.safetensors or model.fp16-00001-of-00002.safetensors,
+        None for model.safetensors or pytorch_model.bin
+    """
+    match = re.fullmatch(r'[^.]+\.([^.-]+)(-\d+-of-\d+)?\.(safetensors|bin)', os.path.basename(path))
+    return match.group(1) if match is not None else None
+
+
+def select_weight_files(paths: List[str], variant: Optional[str] = None) -> List[str]:
+    """ Choose the weight files to store out of the files of a hub repository, folder by folder for the components
+        of a diffusers pipeline
+
+    A folder's safetensors are preferred to its pytorch .bin files, which are only stored if there are none. Of
+    each format, the files of the requested variant are chosen, or the main weights if there are none of the
+    variant, so that a single dtype is downloaded rather than, for example, both the float32 and float16 weights.
+    """
+    folders: Dict[str, List[str]] = {}
+    for path in paths:
+        if path.endswith(WEIGHT_EXTENSIONS):
+            folders.setdefault(os.path.dirname(path), []).append(path)
+    selected = []
+    for folder_paths in folders.values():
+        for extension in WEIGHT_EXTENSIONS:
+            candidates = [path for path in folder_paths if path.endswith(extension)]
+            chosen = [path for path in candidates if variant is not None and weight_variant(path) == variant]
+            chosen = chosen or [path for path in candidates if weight_variant(path) is None]
+            if chosen:
+                selected.extend(chosen)
+                break
+    return sorted(selected)
+
+
+def from_pretrained(cls: Type, model_name: str, store: Optional[ModelStore] = None, **kwargs: Any) -> Any:
+    """ Load a pretrained processor or configuration from the store if given, otherwise from the hub """
+    if store is None:
+        return cls.from_pretrained(model_name, **kwargs)
+    return store.from_pretrained(cls, model_name, **kwargs)
+
+
+def load_pretrained_model(cls: Type, model_name: str, store: Optional[ModelStore] = None, **kwargs: Any) -> Any:
+    """ Load pretrained model weights from the store if given, otherwise from the hub """
+    if store is None:
+        return cls.from_pretrained(model_name, **kwargs)
+    return store.load_model(cls, model_name, **kwargs)
+
+
+def directory_revision(path: str) -> Optional[str]:
+    """ Identify the weights of a model loaded from a local directory, which has no hub commit hash, by its
+        safetensors index and the names, sizes and modification times of its weight and configuration files
+
+    Returns
+    -------
+    Optional[str]
+        The hex digest, or None if path is not a directory
+    """
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(('.safetensors', '.json', '.bin')):
+            continue
+        file_path = os.path.join(path, name)
+        stat = os.stat(file_path)
+        digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        if name.endswith('.safetensors.index.json'):
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def library_versions() -> Dict[str, str]:
+    """ The versions of the libraries whose classes a snapshot pickles """
+    import transformers
+
+    return dict(python=sys.version.split()[0], torch=torch.__version__, transformers=transformers.__version__)
+
+
+def save_snapshot(modules: List[Any], path: str, build_args: Dict[str, Any]):
+    """ Save fully initialized modules so that they can be reloaded without running their constructors
+
+    Parameters
+    ----------
+    modules : List[Any]
+        The modules
+
+    path : str
+        The snapshot file
+
+    build_args : Dict[str, Any]
+        The arguments the modules were built with, a snapshot is only loaded for the same arguments
+    """
+    snapshot = dict(build_args=build_args, versions=library_versions(), modules=modules)
+    atomic_save(lambda temporary_path: torch.save(snapshot, temporary_path), path)
+
+
+def load_snapshot(path: str, build_args: Dict[str, Any]) -> Optional[List[Any]]:
+    """ Load modules saved with save_snapshot, memory-mapping their tensors instead of reading them
+
+    Constructors are not run for loaded modules, so the thread settings of their inference policies are applied here.
+
+    Returns
+    -------
+    Optional[List[Any]]
+        The modules, or None if the snapshot was built with other arguments or library versions and has to be rebuilt
+    """
+    snapshot = torch.load(path, mmap=True, weights_only=False)
+    if not isinstance(snapshot, dict):
+        print(f'{path} is a snapshot of an older format')
+        return None
+    for kind, expected in (('build_args', build_args), ('versions', library_versions())):
+        if snapshot[kind] != expected:
+            changed = sorted(key for key in set(snapshot[kind]) | set(expected)
+                             if snapshot[kind].get(key) != expected.get(key))
+            print(f'{path} was built with different {", ".join(changed)}')
+            return None
+    for module in snapshot['modules']:
+        policy = getattr(module, 'policy', None)
+        if policy is not None:
+            policy.apply_threads()
+    return snapshot['modules']
@@ -0,0 +1,101 @@
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """ The difference hash of the image, robust to re-encoding and resizing """
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).tobytes().hex(), 16)
+
+
+class NearDuplicateCache:
+    """ Reuses module outputs for the same query on perceptually near-identical images.
+
+    Images are indexed by their difference hash. A lookup reuses the output of a previous image with the same
+    query whose hash is within max_distance bits, after mapping it to the new image size. Every verify_every-th
+    reuse also runs the exact computation and records whether both outputs agree.
+    """
+
+    def __init__(self, max_distance: int = 4, verify_every: Optional[int] = None, max_entries_per_query: int = 1024):
+        self.max_distance = max_distance
+        self.verify_every = verify_every
+        self.max_entries_per_query = max_entries_per_query
+        self.entries: Dict[Hashable, List[Tuple[int, Tuple[int, int], Any]]] = defaultdict(list)
+        self.stats = Counter()
+
+    def lookup(self, image_hash: int, query: Hashable) -> Optional[Tuple[Tuple[int, int], Any]]:
+        best = None
+        best_distance = self.max_distance + 1
+        for entry_hash, size, output in self.entries[query]:
+            distance = bin(entry_hash ^ image_hash).count('1')
+            if distance < best_distance:
+                best, best_distance = (size, output), distance
+        return best
+
+    def add(self, image_hash: int, size: Tuple[int, int], query: Hashable, output: Any):
+        entries = self.entries[query]
+        entries.append((image_hash, size, output))
+        if len(entries) > self.max_entries_per_query:
+            entries.pop(0)
+
+    def reuse(self, image: Image.Image, query: Hashable, compute: Callable[[], Any],
+              transform: Optional[Callable[[Any, Tuple[int, int], Tuple[int, int]], Any]] = None,
+              agree: Callable[[Any, Any], bool] = lambda a, b: a == b) -> Any:
+        """ Return the output of a near-duplicate image for the query, or compute it
+
+        Parameters
+        ----------
+        image : Image.Image
+            The input image
+
+        query : Hashable
+            The non-image inputs of the module
+
+        compute : Callable[[], Any]
+            Computes the exact output for the image
+
+        transform : Optional[Callable[[Any, Tuple[int, int], Tuple[int, int]], Any]]
+            Maps an output from the size of the image it was computed on to the size of the input image
+
+        agree : Callable[[Any, Any], bool]
+            Whether a reused output agrees with the exact one, used for verification
+
+        Returns
+        -------
+        Any
+            The output
+        """
+        self.stats['lookups'] += 1
+        image_hash = dhash(image)
+        match = self.lookup(image_hash, query)
+        if match is None:
+            output = compute()
+            self.add(image_hash, image.size, query, output)
+            return output
+
+        size, output = match
+        if transform is not None and size != image.size:
+            output = transform(output, size, image.size)
+        self.stats['reuses'] += 1
+        if self.verify_every is not None and self.stats['reuses'] % self.verify_every == 0:
+            self.stats['verified'] += 1
+            self.stats['agreements'] += int(agree(output, compute()))
+        return output
+
+    def attach(self, modules: list):
+        """ Make the modules reuse their outputs across near-duplicate images """
+        for module in modules:
+            module.near_duplicates = self
+
+    def report(self) -> Dict[str, float]:
+        """ The reuse rate over all lookups and the agreement rate of the verified reuses """
+        return dict(
+            lookups=self.stats['lookups'],
+            reuse_rate=self.stats['reuses'] / self.stats['lookups'] if self.stats['lookups'] else 0.,
+            verified=self.stats['verified'],
+            agreement_rate=self.stats['agreements'] / self.stats['verified'] if self.stats['verified'] else 1.,
+        )
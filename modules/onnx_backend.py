@@ -0,0 +1,127 @@
+import contextlib
+import os
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from PIL import Image
+import torch
+from transformers import PretrainedConfig
+
+from modules.caching import atomic_save, versioned_cache_path
+
+
+def example_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    """ A noise image to export and check models with, noise keeps the activations away from degenerate values """
+    return Image.fromarray(np.random.RandomState(seed).randint(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+class ExportWrapper(torch.nn.Module):
+    """ Adapts a transformers model to the positional inputs and tuple outputs torch.onnx.export expects """
+
+    def __init__(self, model: torch.nn.Module, input_names: Sequence[str], output_names: Sequence[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = list(input_names)
+        self.output_names = list(output_names)
+
+    def forward(self, *args: torch.Tensor):
+        outputs = self.model(**dict(zip(self.input_names, args)), return_dict=True)
+        return tuple(outputs[name] for name in self.output_names)
+
+
+class OnnxModel:
+    """ Runs a transformers model with onnxruntime on CPU.
+
+    Unless a graph is cached on disk, the model is exported when the object is created: it is traced in float32,
+    outside of any inference mode or autocast context, on the first of the example inputs. Tracing fixes the
+    shape dependent Python branches of a model to the traced shapes, so the graph is checked against torch on the
+    other example inputs, which should have different shapes, and is only cached if it matches. Later processes
+    never load the torch model. Calling the object returns a namespace with the requested outputs as tensors, so
+    the processors' post-processing works unchanged.
+    """
+
+    def __init__(self, model_loader: Callable[[], torch.nn.Module], model_name: str, config: PretrainedConfig,
+                 output_names: Sequence[str], example_inputs: Callable[[], Sequence[Dict[str, torch.Tensor]]],
+                 num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None,
+                 cache_dir: Optional[str] = None, tolerance: float = 1e-3):
+        self.model_name = model_name
+        self.output_names = list(output_names)
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.tolerance = tolerance
+        self.path = versioned_cache_path('onnx', model_name, 'onnx', cache_dir)
+        self.config = config
+        if not os.path.exists(self.path):
+            self.export(model_loader, example_inputs())
+        self.session = self.create_session(self.path)
+
+    def create_session(self, path: str):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if self.num_threads is not None:
+            options.intra_op_num_threads = self.num_threads
+        if self.num_interop_threads is not None:
+            options.inter_op_num_threads = self.num_interop_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def export(self, model_loader: Callable[[], torch.nn.Module], example_inputs: Sequence[Dict[str, torch.Tensor]]):
+        """ Trace the model on the first example inputs and check the graph on the others before caching it """
+        if len(example_inputs) < 2:
+            raise ValueError("Exporting needs example inputs of at least two different shapes")
+        trace_inputs, *check_inputs = [{name: torch.as_tensor(tensor).cpu() for name, tensor in inputs.items()}
+                                       for inputs in example_inputs]
+        model = model_loader().float().eval()
+        input_names = list(trace_inputs)
+        dynamic_axes = {name: {axis: f'{name}_{axis}' for axis in range(tensor.dim())}
+                        for name, tensor in trace_inputs.items()}
+
+        def save(temporary_path: str):
+            with self.export_context():
+                torch.onnx.export(ExportWrapper(model, input_names, self.output_names),
+                                  tuple(trace_inputs.values()), temporary_path, input_names=input_names,
+                                  output_names=self.output_names, dynamic_axes=dynamic_axes, opset_version=17)
+            try:
+                self.check(model, self.create_session(temporary_path), check_inputs)
+            except Exception:
+                os.remove(temporary_path)
+                raise
+
+        atomic_save(save, self.path)
+
+    @staticmethod
+    def export_context() -> contextlib.ExitStack:
+        """ Plain float32 autograd-free execution, whatever context the caller runs in """
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode(False))
+        stack.enter_context(torch.no_grad())
+        stack.enter_context(torch.autocast(device_type='cpu', enabled=False))
+        return stack
+
+    def check(self, model: torch.nn.Module, session, inputs_list: List[Dict[str, torch.Tensor]]):
+        """ Raise a RuntimeError if the graph's outputs differ from the model's on any of the inputs """
+        for inputs in inputs_list:
+            with self.export_context():
+                expected = model(**inputs, return_dict=True)
+            actual = self.run(session, inputs)
+            shapes = {name: tuple(tensor.shape) for name, tensor in inputs.items()}
+            for name, output in zip(self.output_names, actual):
+                expected_output = expected[name].float().numpy()
+                if output.shape != expected_output.shape:
+                    raise RuntimeError(f"The onnx graph of {self.model_name} is fixed to the traced shapes: output "
+                                       f"{name} has shape {output.shape} instead of {expected_output.shape} "
+                                       f"for inputs of shapes {shapes}")
+                if not np.allclose(output, expected_output, rtol=self.tolerance, atol=self.tolerance):
+                    raise RuntimeError(f"The onnx graph of {self.model_name} does not match torch for inputs of "
+                                       f"shapes {shapes}: output {name} differs by up to "
+                                       f"{np.abs(output - expected_output).max():.3g}")
+
+    def run(self, session, inputs: Dict[str, torch.Tensor]) -> List[np.ndarray]:
+        feed = {node.name: inputs[node.name].cpu().numpy() for node in session.get_inputs()}
+        return session.run(self.output_names, feed)
+
+    def __call__(self, **inputs: torch.Tensor) -> SimpleNamespace:
+        outputs = self.run(self.session, inputs)
+        return SimpleNamespace(**{name: torch.from_numpy(output) for name, output in zip(self.output_names, outputs)})
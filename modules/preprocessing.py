@@ -0,0 +1,113 @@
+from collections import defaultdict
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers import BatchFeature
+
+
+class FastImagePreprocessor:
+    """ Vectorized torch version of the CLIP, OwlViT and ViLT image processors.
+
+    Images of the same size are resized, cropped, rescaled and normalized as one batch tensor instead of one PIL
+    image at a time. Resizing is bicubic with antialiasing and rounded to uint8 values like PIL, so the outputs
+    match the Hugging Face processors within a small tolerance (see tests/test_preprocessing_parity.py).
+    """
+
+    def __init__(self, image_processor: Any):
+        self.image_mean = torch.tensor(image_processor.image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.image_std = torch.tensor(image_processor.image_std, dtype=torch.float32).view(1, 3, 1, 1)
+        self.rescale_factor = image_processor.rescale_factor
+        self.size = dict(image_processor.size)
+        self.crop_size = dict(image_processor.crop_size) if getattr(image_processor, 'do_center_crop', False) \
+            else None
+        # ViLT limits the longer edge, rounds the size down to size_divisor and pads batches with a pixel mask
+        self.is_vilt = type(image_processor).__name__.startswith('Vilt')
+        self.size_divisor = getattr(image_processor, 'size_divisor', 32)
+
+    def get_output_size(self, height: int, width: int, shortest_edge: Optional[int] = None) -> Tuple[int, int]:
+        """ The size (height, width) an image is resized to, mirroring the processors' resize rules """
+        if 'height' in self.size and shortest_edge is None:
+            return self.size['height'], self.size['width']
+
+        shortest_edge = shortest_edge or self.size['shortest_edge']
+        if not self.is_vilt:
+            short, long = (width, height) if width <= height else (height, width)
+            new_short, new_long = shortest_edge, int(shortest_edge * long / short)
+            return (new_long, new_short) if width <= height else (new_short, new_long)
+
+        longest_edge = int(1333 / 800 * shortest_edge)
+        scale = shortest_edge / min(height, width)
+        if height < width:
+            new_height, new_width = shortest_edge, scale * width
+        else:
+            new_height, new_width = scale * height, shortest_edge
+        if max(new_height, new_width) > longest_edge:
+            scale = longest_edge / max(new_height, new_width)
+            new_height, new_width = scale * new_height, scale * new_width
+        new_height, new_width = int(new_height + 0.5), int(new_width + 0.5)
+        return new_height // self.size_divisor * self.size_divisor, new_width // self.size_divisor * self.size_divisor
+
+    def center_crop(self, pixels: torch.Tensor) -> torch.Tensor:
+        if self.crop_size is None:
+            return pixels
+        height, width = pixels.shape[-2:]
+        crop_height, crop_width = self.crop_size['height'], self.crop_size['width']
+        top, left = max((height - crop_height) // 2, 0), max((width - crop_width) // 2, 0)
+        return pixels[..., top:top + crop_height, left:left + crop_width]
+
+    def preprocess_batch(self, images: np.ndarray, shortest_edge: Optional[int] = None) -> torch.Tensor:
+        """ Preprocess a (N, H, W, 3) uint8 batch of equally sized images into (N, 3, H', W') model inputs """
+        pixels = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2).float()
+        output_size = self.get_output_size(*images.shape[1:3], shortest_edge=shortest_edge)
+        if output_size != tuple(images.shape[1:3]):
+            pixels = F.interpolate(pixels, size=output_size, mode='bicubic', align_corners=False, antialias=True)
+            pixels = pixels.round_().clamp_(0, 255)
+        pixels = self.center_crop(pixels)
+        pixels = pixels * self.rescale_factor
+        return (pixels - self.image_mean) / self.image_std
+
+    def __call__(self, images: Union[np.ndarray, Sequence[Union[np.ndarray, Image.Image]]],
+                 shortest_edge: Optional[int] = None) -> BatchFeature:
+        """ Preprocess images into pixel_values, plus pixel_mask for ViLT
+
+        Parameters
+        ----------
+        images : Union[np.ndarray, Sequence[Union[np.ndarray, Image.Image]]]
+            A (N, H, W, 3) uint8 batch, or a sequence of RGB images of any sizes
+
+        shortest_edge : Optional[int]
+            Overrides the shortest edge the images are resized to
+
+        Returns
+        -------
+        BatchFeature
+            The model inputs
+        """
+        if isinstance(images, np.ndarray) and images.ndim == 4:
+            outputs = list(self.preprocess_batch(images, shortest_edge))
+        else:
+            arrays = [np.asarray(image) for image in images]
+            groups = defaultdict(list)
+            for i, array in enumerate(arrays):
+                groups[array.shape].append(i)
+            outputs: List[Optional[torch.Tensor]] = [None] * len(arrays)
+            for indices in groups.values():
+                batch = self.preprocess_batch(np.stack([arrays[i] for i in indices]), shortest_edge)
+                for i, pixels in zip(indices, batch):
+                    outputs[i] = pixels
+
+        if not self.is_vilt:
+            return BatchFeature({'pixel_values': torch.stack(outputs)})
+
+        max_height = max(pixels.shape[-2] for pixels in outputs)
+        max_width = max(pixels.shape[-1] for pixels in outputs)
+        pixel_values = torch.zeros(len(outputs), 3, max_height, max_width)
+        pixel_mask = torch.zeros(len(outputs), max_height, max_width, dtype=torch.long)
+        for i, pixels in enumerate(outputs):
+            height, width = pixels.shape[-2:]
+            pixel_values[i, :, :height, :width] = pixels
+            pixel_mask[i, :height, :width] = 1
+        return BatchFeature({'pixel_values': pixel_values, 'pixel_mask': pixel_mask})
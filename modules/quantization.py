@@ -0,0 +1,44 @@
+import os
+from typing import Optional, Type
+
+import torch
+from transformers import PreTrainedModel
+
+from modules.caching import atomic_save, versioned_cache_path
+from modules.model_store import ModelStore, load_pretrained_model
+
+
+def load_quantized(model_class: Type[PreTrainedModel], model_name: str,
+                   cache_dir: Optional[str] = None, store: Optional[ModelStore] = None) -> torch.nn.Module:
+    """ Load a model with its linear layers dynamically quantized to INT8.
+
+    The quantized model is saved to disk on first use, so the float weights are only loaded
+    and converted once.
+
+    Parameters
+    ----------
+    model_class : Type[PreTrainedModel]
+        The transformers class of the model
+
+    model_name : str
+        The name of the pretrained model
+
+    cache_dir : Optional[str]
+        Where to cache the quantized model, defaults to <VISPROG_CACHE_DIR>/quantized
+
+    store : Optional[ModelStore]
+        The model store to load the float weights from, the hub if None
+
+    Returns
+    -------
+    torch.nn.Module
+        The quantized model, for CPU inference only
+    """
+    path = versioned_cache_path('quantized', model_name, 'pt', cache_dir)
+    if os.path.exists(path):
+        return torch.load(path, weights_only=False)
+
+    model = load_pretrained_model(model_class, model_name, store).eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    atomic_save(lambda temporary_path: torch.save(model, temporary_path), path)
+    return model
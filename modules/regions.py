@@ -0,0 +1,345 @@
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+class Boxes:
+    """ N boxes (x1, y1, x2, y2) as one (N, 4) float32 array with optional (N,) detection scores.
+
+    Boxes behave like the tuple of box tuples modules used to pass around: len, indexing with an int and iteration
+    give (x1, y1, x2, y2) tuples of floats. Indexing with a slice or an index array gives Boxes.
+    """
+
+    def __init__(self, boxes: Union[np.ndarray, Sequence[Sequence[float]]] = (),
+                 scores: Optional[Union[np.ndarray, Sequence[float]]] = None):
+        self.array = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.scores = None if scores is None else np.asarray(scores, dtype=np.float32).reshape(-1)
+
+    @classmethod
+    def from_any(cls, boxes: Union['Boxes', np.ndarray, Sequence[Sequence[float]]]) -> 'Boxes':
+        return boxes if isinstance(boxes, Boxes) else cls(boxes)
+
+    def __len__(self) -> int:
+        return len(self.array)
+
+    def __iter__(self) -> Iterator[Tuple[float, ...]]:
+        return (tuple(box) for box in self.array.tolist())
+
+    def __getitem__(self, index: Union[int, slice, Sequence[int], np.ndarray]) -> Union[Tuple[float, ...], 'Boxes']:
+        if isinstance(index, (int, np.integer)):
+            return tuple(self.array[index].tolist())
+        return Boxes(self.array[index], None if self.scores is None else self.scores[index])
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, (Boxes, tuple, list, np.ndarray)):
+            return NotImplemented
+        return np.array_equal(self.array, Boxes.from_any(other).array)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'Boxes({self.array.tolist()})'
+
+    @property
+    def widths(self) -> np.ndarray:
+        return self.array[:, 2] - self.array[:, 0]
+
+    @property
+    def heights(self) -> np.ndarray:
+        return self.array[:, 3] - self.array[:, 1]
+
+    def area(self) -> np.ndarray:
+        return np.clip(self.widths, 0, None) * np.clip(self.heights, 0, None)
+
+    def iou(self, other: 'Boxes') -> np.ndarray:
+        """ The (N, M) intersection over union of these N boxes and the M other boxes """
+        other = Boxes.from_any(other)
+        top_left = np.maximum(self.array[:, None, :2], other.array[None, :, :2])
+        bottom_right = np.minimum(self.array[:, None, 2:], other.array[None, :, 2:])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+        union = self.area()[:, None] + other.area()[None, :] - intersection
+        return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+    def translate(self, dx: float, dy: float) -> 'Boxes':
+        return Boxes(self.array + np.array([dx, dy, dx, dy], dtype=np.float32), self.scores)
+
+    def scale(self, scale_x: float, scale_y: float) -> 'Boxes':
+        return Boxes(self.array * np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32), self.scores)
+
+    def clip(self, size: Tuple[int, int]) -> 'Boxes':
+        """ Clip the boxes to an image of size (width, height) """
+        width, height = size
+        return Boxes(np.clip(self.array, 0, np.array([width, height, width, height], dtype=np.float32)), self.scores)
+
+    def rasterize(self, size: Tuple[int, int], labels: bool = False) -> 'Mask':
+        """ Paint the boxes, truncated to whole pixels, into an image of size (width, height)
+
+        Parameters
+        ----------
+        size : Tuple[int, int]
+            The (width, height) of the image
+
+        labels : bool
+            Whether to return a uint8 label map in which box i has label i + 1 and later boxes cover earlier ones,
+            instead of a boolean mask of the union of the boxes
+
+        Returns
+        -------
+        Mask
+            The (height, width) mask or label map
+        """
+        width, height = size
+        pixels = np.clip(self.array.astype(np.int64), 0, np.array([width, height, width, height])).tolist()
+        # one (H, W) output painted box by box, an (N, H, W) broadcast would need N times the memory
+        output = np.zeros((height, width), dtype=np.uint8 if labels else bool)
+        for label, (x1, y1, x2, y2) in enumerate(pixels, start=1):
+            output[y1:y2, x1:x2] = label if labels else True
+        return Mask(output)
+
+    def to_tuple(self) -> Tuple[Tuple[float, ...], ...]:
+        return tuple(self)
+
+
+class Mask(np.ndarray):
+    """ A (H, W) boolean mask or integer label map, a numpy array with vectorized region operations """
+
+    def __new__(cls, array: np.ndarray) -> 'Mask':
+        return np.asarray(array).view(cls)
+
+    @property
+    def is_label_map(self) -> bool:
+        return self.dtype != bool
+
+    def bbox(self) -> Optional[Tuple[int, int, int, int]]:
+        """ The bounding box (x1, y1, x2, y2) of the nonzero pixels, or None if there are none """
+        return mask_box(np.asarray(self))
+
+    def area(self) -> int:
+        return int(np.count_nonzero(np.asarray(self)))
+
+    def iou(self, other: np.ndarray) -> float:
+        mask, other = np.asarray(self) != 0, np.asarray(other) != 0
+        union = np.count_nonzero(mask | other)
+        return np.count_nonzero(mask & other) / union if union else 0.
+
+    def select(self, labels: Sequence[int]) -> 'Mask':
+        """ The boolean mask of the pixels whose label is one of labels """
+        return Mask(np.isin(np.asarray(self), labels))
+
+    def translate(self, dx: int, dy: int) -> 'Mask':
+        """ Move the mask by whole pixels, the uncovered border is zero """
+        height, width = self.shape
+        output = np.zeros_like(np.asarray(self))
+        output[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = \
+            np.asarray(self)[max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)]
+        return Mask(output)
+
+
+class PackedMask:
+    """ A (H, W) boolean mask packed to one bit per pixel, row by row.
+
+    Union, intersection, inversion, area and IoU work on the packed bytes. The dense mask is only decoded when a
+    consumer asks for it, through to_mask, np.asarray or as_mask. The padding bits of the last byte are always zero.
+    """
+    popcount = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+    def __init__(self, bits: np.ndarray, shape: Tuple[int, int]):
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_mask(cls, mask: Union['PackedMask', np.ndarray]) -> 'PackedMask':
+        if isinstance(mask, PackedMask):
+            return mask
+        mask = np.asarray(mask)
+        return cls(np.packbits(mask.astype(bool, copy=False).ravel()), mask.shape)
+
+    @classmethod
+    def from_rle(cls, rle: Dict[str, Any]) -> 'PackedMask':
+        """ Decode a COCO run-length encoding with a compressed string or a list of counts """
+        height, width = rle['size']
+        counts = rle['counts']
+        if isinstance(counts, (str, bytes)):
+            counts = decode_rle_string(counts)
+        values = np.arange(len(counts)) % 2 == 1
+        column_major = np.repeat(values, np.asarray(counts, dtype=np.int64))
+        return cls.from_mask(column_major.reshape(width, height).T)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def to_mask(self) -> Mask:
+        height, width = self.shape
+        return Mask(np.unpackbits(self.bits, count=height * width).astype(bool).reshape(height, width))
+
+    def rows(self, y1: int, y2: int) -> np.ndarray:
+        """ Decode only the rows y1 to y2 of the mask """
+        height, width = self.shape
+        y1, y2 = min(max(y1, 0), height), min(max(y2, 0), height)
+        start, stop = y1 * width, max(y2, y1) * width
+        bits = np.unpackbits(self.bits[start // 8:(stop + 7) // 8])
+        return bits[start % 8:start % 8 + stop - start].astype(bool).reshape(-1, width)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        mask = np.asarray(self.to_mask())
+        return mask if dtype is None else mask.astype(dtype)
+
+    def packed_bits(self, other: Union['PackedMask', np.ndarray]) -> np.ndarray:
+        other = PackedMask.from_mask(other)
+        if other.shape != self.shape:
+            raise ValueError(f'Mask shapes {self.shape} and {other.shape} differ')
+        return other.bits
+
+    def __or__(self, other: Union['PackedMask', np.ndarray]) -> 'PackedMask':
+        return PackedMask(self.bits | self.packed_bits(other), self.shape)
+
+    def __and__(self, other: Union['PackedMask', np.ndarray]) -> 'PackedMask':
+        return PackedMask(self.bits & self.packed_bits(other), self.shape)
+
+    def __invert__(self) -> 'PackedMask':
+        bits = ~self.bits
+        padding = len(bits) * 8 - self.shape[0] * self.shape[1]
+        if padding:
+            bits[-1] &= 0xff << padding & 0xff
+        return PackedMask(bits, self.shape)
+
+    def area(self) -> int:
+        return int(self.popcount[self.bits].sum(dtype=np.int64))
+
+    def iou(self, other: Union['PackedMask', np.ndarray]) -> float:
+        other_bits = self.packed_bits(other)
+        union = int(self.popcount[self.bits | other_bits].sum(dtype=np.int64))
+        return int(self.popcount[self.bits & other_bits].sum(dtype=np.int64)) / union if union else 0.
+
+    def bbox(self) -> Optional[Tuple[int, int, int, int]]:
+        return self.to_mask().bbox()
+
+    def to_rle(self, compress: bool = True) -> Dict[str, Any]:
+        """ The COCO run-length encoding of the mask, runs over the pixels in column-major order starting with a
+            run of zeros, as a compressed string like pycocotools or as a list of counts
+        """
+        height, width = self.shape
+        pixels = np.asarray(self.to_mask()).T.ravel()
+        changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+        counts = np.diff(np.concatenate([[0], changes, [len(pixels)]])).tolist() if len(pixels) else []
+        if len(pixels) and pixels[0]:
+            counts.insert(0, 0)
+        return {'size': [height, width], 'counts': encode_rle_string(counts) if compress else counts}
+
+    def __repr__(self) -> str:
+        return f'PackedMask(shape={self.shape}, area={self.area()})'
+
+
+class ScaledMask:
+    """ A mask or label map computed at another resolution and read at shape (H, W) with nearest neighbor
+        resampling, row by row.
+
+    Modules that run on the downscaled proxy of a tiled image return their masks and label maps as ScaledMasks of
+    the size of the tiled image, so the full resolution mask is never held in memory: consumers that process the
+    image in strips only expand the rows of the strip. Boolean masks are kept packed.
+    """
+
+    def __init__(self, mask: Union[np.ndarray, PackedMask], shape: Tuple[int, int]):
+        if isinstance(mask, np.ndarray) and mask.dtype == bool:
+            mask = PackedMask.from_mask(mask)
+        self.mask = mask if isinstance(mask, PackedMask) else np.asarray(mask)
+        self.shape = tuple(shape)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(bool) if isinstance(self.mask, PackedMask) else self.mask.dtype
+
+    def rows(self, y1: int, y2: int) -> np.ndarray:
+        """ Resample only the rows y1 to y2 """
+        height, width = self.shape
+        source_height, source_width = self.mask.shape
+        y1, y2 = min(max(y1, 0), height), min(max(y2, 0), height)
+        source_rows = np.arange(y1, max(y2, y1)) * source_height // height
+        if len(source_rows) == 0:
+            return np.zeros((0, width), dtype=self.dtype)
+        first, last = int(source_rows[0]), int(source_rows[-1]) + 1
+        block = self.mask.rows(first, last) if isinstance(self.mask, PackedMask) else self.mask[first:last]
+        return block[source_rows - first][:, np.arange(width) * source_width // width]
+
+    def resized(self, shape: Tuple[int, int]) -> 'ScaledMask':
+        return ScaledMask(self.mask, shape)
+
+    def to_mask(self) -> Mask:
+        return Mask(self.rows(0, self.shape[0]))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        mask = np.asarray(self.to_mask())
+        return mask if dtype is None else mask.astype(dtype)
+
+    def __repr__(self) -> str:
+        return f'ScaledMask(shape={self.shape}, source_shape={self.mask.shape})'
+
+
+def encode_rle_string(counts: List[int]) -> str:
+    """ Compress RLE counts into the ASCII string format of pycocotools """
+    characters = []
+    for i, count in enumerate(counts):
+        value = count - counts[i - 2] if i > 2 else count
+        more = True
+        while more:
+            character = value & 0x1f
+            value >>= 5
+            more = value != -1 if character & 0x10 else value != 0
+            if more:
+                character |= 0x20
+            characters.append(chr(character + 48))
+    return ''.join(characters)
+
+
+def decode_rle_string(string: Union[str, bytes]) -> List[int]:
+    """ Decompress the RLE counts of an ASCII string in the format of pycocotools """
+    if isinstance(string, bytes):
+        string = string.decode('ascii')
+    counts, position = [], 0
+    while position < len(string):
+        value, shift, more = 0, 0, True
+        while more:
+            character = ord(string[position]) - 48
+            value |= (character & 0x1f) << shift
+            more = bool(character & 0x20)
+            position += 1
+            shift += 5
+            if not more and character & 0x10:
+                value |= -1 << shift
+        if len(counts) > 2:
+            value += counts[-2]
+        counts.append(value)
+    return counts
+
+
+def mask_box(mask: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    """ The bounding box (x1, y1, x2, y2) of the true pixels of a 2D mask, or None if it is empty """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def as_mask(object: Union[np.ndarray, PackedMask, ScaledMask, Boxes, Sequence[Sequence[float]]],
+            size: Tuple[int, int]) -> np.ndarray:
+    """ The boolean (H, W) mask of a mask, packed or scaled mask, label map or boxes for an image of size
+        (width, height)
+    """
+    if isinstance(object, (PackedMask, ScaledMask)):
+        return np.asarray(object).astype(bool, copy=False)
+    if isinstance(object, np.ndarray):
+        return np.asarray(object).astype(bool, copy=False)
+    return np.asarray(Boxes.from_any(object).rasterize(size))
+
+
+def encode_region(value: Any) -> Any:
+    """ A plain representation of a step output for result files: COCO RLE for boolean masks, lists of
+        [x1, y1, x2, y2] for boxes, and any other value unchanged
+    """
+    if isinstance(value, PackedMask) or isinstance(value, np.ndarray) and value.ndim == 2 and value.dtype == bool:
+        return PackedMask.from_mask(value).to_rle()
+    if isinstance(value, Boxes):
+        return value.array.tolist()
+    return value
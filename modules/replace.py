@@ -1,11 +1,18 @@
+import gc
 import re
-from typing import Dict, Union, Tuple
+from typing import Dict, List, Optional, Union, Tuple
 
 import numpy as np
-from PIL import Image, ImageDraw
+from PIL import Image, ImageDraw, ImageFilter
 import torch
+import diffusers
 from diffusers import StableDiffusionInpaintPipeline
+from transformers import CLIPTextModel, CLIPTokenizer
 
+from modules.caching import LRUCache, fingerprint
+from modules.image_buffer import ImageBuffer, as_array, as_pil
+from modules.model_store import ModelStore, from_pretrained, load_pretrained_model
+from modules.regions import Boxes, PackedMask
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
@@ -14,18 +21,133 @@ class Replace(VisProgModule):
                          r"\(\s*image\s*=\s*(?P<image>\S*)\s*"
                          r",\s*object\s*=\s*(?P<object>\S*)\s*"
                          r",\s*prompt\s*=\s*'(?P<prompt>.*)'\s*\)")
+    model_name = "runwayml/stable-diffusion-inpainting"
+    schedule_profiles = {
+        'default': dict(num_inference_steps=50, scheduler=None),
+        'fast': dict(num_inference_steps=25, scheduler='DPMSolverMultistepScheduler'),
+        'draft': dict(num_inference_steps=12, scheduler='DPMSolverMultistepScheduler'),
+    }
+    accepts_image_buffers = True
 
-    def __init__(self, device: str = "cpu"):
+    def __init__(self, device: str = "cpu", roi: bool = False, roi_context: float = 0.5,
+                 resolution: int = 512, feather_radius: float = 2., profile: str = 'default',
+                 num_inference_steps: Optional[int] = None, vae_cache_size: int = 8,
+                 low_memory: bool = False, release_after_call: Optional[bool] = None,
+                 store: Optional[ModelStore] = None):
+        """
+        Parameters
+        ----------
+        device : str
+            The device to run the pipeline on
+
+        roi : bool
+            Whether to inpaint only a context window around the object instead of the whole image
+
+        roi_context : float
+            The margin added on each side of the object bounding box, relative to the box size
+
+        resolution : int
+            The resolution the context window is resized to before inpainting
+
+        feather_radius : float
+            The blur radius of the mask used to composite the inpainted window back into the image
+
+        profile : str
+            The diffusion schedule profile, one of 'default', 'fast' or 'draft'
+
+        num_inference_steps : Optional[int]
+            Overrides the number of denoising steps of the profile
+
+        vae_cache_size : int
+            The number of VAE encodings of masked source images to keep for reuse
+
+        low_memory : bool
+            Load the pipeline lazily, encode prompts with a separately loaded text encoder that is freed
+            before the UNet and VAE are loaded, and use sliced attention and tiled VAE decoding
+
+        release_after_call : Optional[bool]
+            Whether to free the pipeline after every call, defaults to low_memory
+
+        store : Optional[ModelStore]
+            The local model store to load the pipeline from, the hub if None
+        """
         super().__init__()
-        self.pipe = StableDiffusionInpaintPipeline.from_pretrained(
-            "runwayml/stable-diffusion-inpainting",
+        self.device = device
+        self.store = store
+        self.roi = roi
+        self.roi_context = roi_context
+        self.resolution = resolution
+        self.feather_radius = feather_radius
+        self.schedule = self.schedule_profiles[profile]
+        self.num_inference_steps = num_inference_steps or self.schedule['num_inference_steps']
+        self.vae_cache = LRUCache(vae_cache_size)
+        self.low_memory = low_memory
+        self.release_after_call = low_memory if release_after_call is None else release_after_call
+        self._pipe: Optional[StableDiffusionInpaintPipeline] = None
+        if not low_memory:
+            self.load_pipeline()
+
+    @property
+    def pretrained_kwargs(self) -> Dict[str, object]:
+        if self.device == 'cpu':
+            return {}
+        if self.store is not None:  # the store holds the weights of one variant, passed on load and cast to float16
+            return dict(torch_dtype=torch.float16)
+        return dict(
+            revision="fp16",
+            torch_dtype=torch.float16,
+        )
+
+    @property
+    def pipe(self) -> StableDiffusionInpaintPipeline:
+        if self._pipe is None:
+            self.load_pipeline()
+        return self._pipe
+
+    def load_pipeline(self):
+        """ Load the inpainting pipeline, without its text encoder in low-memory mode """
+        pipe = load_pretrained_model(
+            StableDiffusionInpaintPipeline,
+            self.model_name,
+            self.store,
+            **self.pretrained_kwargs,
             **(dict(
-                revision="fp16",
-                torch_dtype=torch.float16,
-            ) if device != 'cpu' else {})
+                text_encoder=None,
+                tokenizer=None,
+                low_cpu_mem_usage=True,
+            ) if self.low_memory else {})
         )
-        self.model = self.pipe.to(device)
-        self.device = device
+        if self.schedule['scheduler'] is not None:
+            scheduler_class = getattr(diffusers, self.schedule['scheduler'])
+            pipe.scheduler = scheduler_class.from_config(pipe.scheduler.config)
+        if self.low_memory:
+            pipe.enable_attention_slicing()
+            pipe.enable_vae_tiling()
+        self._pipe = pipe.to(self.device)
+
+    def release(self):
+        """ Free the pipeline, it is reloaded on the next call """
+        self._pipe = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def encode_prompts(self, prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Encode the prompts and the empty negative prompt with a temporarily loaded text encoder """
+        tokenizer = from_pretrained(CLIPTokenizer, self.model_name, self.store, subfolder="tokenizer")
+        text_encoder = load_pretrained_model(CLIPTextModel, self.model_name, self.store, subfolder="text_encoder",
+                                             low_cpu_mem_usage=True, **self.pretrained_kwargs)
+        text_encoder = text_encoder.to(self.device)
+        embeddings = []
+        for texts in (prompts, [""] * len(prompts)):
+            input_ids = tokenizer(texts, padding="max_length", max_length=tokenizer.model_max_length,
+                                  truncation=True, return_tensors="pt").input_ids
+            with torch.no_grad():
+                embeddings.append(text_encoder(input_ids.to(self.device))[0])
+        del text_encoder
+        gc.collect()
+        prompt_embeds, negative_prompt_embeds = embeddings
+        return prompt_embeds, negative_prompt_embeds
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -55,14 +177,13 @@ class Replace(VisProgModule):
 
     @staticmethod
     def get_seg_map(image: Image.Image,
-                    object: Union[np.ndarray, Tuple[Tuple[float, ...], ...]]) -> np.ndarray:
+                    object: Union[np.ndarray, PackedMask, Boxes]) -> np.ndarray:
         if isinstance(object, np.ndarray):  # object is a segmentation map
             seg_map = object
+        elif isinstance(object, PackedMask):
+            seg_map = object.to_mask()
         else:   # object is a list of bounding boxes
-            seg_map = np.zeros(image.size[::-1], dtype=np.uint8)
-            for obj in object:
-                x1, y1, x2, y2 = map(int, obj)
-                seg_map[y1:y2, x1:x2] = 1
+            seg_map = np.asarray(Boxes.from_any(object).rasterize(image.size), dtype=np.uint8)
 
         return seg_map
 
@@ -86,16 +207,161 @@ class Replace(VisProgModule):
         output = output.resize((max_dim, max_dim))
         return output.crop((0, 0, *image.size))
 
-    def perform_module_function(self, image: Image.Image, object: np.ndarray, prompt: str) -> Image.Image:
+    @staticmethod
+    def get_roi_box(seg_map: np.ndarray, context: float) -> Optional[Tuple[int, int, int, int]]:
+        """ Get the context window (x1, y1, x2, y2) around the mask, or None if the mask is empty """
+        rows = np.flatnonzero(seg_map.any(axis=1))
+        cols = np.flatnonzero(seg_map.any(axis=0))
+        if len(rows) == 0:
+            return None
+        height, width = seg_map.shape
+        y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        # grow the window to a square so that the model sees it without distortion
+        side = min(int(max(x2 - x1, y2 - y1) * (1 + 2 * context)), max(width, height))
+        x1 = int(np.clip((x1 + x2 - side) // 2, 0, max(width - side, 0)))
+        y1 = int(np.clip((y1 + y2 - side) // 2, 0, max(height - side, 0)))
+        return x1, y1, min(x1 + side, width), min(y1 + side, height)
+
+    @staticmethod
+    def get_edited_box(seg_map: np.ndarray, feather_radius: float) -> Optional[Tuple[int, int, int, int]]:
+        """ Get the box (x1, y1, x2, y2) of the pixels a composite with the mask changes, or None if it is empty """
+        rows = np.flatnonzero(seg_map.any(axis=1))
+        cols = np.flatnonzero(seg_map.any(axis=0))
+        if len(rows) == 0:
+            return None
+        height, width = seg_map.shape
+        margin = int(np.ceil(3 * feather_radius))
+        return (max(int(cols[0]) - margin, 0), max(int(rows[0]) - margin, 0),
+                min(int(cols[-1]) + 1 + margin, width), min(int(rows[-1]) + 1 + margin, height))
+
+    @staticmethod
+    def record_edit(output: Image.Image, image: Image.Image, box: Optional[Tuple[int, int, int, int]]
+                    ) -> Image.Image:
+        """ Remember that output is image with only the pixels in box (x1, y1, x2, y2) changed, or none if box is
+            None, so that Seg can update the label map of image instead of segmenting output from scratch
+        """
+        output.edit_source = image
+        output.edit_box = box
+        return output
+
+    def prepare_inpainting(self, image: Image.Image, seg_map: np.ndarray
+                           ) -> Optional[Tuple[Image.Image, Image.Image, Tuple[int, int, int, int]]]:
+        """ Build the square model inputs for the image and mask.
+
+        Returns
+        -------
+        Optional[Tuple[Image.Image, Image.Image, Tuple[int, int, int, int]]]
+            The square image, the square mask and the window (x1, y1, x2, y2) they were taken from,
+            or None if there is nothing to inpaint
+        """
+        seg_map = seg_map > 0
+        if self.roi:
+            box = self.get_roi_box(seg_map, self.roi_context)
+            if box is None:
+                return None
+        else:
+            box = (0, 0, *image.size)
+        x1, y1, x2, y2 = box
+        window = image.crop(box) if self.roi else image
+        size = (self.resolution, self.resolution)
+        square_window = self.square_image(window).resize(size, Image.BICUBIC)
+        square_mask = Image.fromarray(self.square_seg_map(seg_map[y1:y2, x1:x2]) * np.uint8(255)).resize(
+            size, Image.NEAREST)
+        return square_window, square_mask, box
+
+    def composite(self, output: Image.Image, image: Image.Image, seg_map: np.ndarray,
+                  box: Tuple[int, int, int, int]) -> Image.Image:
+        """ Map the square model output back to the image """
+        x1, y1, x2, y2 = box
+        window = image.crop(box) if self.roi else image
+        output = self.desquare_image(output, window)
+        if not self.roi:
+            return output
+
+        alpha = Image.fromarray((seg_map[y1:y2, x1:x2] > 0).astype(np.uint8) * 255)
+        if self.feather_radius > 0:
+            alpha = alpha.filter(ImageFilter.GaussianBlur(radius=self.feather_radius))
+        result = image.copy()
+        result.paste(output, box[:2], alpha)
+        return result
+
+    def encode_masked_image(self, image: Image.Image, mask: Image.Image) -> torch.Tensor:
+        """ VAE-encode the masked image the way the inpainting pipeline conditions on it,
+            reusing the encoding when the same image and mask were seen before """
+        key = fingerprint(image, mask)
+        latents = self.vae_cache.get(key)
+        if latents is not None:
+            return latents
+        init_image = self.pipe.image_processor.preprocess(image, height=self.resolution, width=self.resolution)
+        mask_condition = self.pipe.mask_processor.preprocess(mask, height=self.resolution, width=self.resolution)
+        masked_image = (init_image * (mask_condition < 0.5)).to(device=self.device, dtype=self.pipe.vae.dtype)
+        with torch.no_grad():
+            latents = self.pipe.vae.encode(masked_image).latent_dist.mode()
+        latents = latents * self.pipe.vae.config.scaling_factor
+        self.vae_cache.put(key, latents)
+        return latents
+
+    def inpaint(self, images: List[Image.Image], masks: List[Image.Image], prompts: List[str]) -> List[Image.Image]:
+        """ Run the inpainting pipeline once for a batch of square images """
+        prompt_kwargs = dict(prompt=prompts)
+        if self.low_memory:
+            prompt_embeds, negative_prompt_embeds = self.encode_prompts(prompts)
+            prompt_kwargs = dict(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_prompt_embeds)
+        masked_image_latents = torch.cat([self.encode_masked_image(image, mask)
+                                          for image, mask in zip(images, masks)])
+        outputs = self.pipe(**prompt_kwargs, image=images, mask_image=masks,
+                            masked_image_latents=masked_image_latents,
+                            height=self.resolution, width=self.resolution,
+                            num_inference_steps=self.num_inference_steps).images
+        if self.release_after_call:
+            self.release()
+        return outputs
+
+    def replace_batch(self, requests: List[Tuple[Image.Image, Union[np.ndarray, PackedMask, Boxes], str]]
+                      ) -> List[Image.Image]:
+        """ Perform several independent replacements with a single pipeline call
+
+        Parameters
+        ----------
+        requests : List[Tuple[Image.Image, Union[np.ndarray, PackedMask, Boxes], str]]
+            (image, object, prompt) for each replacement
+
+        Returns
+        -------
+        List[Image.Image]
+            The images with the objects replaced, in the order of the requests
+        """
+        outputs: List[Optional[Image.Image]] = [None] * len(requests)
+        pending = []
+        for i, (image, object, prompt) in enumerate(requests):
+            seg_map = self.get_seg_map(image, object)
+            prepared = self.prepare_inpainting(image, seg_map)
+            if prepared is None:
+                outputs[i] = self.record_edit(image.copy(), image, None)
+            else:
+                pending.append((i, image, seg_map, prompt, *prepared))
+
+        if pending:
+            indices, images, seg_maps, prompts, square_images, square_masks, boxes = zip(*pending)
+            inpainted = self.inpaint(list(square_images), list(square_masks), list(prompts))
+            for i, image, seg_map, box, output in zip(indices, images, seg_maps, boxes, inpainted):
+                outputs[i] = self.composite(output, image, seg_map, box)
+                if self.roi:
+                    self.record_edit(outputs[i], image, self.get_edited_box(seg_map, self.feather_radius))
+        return outputs
+
+    def perform_module_function(self, image: Union[ImageBuffer, Image.Image],
+                                object: Union[np.ndarray, PackedMask, Boxes],
+                                prompt: str) -> Image.Image:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
+        image : Union[ImageBuffer, Image.Image]
             The original image
 
-        object : np.ndarray
-            The mask of the object in the image
+        object : Union[np.ndarray, PackedMask, Boxes]
+            The mask of the object in the image, or its boxes
 
         prompt : str
             The prompt to use for the replacement
@@ -105,14 +371,10 @@ class Replace(VisProgModule):
         Image.Image
             The image with the object replaced
         """
-        seg_map = self.get_seg_map(image, object)
-        square_image = self.square_image(image)
-        square_seg_map = self.square_seg_map(seg_map)
-        output: Image.Image = self.pipe(prompt=prompt, image=square_image,
-                                        mask_image=square_seg_map.astype('float')).images[0]
-        return self.desquare_image(output, image)
-
-    def html(self, output: Image.Image, image: Image.Image, object: np.ndarray, prompt: str) -> str:
+        return self.replace_batch([(as_pil(image), object, prompt)])[0]
+
+    def html(self, output: Image.Image, image: Union[ImageBuffer, Image.Image],
+             object: Union[np.ndarray, PackedMask, Boxes], prompt: str) -> str:
         """ Generate HTML to display the output
 
         Parameters
@@ -128,10 +390,10 @@ class Replace(VisProgModule):
         str
             The HTML to display the output
         """
-        if isinstance(object, np.ndarray):
-            image_array = np.array(image)
-            masked_image = image_array * (~object[..., None])
-            masked_image = Image.fromarray(masked_image)
+        image_array = as_array(image)
+        image = as_pil(image)
+        if isinstance(object, (np.ndarray, PackedMask)):
+            masked_image = self.buffer_pool.masked_image(image_array, np.asarray(object, dtype=bool), inside=False)
 
             return {
                 'input': image,
@@ -1,23 +1,99 @@
 import re
-from typing import Any, Dict
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
+import torch
 from PIL import Image
 from transformers import AutoImageProcessor, MaskFormerForInstanceSegmentation
 
+from modules.caching import LRUCache
+from modules.image_buffer import ImageBuffer, as_array, as_pil
+from modules.inference_policy import InferencePolicy
+from modules.model_loading import load_model, model_revision
+from modules.model_store import ModelStore, from_pretrained
+from modules.onnx_backend import example_image
+from modules.regions import Mask, ScaledMask
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
 class Seg(VisProgModule):
     pattern = re.compile(r"(?P<output>\S*)\s*=\s*SEG\s*"
                          r"\(\s*image\s*=\s*(?P<image>\S*)\s*\)")
+    accepts_image_buffers = True
+    # tiled images are analysed on their downscaled proxy
+    runs_on_proxy = True
 
-    def __init__(self, device: str = "cpu"):
+    def __init__(self, device: str = "cpu", max_resolution: Optional[int] = None,
+                 tile_size: Optional[int] = None, tile_overlap: int = 64,
+                 policy: Optional[InferencePolicy] = None, backend: str = "torch", compile: bool = False,
+                 store: Optional[ModelStore] = None, incremental: bool = False, incremental_padding: int = 64,
+                 incremental_max_fraction: float = 0.5, label_map_cache_size: int = 8):
+        """
+        Parameters
+        ----------
+        device : str
+            The device to run the model on
+
+        max_resolution : Optional[int]
+            If given, images whose longest side exceeds this value are downscaled before inference
+            and the label map is upsampled back with nearest-neighbor interpolation
+
+        tile_size : Optional[int]
+            If given, the (possibly downscaled) image is segmented in square tiles of this size
+
+        tile_overlap : int
+            The overlap in pixels between neighbouring tiles, only used when tile_size is given
+
+        policy : Optional[InferencePolicy]
+            How to run the forward passes, the default policy if None
+
+        backend : str
+            'torch' or 'onnx', see load_model
+
+        compile : bool
+            Whether to wrap the model in torch.compile
+
+        store : Optional[ModelStore]
+            The local model store to load the model from, the hub if None
+
+        incremental : bool
+            Whether to segment images edited by Replace by re-running the model only on a window around the edited
+            region and merging the result into the label map of the image before the edit, if it was segmented
+
+        incremental_padding : int
+            The context in pixels added around the edited region to form the window
+
+        incremental_max_fraction : float
+            Edits whose window covers more than this fraction of the image are segmented from scratch
+
+        label_map_cache_size : int
+            The number of recent label maps kept as bases for incremental segmentation
+        """
         super().__init__()
-        self.image_processor = AutoImageProcessor.from_pretrained("facebook/maskformer-swin-base-ade")
-        self.model = MaskFormerForInstanceSegmentation.from_pretrained("facebook/maskformer-swin-base-ade")
-        self.model = self.model.to(device)
+        if tile_size is not None and tile_overlap * 2 >= tile_size:
+            raise ValueError(f"tile_overlap ({tile_overlap}) must be less than half of tile_size ({tile_size})")
+        self.policy = policy or InferencePolicy()
+        self.image_processor = from_pretrained(AutoImageProcessor, "facebook/maskformer-swin-base-ade", store)
+        self.model = load_model(MaskFormerForInstanceSegmentation, "facebook/maskformer-swin-base-ade",
+                                device=device, policy=self.policy, backend=backend,
+                                output_names=('class_queries_logits', 'masks_queries_logits'),
+                                compile=compile, dynamic=True, store=store, example_inputs=self.example_inputs)
         self.device = device
+        self.max_resolution = max_resolution
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.backend = backend
+        self.incremental = incremental
+        self.incremental_padding = incremental_padding
+        self.incremental_max_fraction = incremental_max_fraction
+        self.label_maps = LRUCache(label_map_cache_size)
+        self.incremental_stats = Counter()
+
+    def example_inputs(self) -> List[Dict[str, torch.Tensor]]:
+        """ Processor outputs of landscape and portrait images to export the model with """
+        return [self.image_processor(example_image(640, 480), return_tensors="pt"),
+                self.image_processor(example_image(360, 540, seed=1), return_tensors="pt")]
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -42,41 +118,177 @@ class Seg(VisProgModule):
                               'image': match.group('image')
                           })
 
-    def perform_module_function(self, image: Image.Image) -> np.ndarray:
+    def perform_module_function(self, image: Union[ImageBuffer, Image.Image]) -> Mask:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
+        image : Union[ImageBuffer, Image.Image]
             The original image
 
         Returns
         -------
-        np.ndarray
-            The mask of the object in the image
+        Mask
+            The label map of the image
+        """
+        image = as_pil(image)
+        if not self.incremental:
+            return Mask(self.segment(image))
+
+        label_map = self.resegment_edit(image)
+        if label_map is None:
+            self.incremental_stats['full'] += 1
+            label_map = self.segment(image)
+        else:
+            self.incremental_stats['incremental'] += 1
+        self.label_maps.put(id(image), (image, label_map))
+        return Mask(label_map)
+
+    def segment(self, image: Image.Image) -> np.ndarray:
+        """ Segment the whole image, downscaled and tiled according to max_resolution and tile_size """
+        if self.max_resolution is None and self.tile_size is None:
+            return self.predict_label_map(image)
+
+        inference_size = self.get_inference_size(image.size, self.max_resolution)
+        inference_image = image if inference_size == image.size else image.resize(inference_size, Image.BILINEAR)
+        if self.tile_size is None:
+            label_map = self.predict_label_map(inference_image).astype(self.label_dtype)
+        else:
+            label_map = self.predict_tiled_label_map(inference_image)
+        return self.upsample_label_map(label_map, image.size)
+
+    def resegment_edit(self, image: Image.Image) -> Optional[np.ndarray]:
+        """ Update the label map of the image an edited image was derived from, see Replace.record_edit
+
+        Follows the chain of edits back to the latest image with a cached label map and segments a padded window
+        around the union of the edited regions.
+
+        Returns
+        -------
+        Optional[np.ndarray]
+            The label map, or None if the image has to be segmented from scratch
         """
+        source, box = image, None
+        while True:
+            if getattr(source, 'edit_source', None) is None:
+                return None
+            edit_box = source.edit_box
+            if edit_box is not None:
+                box = edit_box if box is None else (min(box[0], edit_box[0]), min(box[1], edit_box[1]),
+                                                    max(box[2], edit_box[2]), max(box[3], edit_box[3]))
+            source = source.edit_source
+            entry = self.label_maps.get(id(source))
+            if entry is not None and entry[0] is source:
+                break
+
+        label_map = entry[1]
+        if source.size != image.size:
+            return None
+        if box is None:
+            return label_map
+
+        width, height = image.size
+        x1, y1, x2, y2 = box
+        window = (max(x1 - self.incremental_padding, 0), max(y1 - self.incremental_padding, 0),
+                  min(x2 + self.incremental_padding, width), min(y2 + self.incremental_padding, height))
+        window_x1, window_y1, window_x2, window_y2 = window
+        if (window_x2 - window_x1) * (window_y2 - window_y1) > self.incremental_max_fraction * width * height:
+            return None
+
+        window_label_map = self.segment(image.crop(window))
+        label_map = label_map.copy()
+        label_map[y1:y2, x1:x2] = window_label_map[y1 - window_y1:y2 - window_y1, x1 - window_x1:x2 - window_x1]
+        return label_map
+
+    def predict_label_map(self, image: Image.Image) -> np.ndarray:
+        """ Run the model on the image and return the label map at the image resolution """
         inputs = self.image_processor(image, return_tensors="pt").to(self.device)
-        outputs = self.model(**inputs)
-        predicted_semantic_map = self.image_processor.post_process_semantic_segmentation(
-            outputs, target_sizes=[image.size[::-1]]
-        )[0]
+        with self.policy.inference(self.device):
+            outputs = self.model(**inputs)
+            predicted_semantic_map = self.image_processor.post_process_semantic_segmentation(
+                outputs, target_sizes=[image.size[::-1]]
+            )[0]
         return predicted_semantic_map.detach().cpu().numpy()
 
-    def html(self, output: np.ndarray, image: Image.Image) -> Dict[str, Any]:
+    def predict_tiled_label_map(self, image: Image.Image) -> np.ndarray:
+        """ Segment the image tile by tile and stitch the label maps together.
+
+        Each tile only writes its core region, i.e. the tile without the half of the overlap that is shared
+        with a neighbour, so every pixel is labelled by the tile in which it is furthest from the border.
+        """
+        width, height = image.size
+        label_map = np.zeros((height, width), dtype=self.label_dtype)
+        for x1, x2, core_x1, core_x2 in self.get_tiles(width, self.tile_size, self.tile_overlap):
+            for y1, y2, core_y1, core_y2 in self.get_tiles(height, self.tile_size, self.tile_overlap):
+                tile_label_map = self.predict_label_map(image.crop((x1, y1, x2, y2)))
+                label_map[core_y1:core_y2, core_x1:core_x2] = \
+                    tile_label_map[core_y1 - y1:core_y2 - y1, core_x1 - x1:core_x2 - x1]
+        return label_map
+
+    @property
+    def label_dtype(self) -> np.dtype:
+        return np.min_scalar_type(self.model.config.num_labels)
+
+    @staticmethod
+    def get_inference_size(size: Tuple[int, int], max_resolution: Optional[int]) -> Tuple[int, int]:
+        if max_resolution is None or max(size) <= max_resolution:
+            return size
+        scale = max_resolution / max(size)
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+    @staticmethod
+    def get_tiles(length: int, tile_size: int, overlap: int) -> List[Tuple[int, int, int, int]]:
+        """ Split [0, length) into overlapping tiles.
+
+        Returns
+        -------
+        List[Tuple[int, int, int, int]]
+            (start, end, core_start, core_end) for each tile
+        """
+        if length <= tile_size:
+            return [(0, length, 0, length)]
+        stride = tile_size - 2 * overlap
+        starts = list(range(0, length - tile_size, stride)) + [length - tile_size]
+        tiles = []
+        for i, start in enumerate(starts):
+            core_start = 0 if i == 0 else tiles[-1][3]
+            core_end = length if i == len(starts) - 1 else start + tile_size - overlap
+            tiles.append((start, start + tile_size, core_start, core_end))
+        return tiles
+
+    @staticmethod
+    def upsample_label_map(label_map: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+        """ Nearest-neighbor upsampling of the label map to size (width, height) """
+        height, width = label_map.shape
+        if (width, height) == tuple(size):
+            return label_map
+        rows = (np.arange(size[1]) * height // size[1])
+        cols = (np.arange(size[0]) * width // size[0])
+        return label_map[rows[:, None], cols[None, :]]
+
+    def cache_identity(self) -> Optional[tuple]:
+        return ("facebook/maskformer-swin-base-ade", model_revision(self.model), self.backend, self.policy.bfloat16,
+                self.max_resolution, self.tile_size, self.tile_overlap, self.incremental, self.incremental_padding,
+                self.incremental_max_fraction)
+
+    def rescale_output(self, output: np.ndarray, from_size: Tuple[int, int], to_size: Tuple[int, int]
+                       ) -> Union[np.ndarray, ScaledMask]:
+        """ The label map of a proxy, resampled row by row when it is read at the size of the tiled image """
+        return output if tuple(from_size) == tuple(to_size) else ScaledMask(output, to_size[::-1])
+
+    def html(self, output: np.ndarray, image: Union[ImageBuffer, Image.Image]) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
         ----------
         inputs : Dict[str, Any]
         """
-        image_array = np.array(image)
+        image_array = as_array(image)
+        image = as_pil(image)
         unique_classes = np.unique(output)
         segments = []
         for class_label in unique_classes:
-            mask = output == class_label
-            masked_image = image_array * mask[..., None]
-            masked_image = Image.fromarray(masked_image)
-            segments.append(masked_image)
+            segments.append(self.buffer_pool.masked_image(image_array, output == class_label))
 
         return {
             'input': image,
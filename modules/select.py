@@ -7,6 +7,13 @@ import PIL
 import torch
 from transformers import CLIPProcessor, CLIPModel
 
+from modules.image_buffer import ImageBuffer, as_array, as_pil
+from modules.inference_policy import InferencePolicy
+from modules.model_loading import load_model, model_revision
+from modules.model_store import ModelStore, from_pretrained
+from modules.onnx_backend import example_image
+from modules.preprocessing import FastImagePreprocessor
+from modules.regions import Boxes, Mask, PackedMask, ScaledMask, as_mask
 from modules.visprog_module import VisProgModule, ParsedStep
 
 
@@ -16,13 +23,33 @@ class Select(VisProgModule):
                          r",\s*object\s*=\s*(?P<object>\S*)\s*"
                          r",\s*query\s*=\s*'(?P<query>.*)'\s*"
                          r",\s*category\s*=\s*(?P<category>\S.*\S*)\s*\)")
-
-    def __init__(self, category_id_to_name: Dict[int, str], category_name_to_id: Dict[str, int], device: str = "cpu"):
+    accepts_image_buffers = True
+    # tiled images are analysed on their downscaled proxy
+    runs_on_proxy = True
+
+    def __init__(self, category_id_to_name: Dict[int, str], category_name_to_id: Dict[str, int], device: str = "cpu",
+                 policy: Optional[InferencePolicy] = None, quantize: bool = False, backend: str = "torch",
+                 compile: bool = False, store: Optional[ModelStore] = None, fast_preprocessing: bool = False,
+                 pack_masks: bool = False):
+        """
+        Parameters
+        ----------
+        pack_masks : bool
+            Whether to return selected masks as PackedMasks of one bit per pixel instead of boolean arrays
+        """
         super().__init__()
-        self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
-        self.model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14")
-        self.model = self.model.to(device)
+        self.policy = policy or InferencePolicy()
+        self.processor = from_pretrained(CLIPProcessor, "openai/clip-vit-large-patch14", store)
+        self.fast_image_processor = FastImagePreprocessor(self.processor.image_processor) if fast_preprocessing \
+            else None
+        self.model = load_model(CLIPModel, "openai/clip-vit-large-patch14", device=device, policy=self.policy,
+                                quantize=quantize, backend=backend, output_names=('logits_per_image',),
+                                compile=compile, dynamic=True, store=store, example_inputs=self.example_inputs)
+        self.text_padding = "max_length" if compile else True
+        self.quantize = quantize
+        self.backend = backend
         self.device = device
+        self.pack_masks = pack_masks
         self.category_id_to_name = category_id_to_name
         self.category_name_to_id = {}
         for k, v in category_name_to_id.items():
@@ -30,6 +57,14 @@ class Select(VisProgModule):
             for key in keys:
                 self.category_name_to_id[key] = v
 
+    def example_inputs(self) -> List[Dict[str, torch.Tensor]]:
+        """ Processor outputs with different numbers of images, queries and query lengths to export the model with """
+        return [self.processor(text=["the man"], images=[example_image(224, 224, seed) for seed in range(3)],
+                               return_tensors="pt", padding=True),
+                self.processor(text=["a dog", "the umbrella on the left"],
+                               images=[example_image(224, 224, seed) for seed in range(3, 5)],
+                               return_tensors="pt", padding=True)]
+
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
             and output variable name.
@@ -58,7 +93,7 @@ class Select(VisProgModule):
                               'object': match.group('object')
                           })
 
-    def get_seg_map_and_category_ids(self, image: Image.Image, object: Union[np.ndarray, Tuple[Tuple[float, ...], ...]],
+    def get_seg_map_and_category_ids(self, image: Image.Image, object: Union[np.ndarray, Boxes],
                                      category: Optional[str] = None) -> Tuple[np.ndarray, List[int]]:
         if isinstance(object, np.ndarray):  # object is a segmentation map
             seg_map = object
@@ -75,26 +110,26 @@ class Select(VisProgModule):
                 category_ids = list(np.unique(seg_map))
 
         else:   # object is a list of bounding boxes
-            seg_map = np.zeros(image.size[::-1], dtype=np.uint8)
-            for i, box in enumerate(object):
-                x1, y1, x2, y2 = map(int, box)
-                seg_map[y1:y2, x1:x2] = i + 1
-
+            seg_map = np.asarray(Boxes.from_any(object).rasterize(image.size, labels=True))
             category_ids = list(range(len(object) + 1))
 
         return seg_map, category_ids
 
-    def perform_module_function(self, image: Image.Image, object: Union[np.ndarray, Tuple[Tuple[float, ...], ...]],
+    def mask_output(self, mask: np.ndarray) -> Union[Mask, PackedMask]:
+        return PackedMask.from_mask(mask) if self.pack_masks else Mask(mask)
+
+    def perform_module_function(self, image: Union[ImageBuffer, Image.Image],
+                                object: Union[np.ndarray, PackedMask, Boxes],
                                 query: str,
-                                category: Optional[str] = None) -> Union[np.ndarray, Tuple[Tuple[float, ...], ...]]:
+                                category: Optional[str] = None) -> Union[Mask, PackedMask, Boxes]:
         """ Select the object in the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
+        image : Union[ImageBuffer, Image.Image]
             The original image
 
-        object : Union[np.ndarray, Tuple[Tuple[float, ...], ...]]
+        object : Union[np.ndarray, PackedMask, Boxes]
             The segmentation map or bounding boxes
 
         query : str
@@ -105,35 +140,61 @@ class Select(VisProgModule):
 
         Returns
         -------
-        np.ndarray
-            The mask of the selected object in the image
+        Union[Mask, PackedMask, Boxes]
+            The mask of the selected object in the image, or the selected boxes
         """
+        if isinstance(object, PackedMask):
+            object = object.to_mask()
         queries = query.split(',')
-        image_array = np.array(image)
+        image_array = as_array(image)
 
         seg_map, category_ids = self.get_seg_map_and_category_ids(image, object, category)
 
-        masked_images = []
-        for category_id in category_ids:
-            mask = seg_map == category_id
-            masked_image = image_array * mask[..., None]
-            masked_image = Image.fromarray(masked_image)
-            masked_images.append(masked_image)
+        if self.fast_image_processor is not None:
+            # mask and preprocess all the category crops as one batch
+            inputs = self.processor.tokenizer(text=queries, return_tensors="pt", padding=self.text_padding)
+            with self.buffer_pool.scratch((len(category_ids), *seg_map.shape), bool) as masks, \
+                    self.buffer_pool.scratch((len(category_ids), *image_array.shape)) as batch:
+                np.equal(seg_map[None], np.asarray(category_ids).reshape(-1, 1, 1), out=masks)
+                np.multiply(image_array[None], masks[..., None], out=batch)
+                # the preprocessor converts the batch to float, so the scratch arrays are free again afterwards
+                inputs.update(self.fast_image_processor(batch))
+            inputs = inputs.to(self.device)
+        else:
+            masked_images = [self.buffer_pool.masked_image(image_array, seg_map == category_id)
+                             for category_id in category_ids]
 
-        inputs = self.processor(text=queries, images=masked_images, return_tensors="pt", padding=True).to(self.device)
-        outputs = self.model(**inputs)
+            inputs = self.processor(text=queries, images=masked_images, return_tensors="pt",
+                                    padding=self.text_padding).to(self.device)
+        with self.policy.inference(self.device):
+            outputs = self.model(**inputs)
         logits_per_image = outputs.logits_per_image
         best_index_per_query = logits_per_image.argmax(dim=0)
         assert len(best_index_per_query) == len(queries)
         selected_category_ids = [category_ids[i] for i in best_index_per_query]
         if isinstance(object, np.ndarray):
-            return np.isin(seg_map, selected_category_ids)
+            return self.mask_output(np.isin(seg_map, selected_category_ids))
         else:
-            selected_boxes = [object[i - 1] for i in best_index_per_query]
-            return selected_boxes
+            return Boxes.from_any(object)[best_index_per_query.cpu().numpy() - 1]
 
-    def html(self, output: Union[np.ndarray, Tuple[Tuple[float, ...], ...]],
-             image: Image.Image, object: Union[np.ndarray, Tuple[Tuple[float, ...], ...]],
+    def cache_identity(self) -> Optional[tuple]:
+        return ("openai/clip-vit-large-patch14", model_revision(self.model), self.quantize, self.backend,
+                self.policy.bfloat16, self.fast_image_processor is not None,
+                tuple(sorted(self.category_name_to_id.items())), self.pack_masks)
+
+    def rescale_output(self, output: Union[Mask, PackedMask, Boxes], from_size: Tuple[int, int],
+                       to_size: Tuple[int, int]) -> Union[Mask, PackedMask, ScaledMask, Boxes]:
+        """ Scale selected boxes, selected masks of a proxy are resampled row by row when they are read at the size of
+            the tiled image
+        """
+        if tuple(from_size) == tuple(to_size):
+            return output
+        if isinstance(output, Boxes):
+            return output.scale(to_size[0] / from_size[0], to_size[1] / from_size[1])
+        return ScaledMask(output, to_size[::-1])
+
+    def html(self, output: Union[np.ndarray, PackedMask, Boxes],
+             image: Union[ImageBuffer, Image.Image], object: Union[np.ndarray, PackedMask, Boxes],
              query: str, category: Optional[str] = None) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
@@ -150,10 +211,10 @@ class Select(VisProgModule):
         Dict[str, Any]
             The HTML to display
         """
-        if isinstance(object, np.ndarray):
-            image_array = np.array(image)
-            masked_image = image_array * output[..., None]
-            masked_image = Image.fromarray(masked_image)
+        image_array = as_array(image)
+        image = as_pil(image)
+        if isinstance(object, (np.ndarray, PackedMask)):
+            masked_image = self.buffer_pool.masked_image(image_array, as_mask(output, image.size))
             return {
                 'prompt': query,
                 'category': category,
@@ -0,0 +1,163 @@
+import re
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from modules.caching import LRUCache, fingerprint
+from modules.facedet import FaceDet
+from modules.image_buffer import as_pil
+from modules.loc import Loc
+from modules.regions import Boxes, Mask, PackedMask
+from modules.replace import Replace
+from modules.seg import Seg
+from modules.select import Select
+from modules.visprog_module import VisProgModule
+from modules.vqa import VQA
+
+
+class StubMixin:
+    """ Replaces the model of a module with deterministic, input-derived outputs.
+
+    Stubs keep the pattern, parse and html of the module they stand in for, load no weights,
+    and sleep for a configurable synthetic latency on every call.
+    """
+    latency: float
+
+    def init_stub(self, latency: float = 0.):
+        VisProgModule.__init__(self)
+        self.latency = latency
+
+    def cache_identity(self) -> Optional[tuple]:
+        return None
+
+    def rng(self, *values) -> np.random.Generator:
+        """ Sleep for the synthetic latency and return a generator seeded by the inputs """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return np.random.default_rng(int(fingerprint(type(self).__name__, *values)[:16], 16))
+
+    @staticmethod
+    def random_boxes(rng: np.random.Generator, size: Tuple[int, int], max_boxes: int = 3) -> Boxes:
+        width, height = size
+        boxes = []
+        for _ in range(rng.integers(0, max_boxes + 1)):
+            x1, x2 = np.sort(rng.uniform(0, width, 2))
+            y1, y2 = np.sort(rng.uniform(0, height, 2))
+            boxes.append((float(x1), float(y1), float(x2), float(y2)))
+        return Boxes(boxes)
+
+
+class StubLoc(StubMixin, Loc):
+
+    def __init__(self, latency: float = 0., **kwargs):
+        self.init_stub(latency)
+
+    def perform_module_function(self, image: Image.Image, object: str) -> Boxes:
+        return self.random_boxes(self.rng(image, object), image.size)
+
+
+class StubFaceDet(StubMixin, FaceDet):
+
+    def __init__(self, latency: float = 0., **kwargs):
+        self.init_stub(latency)
+
+    def perform_module_function(self, image: Image.Image) -> Boxes:
+        return self.random_boxes(self.rng(image), image.size)
+
+
+class StubVQA(StubMixin, VQA):
+    yes_no_pattern = re.compile(r'^\s*(is|are|does|do|did|can|was|were|has|have)\b', re.IGNORECASE)
+    count_pattern = re.compile(r'^\s*how many\b', re.IGNORECASE)
+    labels = ('red', 'blue', 'white', 'dog', 'cat', 'table', 'left', 'right')
+
+    def __init__(self, latency: float = 0., cast_from_string: bool = False, **kwargs):
+        self.init_stub(latency)
+        self.cast_from_string = cast_from_string
+        self.cascade_threshold = None
+
+    def perform_module_function(self, image: Image.Image, question: str) -> Union[str, int, bool]:
+        rng = self.rng(image, question)
+        if self.yes_no_pattern.match(question):
+            label = 'yes' if rng.random() < 0.5 else 'no'
+        elif self.count_pattern.match(question):
+            label = str(rng.integers(0, 5))
+        else:
+            label = self.labels[rng.integers(len(self.labels))]
+
+        if self.cast_from_string:
+            if self.true_pattern.match(label):
+                return True
+            if self.false_pattern.match(label):
+                return False
+            if self.int_pattern.match(label):
+                return int(label)
+        return label
+
+
+class StubSelect(StubMixin, Select):
+
+    def __init__(self, category_id_to_name: Dict[int, str], category_name_to_id: Dict[str, int],
+                 latency: float = 0., pack_masks: bool = False, **kwargs):
+        self.init_stub(latency)
+        self.pack_masks = pack_masks
+        self.category_id_to_name = category_id_to_name
+        self.category_name_to_id = {}
+        for k, v in category_name_to_id.items():
+            for key in k.split(', '):
+                self.category_name_to_id[key] = v
+
+    def perform_module_function(self, image: Image.Image, object: Union[np.ndarray, PackedMask, Boxes], query: str,
+                                category: Optional[str] = None) -> Union[Mask, PackedMask, Boxes]:
+        if isinstance(object, PackedMask):
+            object = object.to_mask()
+        seg_map, category_ids = self.get_seg_map_and_category_ids(image, object, category)
+        queries = query.split(',')
+        rng = self.rng(image, seg_map, query, category)
+        best_index_per_query = rng.integers(0, len(category_ids), len(queries))
+        if isinstance(object, np.ndarray):
+            return self.mask_output(np.isin(seg_map, [category_ids[i] for i in best_index_per_query]))
+        return Boxes.from_any(object)[best_index_per_query - 1]
+
+
+class StubSeg(StubMixin, Seg):
+    grid_size = 4
+
+    def __init__(self, latency: float = 0., num_labels: int = 150, incremental: bool = False,
+                 incremental_padding: int = 64, incremental_max_fraction: float = 0.5, label_map_cache_size: int = 8,
+                 **kwargs):
+        self.init_stub(latency)
+        self.num_labels = num_labels
+        self.incremental = incremental
+        self.incremental_padding = incremental_padding
+        self.incremental_max_fraction = incremental_max_fraction
+        self.label_maps = LRUCache(label_map_cache_size)
+        self.incremental_stats = Counter()
+
+    def segment(self, image: Image.Image) -> np.ndarray:
+        """ A label map of grid_size x grid_size blocks with labels derived from the image """
+        rng = self.rng(image)
+        cell_labels = rng.integers(0, self.num_labels, (self.grid_size, self.grid_size))
+        return self.upsample_label_map(cell_labels, image.size)
+
+
+class StubReplace(StubMixin, Replace):
+
+    def __init__(self, latency: float = 0., **kwargs):
+        self.init_stub(latency)
+
+    def perform_module_function(self, image: Image.Image, object: Union[np.ndarray, PackedMask, Boxes], prompt: str
+                                ) -> Image.Image:
+        """ Fill the object with a flat color derived from the prompt """
+        image = as_pil(image)
+        color = self.rng(prompt).integers(0, 256, 3, dtype=np.uint8)
+        image_array = np.array(image)
+        seg_map = self.get_seg_map(image, object) > 0
+        image_array[seg_map] = color
+        return self.record_edit(Image.fromarray(image_array), image, self.get_edited_box(seg_map, 0))
+
+    def replace_batch(self, requests: List[Tuple[Image.Image, Union[np.ndarray, PackedMask, Boxes], str]]
+                      ) -> List[Image.Image]:
+        return [self.perform_module_function(image, object, prompt) for image, object, prompt in requests]
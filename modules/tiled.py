@@ -0,0 +1,261 @@
+import os
+import struct
+import tempfile
+import weakref
+import zlib
+from typing import Any, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from modules.image_buffer import DeferredImage, ImageBuffer, as_pil
+from modules.regions import Boxes, PackedMask, ScaledMask
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class TiledImage:
+    """ An RGB image kept in an .npy file on disk and processed in horizontal strips of rows.
+
+    Strips are read with plain file reads rather than a memory map, so the memory an operation on a tiled image
+    needs is bounded by the strip size and not by the image size. Operations write their output strip by strip to
+    a new temporary tiled image next to their input, which is deleted when it is garbage collected.
+
+    Model-backed modules run on a proxy of the image downscaled to proxy_size, see VisProgModule.runs_on_proxy.
+    The proxy is made once per image, so all the modules of a program see the same proxy.
+    """
+
+    def __init__(self, path: str, strip_height: int = 256, temporary: bool = False, proxy_size: int = 1024,
+                 source: Optional[str] = None):
+        self.path = path
+        self.strip_height = strip_height
+        self.proxy_size = proxy_size
+        # the compressed image the tiled image was decoded from, JPEG proxies are decoded from it at reduced scale
+        self.source = source
+        self._proxy = None
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            self.offset = f.tell()
+        if len(shape) != 3 or shape[2] != 3 or dtype != np.uint8 or fortran_order:
+            raise ValueError(f'{path} is not a C-ordered (H, W, 3) uint8 array')
+        self.shape = shape
+        self.temporary = temporary
+        if temporary:
+            weakref.finalize(self, remove_file, path)
+
+    @classmethod
+    def create(cls, size: Tuple[int, int], path: Optional[str] = None, directory: Optional[str] = None,
+               strip_height: int = 256, proxy_size: int = 1024) -> 'StripWriter':
+        """ Start writing a new tiled image of size (width, height), a temporary one if path is None """
+        temporary = path is None
+        if temporary:
+            handle, path = tempfile.mkstemp(suffix='.npy', prefix='tiled-', dir=directory)
+            os.close(handle)
+        return StripWriter(path, size, strip_height, temporary, proxy_size)
+
+    def create_like(self, size: Optional[Tuple[int, int]] = None) -> 'StripWriter':
+        """ Start writing a temporary tiled image in the directory of this one, by default of the same size """
+        return self.create(size or self.size, directory=os.path.dirname(os.path.abspath(self.path)),
+                           strip_height=self.strip_height, proxy_size=self.proxy_size)
+
+    @classmethod
+    def from_pil(cls, image: Image.Image, path: Optional[str] = None, strip_height: int = 256,
+                 proxy_size: int = 1024) -> 'TiledImage':
+        """ Store an image as a tiled image, PIL decodes the image once but no other full size copy is made """
+        writer = cls.create(image.size, path, strip_height=strip_height, proxy_size=proxy_size)
+        for y1 in range(0, image.height, strip_height):
+            y2 = min(y1 + strip_height, image.height)
+            writer.write(np.asarray(image.crop((0, y1, image.width, y2)).convert('RGB')))
+        return writer.finish()
+
+    @classmethod
+    def from_file(cls, image_path: str, strip_height: int = 256, proxy_size: int = 1024) -> 'TiledImage':
+        """ Open an .npy tiled image in place, or store a compressed image as a temporary tiled image
+
+        PIL has to decode a compressed image in full once, so only .npy inputs, e.g. saved from an earlier run,
+        are processed without ever holding the whole image in memory.
+        """
+        if image_path.endswith('.npy'):
+            return cls(image_path, strip_height, proxy_size=proxy_size)
+        with Image.open(image_path) as image:
+            tiled = cls.from_pil(image, strip_height=strip_height, proxy_size=proxy_size)
+        tiled.source = image_path
+        return tiled
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.shape[1], self.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.shape[0]
+
+    def strips(self) -> Iterator[Tuple[int, int]]:
+        """ The row ranges (y1, y2) of the strips """
+        for y1 in range(0, self.height, self.strip_height):
+            yield y1, min(y1 + self.strip_height, self.height)
+
+    def read_rows(self, y1: int, y2: int) -> np.ndarray:
+        """ Read the (y2 - y1, W, 3) pixels of the rows y1 to y2, clipped to the image """
+        y1, y2 = max(y1, 0), min(y2, self.height)
+        row_size = self.width * 3
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset + y1 * row_size)
+            rows = np.fromfile(f, dtype=np.uint8, count=max(y2 - y1, 0) * row_size)
+        return rows.reshape(-1, self.width, 3)
+
+    def crop(self, box: Sequence[float]) -> 'TiledImage':
+        """ Crop the box (x1, y1, x2, y2), rounded to pixels and padded with black outside the image like PIL """
+        x1, y1, x2, y2 = (int(round(value)) for value in box)
+        writer = self.create_like((x2 - x1, y2 - y1))
+        for strip_y1 in range(y1, y2, self.strip_height):
+            strip_y2 = min(strip_y1 + self.strip_height, y2)
+            rows_y1 = min(max(strip_y1, 0), self.height)
+            rows = self.read_rows(rows_y1, strip_y2)
+            writer.write(ImageBuffer.crop_array(rows, (x1, strip_y1 - rows_y1, x2, strip_y2 - rows_y1)))
+        return writer.finish()
+
+    @property
+    def proxy_shape(self) -> Tuple[int, int]:
+        """ The (height, width) of the proxy """
+        scale = min(1., self.proxy_size / max(self.size))
+        return max(1, round(self.height * scale)), max(1, round(self.width * scale))
+
+    def proxy(self) -> Image.Image:
+        """ The image downscaled so that its longest side is at most proxy_size """
+        if self._proxy is None:
+            self._proxy = self.make_proxy()
+        return self._proxy
+
+    def make_proxy(self) -> Image.Image:
+        """ Decode a JPEG source at a reduced scale with Image.draft, or box filter the strips of the tiled image
+            one band of proxy rows at a time
+        """
+        proxy_height, proxy_width = self.proxy_shape
+        if self.source is not None:
+            with Image.open(self.source) as image:
+                if image.format == 'JPEG' and image.size == self.size:
+                    image.draft('RGB', (proxy_width, proxy_height))
+                    return image.convert('RGB').resize((proxy_width, proxy_height), Image.BOX)
+
+        proxy = np.empty((proxy_height, proxy_width, 3), dtype=np.uint8)
+        band_height = max(1, self.strip_height * proxy_height // self.height)
+        for band_y1 in range(0, proxy_height, band_height):
+            band_y2 = min(band_y1 + band_height, proxy_height)
+            # the rows of the image the band covers, the first and last ones possibly in part
+            y1, y2 = band_y1 * self.height / proxy_height, band_y2 * self.height / proxy_height
+            rows_y1 = int(y1)
+            rows = Image.fromarray(self.read_rows(rows_y1, int(np.ceil(y2))))
+            proxy[band_y1:band_y2] = np.asarray(rows.resize((proxy_width, band_y2 - band_y1), Image.BOX,
+                                                            box=(0, y1 - rows_y1, self.width, y2 - rows_y1)))
+        return Image.fromarray(proxy)
+
+    def to_pil(self) -> Image.Image:
+        """ Decode the whole image, only for images that fit in memory """
+        return Image.fromarray(self.read_rows(0, self.height))
+
+    def save_png(self, path: str, compression: int = 6):
+        """ Encode the image as an RGB PNG strip by strip, compressing the rows as they are read """
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+        compressor = zlib.compressobj(compression)
+        with open(path, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0)))
+            for y1, y2 in self.strips():
+                rows = self.read_rows(y1, y2).reshape(y2 - y1, -1)
+                # every row starts with its filter type, 0 leaves the row unfiltered
+                scanlines = np.concatenate([np.zeros((y2 - y1, 1), dtype=np.uint8), rows], axis=1)
+                data = compressor.compress(scanlines.tobytes())
+                if data:
+                    f.write(chunk(b'IDAT', data))
+            f.write(chunk(b'IDAT', compressor.flush()))
+            f.write(chunk(b'IEND', b''))
+
+    def __repr__(self) -> str:
+        return f'TiledImage({self.path!r}, size={self.size})'
+
+
+class StripWriter:
+    """ Appends strips of rows to the .npy file of a new tiled image """
+
+    def __init__(self, path: str, size: Tuple[int, int], strip_height: int = 256, temporary: bool = False,
+                 proxy_size: int = 1024):
+        self.path = path
+        self.size = size
+        self.strip_height = strip_height
+        self.temporary = temporary
+        self.proxy_size = proxy_size
+        self.rows = 0
+        self.file = open(path, 'wb')
+        width, height = size
+        np.lib.format.write_array_header_1_0(self.file, {'descr': '|u1', 'fortran_order': False,
+                                                         'shape': (height, width, 3)})
+        # an unfinished temporary image is deleted with its writer
+        self.finalizer = weakref.finalize(self, remove_file, path) if temporary else None
+
+    def write(self, rows: np.ndarray):
+        if rows.shape[1:] != (self.size[0], 3):
+            raise ValueError(f'Expected rows of shape (N, {self.size[0]}, 3), got {rows.shape}')
+        np.ascontiguousarray(rows, dtype=np.uint8).tofile(self.file)
+        self.rows += len(rows)
+
+    def finish(self) -> TiledImage:
+        self.file.close()
+        if self.rows != self.size[1]:
+            raise ValueError(f'Wrote {self.rows} rows of an image of height {self.size[1]}')
+        if self.finalizer is not None:
+            self.finalizer.detach()
+        return TiledImage(self.path, self.strip_height, temporary=self.temporary, proxy_size=self.proxy_size)
+
+
+def mask_rows(object: Union[np.ndarray, PackedMask, ScaledMask, Boxes, Sequence[Sequence[float]]],
+              size: Tuple[int, int], y1: int, y2: int) -> np.ndarray:
+    """ The boolean rows y1 to y2 of the mask of a mask, packed or scaled mask or boxes for an image of size
+        (width, height)
+    """
+    if isinstance(object, (PackedMask, ScaledMask)):
+        return object.rows(y1, y2).astype(bool, copy=False)
+    if isinstance(object, np.ndarray):
+        return np.asarray(object[y1:y2]).astype(bool, copy=False)
+    return np.asarray(Boxes.from_any(object).translate(0, -y1).rasterize((size[0], y2 - y1)))
+
+
+def to_proxy(value: Any, size: Tuple[int, int], proxy_size: Tuple[int, int]) -> Any:
+    """ Map a step input from a tiled image of size (width, height) to its proxy of proxy_size: boxes are scaled and
+        masks and label maps resampled, other values are returned unchanged
+    """
+    proxy_shape = proxy_size[::-1]
+    if isinstance(value, ScaledMask):
+        return value.mask if value.mask.shape == proxy_shape else value.resized(proxy_shape).to_mask()
+    if isinstance(value, PackedMask) and value.shape == size[::-1]:
+        return ScaledMask(value, proxy_shape).to_mask()
+    if isinstance(value, np.ndarray) and value.shape == size[::-1]:
+        return ScaledMask(value, proxy_shape).to_mask()
+    if isinstance(value, Boxes):
+        return value.scale(proxy_size[0] / size[0], proxy_size[1] / size[1])
+    return value
+
+
+def displayable(value: Any) -> Any:
+    """ A value of the step details as it is shown, see ProgramResult.rendered_details. Modules keep buffers and
+        deferred images in their html so that crops are not copied during a run, they become PIL images here, also
+        inside lists and tuples. Tiled images are shown by reference and never decoded, other values are unchanged
+    """
+    if isinstance(value, (list, tuple)):
+        return type(value)(displayable(item) for item in value)
+    return value if isinstance(value, TiledImage) else as_pil(value)
@@ -2,6 +2,13 @@ import re
 from typing import Any, Dict, Optional, Tuple
 
 from dataclasses import dataclass, field
+from PIL import Image
+
+from modules.buffer_pool import BufferPool
+from modules.caching import InferenceCache, fingerprint
+from modules.image_buffer import ImageBuffer, as_pil
+from modules.near_duplicates import NearDuplicateCache
+from modules.tiled import TiledImage, to_proxy
 
 
 @dataclass
@@ -21,7 +28,15 @@ class ExecutionError(Exception):
 
 class VisProgModule:
     pattern: re.Pattern[str]
-    
+    inference_cache: Optional[InferenceCache] = None
+    near_duplicates: Optional[NearDuplicateCache] = None
+    # scratch arrays shared by all modules, BufferPool.attach gives modules their own pool
+    buffer_pool: BufferPool = BufferPool()
+    # modules that handle ImageBuffer inputs themselves, the others receive the buffers' PIL images
+    accepts_image_buffers: bool = False
+    # modules that run on the downscaled proxy of a TiledImage input, their outputs are mapped back with rescale_output
+    runs_on_proxy: bool = False
+
     def __init__(self):
         """ Load a trained model, move it to gpu, etc. """
         pass
@@ -76,6 +91,50 @@ class VisProgModule:
 
         pass
 
+    def cache_identity(self) -> Optional[tuple]:
+        """ Identify the model and configuration behind perform_module_function for the inference cache
+
+        Returns
+        -------
+        Optional[tuple]
+            The model id, revision and configuration, or None if the outputs must not be cached
+        """
+        return None
+
+    def perform_cached(self, **inputs) -> Any:
+        """ Call perform_module_function, looking the output up in the inference cache if there is one """
+        identity = self.cache_identity() if self.inference_cache is not None else None
+        if identity is None:
+            return self.perform_module_function(**inputs)
+
+        key = fingerprint(type(self).__name__, *identity,
+                          *(value for name in sorted(inputs) for value in (name, inputs[name])))
+        output = self.inference_cache.get(key)
+        if output is None:
+            output = self.perform_module_function(**inputs)
+            self.inference_cache.put(key, output)
+        return output
+
+    def rescale_output(self, output: Any, from_size: Tuple[int, int], to_size: Tuple[int, int]) -> Any:
+        """ Map an output computed on an image of from_size to a near-duplicate image, or the tiled image a proxy
+            was made from, of to_size
+        """
+        return output
+
+    def outputs_agree(self, output: Any, exact_output: Any) -> bool:
+        """ Whether an output reused from a near-duplicate image agrees with the exact output """
+        return output == exact_output
+
+    def perform(self, **inputs) -> Any:
+        """ Call perform_cached, reusing the output of a near-duplicate image if near_duplicates is set """
+        image = inputs.get('image')
+        if self.near_duplicates is None or not isinstance(image, (ImageBuffer, Image.Image)):
+            return self.perform_cached(**inputs)
+
+        query = (type(self).__name__, *sorted((name, value) for name, value in inputs.items() if name != 'image'))
+        return self.near_duplicates.reuse(as_pil(image), query, lambda: self.perform_cached(**inputs),
+                                          transform=self.rescale_output, agree=self.outputs_agree)
+
     def match(self, step: str) -> Optional[re.Match[str]]:
         """ Match the step to the pattern and return the match object
 
@@ -103,10 +162,17 @@ class VisProgModule:
         for input_name, var_name in parsed_step.input_var_names.items():
             if var_name not in state:
                 raise ExecutionError(step, f"Variable {var_name} not found in state")
-            inputs[input_name] = state[var_name]
+            value = state[var_name]
+            if isinstance(value, ImageBuffer) and not self.accepts_image_buffers:
+                value = value.pil
+            inputs[input_name] = value
+
+        image = inputs.get('image')
+        if self.runs_on_proxy and isinstance(image, TiledImage):
+            return self.execute_on_proxy(parsed_step, state, inputs)
 
         # Perform computation using the loaded module
-        output = self.perform_module_function(**inputs)
+        output = self.perform(**inputs)
 
         # Update state
         state[parsed_step.output_var_name] = output
@@ -115,4 +181,18 @@ class VisProgModule:
 
         return output, step_html
 
+    def execute_on_proxy(self, parsed_step: ParsedStep, state: dict, inputs: Dict[str, Any]
+                         ) -> Tuple[Any, Dict[str, Any]]:
+        """ Perform the step on the proxy of a tiled image, with the other inputs mapped to the proxy, and map the
+            output back to the size of the tiled image. The html shows the step on the proxy
+        """
+        image = inputs['image']
+        proxy = image.proxy()
+        proxy_inputs = {name: to_proxy(value, image.size, proxy.size) for name, value in inputs.items()}
+        proxy_inputs['image'] = proxy
+        proxy_output = self.perform(**proxy_inputs)
+        output = self.rescale_output(proxy_output, proxy.size, image.size)
+        state[parsed_step.output_var_name] = output
+        return output, self.html(proxy_output, **proxy_inputs)
+
 
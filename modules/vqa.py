@@ -1,9 +1,18 @@
 import re
-from typing import Any, Dict, Optional, Tuple
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from PIL import Image
-from transformers import ViltProcessor, ViltForQuestionAnswering
-
+import torch
+from transformers import BatchEncoding, ViltProcessor, ViltForQuestionAnswering
+
+from modules.compilation import pad_pixels_to_bucket
+from modules.image_buffer import ImageBuffer, as_array, as_pil
+from modules.inference_policy import InferencePolicy
+from modules.model_loading import load_model, model_revision
+from modules.model_store import ModelStore, from_pretrained
+from modules.onnx_backend import example_image
+from modules.preprocessing import FastImagePreprocessor
 from modules.visprog_module import VisProgModule, ParsedStep, ExecutionError
 
 
@@ -14,14 +23,63 @@ class VQA(VisProgModule):
     int_pattern = re.compile(r'^\d+$')
     true_pattern = re.compile(r'(yes|true)', re.IGNORECASE)
     false_pattern = re.compile(r'(no|false)', re.IGNORECASE)
+    model_name = "dandelin/vilt-b32-finetuned-vqa"
+    # crops stay views, pixels are only converted for the processor that needs them
+    accepts_image_buffers = True
+    # tiled images are analysed on their downscaled proxy
+    runs_on_proxy = True
+
+    def __init__(self, device: str = "cpu", cast_from_string: bool = False, policy: Optional[InferencePolicy] = None,
+                 quantize: bool = False, backend: str = "torch", compile: bool = False,
+                 store: Optional[ModelStore] = None, cascade_threshold: Optional[float] = None,
+                 cascade_shortest_edge: Optional[int] = 192, cascade_quantize: bool = False,
+                 fast_preprocessing: bool = False):
+        """
+        Parameters
+        ----------
+        cascade_threshold : Optional[float]
+            If given, a cheaper first stage answers first and the full model only runs when the softmax margin
+            between the two most likely answers of the first stage is below this threshold
+
+        cascade_shortest_edge : Optional[int]
+            The shortest image edge of the first stage, the processor default (384) if None
 
-    def __init__(self, device: str = "cpu", cast_from_string: bool = False):
+        cascade_quantize : bool
+            Whether the first stage uses a dynamically INT8 quantized copy of the model
+
+        fast_preprocessing : bool
+            Whether to preprocess images with the vectorized FastImagePreprocessor instead of the ViLT processor
+        """
         super().__init__()
-        self.processor = ViltProcessor.from_pretrained("dandelin/vilt-b32-finetuned-vqa")
-        self.model = ViltForQuestionAnswering.from_pretrained("dandelin/vilt-b32-finetuned-vqa")
-        self.model = self.model.to(device)
+        self.policy = policy or InferencePolicy()
+        self.processor = from_pretrained(ViltProcessor, self.model_name, store)
+        self.fast_image_processor = FastImagePreprocessor(self.processor.image_processor) if fast_preprocessing \
+            else None
+        self.model = load_model(ViltForQuestionAnswering, self.model_name, device=device, policy=self.policy,
+                                quantize=quantize, backend=backend, output_names=('logits',), compile=compile,
+                                store=store, example_inputs=self.example_inputs)
+        self.compile = compile
+        self.quantize = quantize
+        self.backend = backend
         self.device = device
         self.cast_from_string = cast_from_string
+        self.cascade_threshold = cascade_threshold
+        self.cascade_shortest_edge = cascade_shortest_edge
+        self.cascade_model = self.model
+        if cascade_threshold is not None and cascade_quantize and not quantize:
+            self.cascade_model = load_model(ViltForQuestionAnswering, self.model_name, device=device,
+                                            policy=self.policy, quantize=True, store=store)
+        self.cascade_stats = Counter()
+
+    def example_inputs(self) -> List[BatchEncoding]:
+        """ Processor outputs with different image sizes, aspect ratios and question lengths to export the model
+            with, the second at the shortest edge of the cascade's first stage
+        """
+        encoding = self.processor.tokenizer("Is it sunny?", return_tensors="pt")
+        encoding.update(self.processor.image_processor(example_image(360, 540, seed=1), size={"shortest_edge": 192},
+                                                       return_tensors="pt"))
+        return [self.processor(example_image(640, 480), "What color is the car on the left?", return_tensors="pt"),
+                encoding]
 
     def parse(self, match: re.Match[str], step: str) -> ParsedStep:
         """ Parse step and return list of input values/variable names
@@ -48,12 +106,12 @@ class VQA(VisProgModule):
                               'image': match.group('image')
                           })
 
-    def perform_module_function(self, image: Image.Image, question: str) -> str:
+    def perform_module_function(self, image: Union[ImageBuffer, Image.Image], question: str) -> str:
         """ Perform the color pop operation on the image using the object mask
 
         Parameters
         ----------
-        image : Image.Image
+        image : Union[ImageBuffer, Image.Image]
             The original image
 
         question : str
@@ -64,10 +122,41 @@ class VQA(VisProgModule):
         Tuple[str,...]
             The answer to the question
         """
-        encoding = self.processor(image, question, return_tensors="pt").to(self.device)
-        outputs = self.model(**encoding)
-        logits = outputs.logits
-        idx = logits.argmax(-1).item()
+        if self.cascade_threshold is not None:
+            logits = self.predict(self.cascade_model, self.encode(image, question, self.cascade_shortest_edge))
+            top_probabilities = logits.float().softmax(-1).topk(2, dim=-1).values[0]
+            if top_probabilities[0] - top_probabilities[1] >= self.cascade_threshold:
+                self.cascade_stats['first_stage'] += 1
+                return self.to_answer(logits.argmax(-1).item())
+            self.cascade_stats['second_stage'] += 1
+
+        logits = self.predict(self.model, self.encode(image, question))
+        return self.to_answer(logits.argmax(-1).item())
+
+    def encode(self, image: Union[ImageBuffer, Image.Image], question: str,
+               shortest_edge: Optional[int] = None) -> BatchEncoding:
+        """ Encode the image and question, resizing the image to shortest_edge if given """
+        # bucket the input shapes so that a compiled model is not recompiled for every image and question
+        text_kwargs = dict(padding="max_length", truncation=True,
+                           max_length=self.model.config.max_position_embeddings) if self.compile else {}
+        if self.fast_image_processor is not None:
+            encoding = self.processor.tokenizer(question, return_tensors="pt", **text_kwargs)
+            encoding.update(self.fast_image_processor([as_array(image)], shortest_edge=shortest_edge))
+        elif shortest_edge is None:
+            encoding = self.processor(as_pil(image), question, return_tensors="pt", **text_kwargs)
+        else:
+            encoding = self.processor.tokenizer(question, return_tensors="pt", **text_kwargs)
+            encoding.update(self.processor.image_processor(as_pil(image), size={"shortest_edge": shortest_edge},
+                                                           return_tensors="pt"))
+        if self.compile:
+            encoding = pad_pixels_to_bucket(encoding)
+        return encoding.to(self.device)
+
+    def predict(self, model: Any, encoding: BatchEncoding) -> torch.Tensor:
+        with self.policy.inference(self.device):
+            return model(**encoding).logits
+
+    def to_answer(self, idx: int) -> Union[str, int, bool]:
         label = self.model.config.id2label[idx]
         if self.cast_from_string:
             if self.true_pattern.match(label):
@@ -78,13 +167,24 @@ class VQA(VisProgModule):
                 return int(label)
         return label
 
+    def cache_identity(self) -> Optional[tuple]:
+        return (self.model_name, model_revision(self.model), self.cast_from_string, self.quantize, self.backend,
+                self.policy.bfloat16, self.cascade_threshold, self.cascade_shortest_edge,
+                self.cascade_model is not self.model, self.fast_image_processor is not None)
+
+    def cascade_hit_rates(self) -> Dict[str, float]:
+        """ The fraction of questions answered by each cascade stage """
+        total = sum(self.cascade_stats.values())
+        return {stage: self.cascade_stats[stage] / total if total else 0.
+                for stage in ('first_stage', 'second_stage')}
+
     def execute(self, step: str, state: dict, match: Optional[re.Match[str]] = None) -> Tuple[Any, Dict[str, Any]]:
         try:
             return super().execute(step, state, match)
         except RuntimeError as e:
             raise ExecutionError(step, f'Runtime error: {e}')
 
-    def html(self, output: str, image: Image.Image, question: str) -> Dict[str, Any]:
+    def html(self, output: str, image: Union[ImageBuffer, Image.Image], question: str) -> Dict[str, Any]:
         """ Generate HTML to display the output
 
         Parameters
@@ -2,7 +2,7 @@ import argparse
 import os
 import time
 import traceback
-from typing import Any, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import pudb
 import yaml
@@ -10,8 +10,13 @@ from PIL import Image
 from tqdm import tqdm
 
 from modules import (VQA, Count, Crop, CropAbove, CropBelow, CropLeft,
-                     CropRight, Eval, ExecutionError, Loc, Result)
-from visprog import ProgramRunner
+                     CropRight, Eval, ExecutionError, InferencePolicy, Loc,
+                     Result, VisProgModule)
+from modules.caching import InferenceCache
+from modules.near_duplicates import NearDuplicateCache
+from modules.model_store import ModelStore, load_snapshot, save_snapshot
+from modules.stubs import StubLoc, StubVQA
+from visprog import ProgramRunner, render_step_details
 
 
 def do_gqa(
@@ -26,7 +31,7 @@ def do_gqa(
     try:
         steps, result = program_runner.execute_program(program, initial_state)
     except ExecutionError as e:
-        return None, [d.get("output", None) for d in e.previous_step_details], e.error
+        return None, [d.get("output", None) for d in render_step_details(e.previous_step_details)], e.error
     if not isinstance(result.output, dict):
         return (
             None,
@@ -38,7 +43,7 @@ def do_gqa(
 
     print("===== Visprog PREDICTION =====: ", prediction)
 
-    step_details = [d.get("output", None) for d in result.step_details[:-1]]
+    step_details = [d.get("output", None) for d in result.rendered_details()[:-1]]
 
     return prediction, step_details, None
 
@@ -97,6 +102,76 @@ def write_gqa_results(
         print(f"Done writing GQA results for statement {i} program {j}")
 
 
+# the arguments build_modules reads, a snapshot built with other values is rebuilt
+SNAPSHOT_ARGS = ("device", "policy", "threads", "quantize", "backend", "compile", "vqa_cascade_threshold",
+                 "vqa_cascade_quantize", "fast_preprocessing", "loc_crop_reuse", "stub", "stub_latency",
+                 "model_store")
+
+
+def snapshot_args(args: argparse.Namespace) -> Dict[str, Any]:
+    return {name: getattr(args, name) for name in SNAPSHOT_ARGS}
+
+
+def build_modules(args: argparse.Namespace) -> List[VisProgModule]:
+    if args.stub:
+        loc_module = StubLoc(latency=args.stub_latency)
+        vqa = StubVQA(latency=args.stub_latency, cast_from_string=True)
+    else:
+        loc_module, vqa = build_model_modules(args)
+
+    # Define modules based on what is given in the in-context examples for GQA
+    crop = Crop()
+    crop_right = CropRight()
+    crop_left = CropLeft()
+    crop_above = CropAbove()
+    crop_below = CropBelow()
+    count = Count()
+    _eval = Eval()
+    result = Result()
+
+    modules = [
+        loc_module,
+        crop,
+        crop_right,
+        crop_left,
+        crop_above,
+        crop_below,
+        count,
+        _eval,
+        result,
+        vqa,
+    ]
+    return modules
+
+
+def build_model_modules(args: argparse.Namespace) -> Tuple[Loc, VQA]:
+    policy = InferencePolicy.from_name(args.policy, num_threads=args.threads)
+    store = ModelStore(args.model_store) if args.model_store is not None else None
+    loc_module = Loc(
+        device=args.device,
+        policy=policy,
+        quantize=args.quantize,
+        backend=args.backend,
+        compile=args.compile,
+        store=store,
+        fast_preprocessing=args.fast_preprocessing,
+        crop_reuse=args.loc_crop_reuse,
+    )
+    vqa = VQA(
+        device=args.device,
+        cast_from_string=True,
+        policy=policy,
+        quantize=args.quantize,
+        backend=args.backend,
+        compile=args.compile,
+        store=store,
+        cascade_threshold=args.vqa_cascade_threshold,
+        cascade_quantize=args.vqa_cascade_quantize,
+        fast_preprocessing=args.fast_preprocessing,
+    )
+    return loc_module, vqa
+
+
 def main():
 
     print("Running GQA programs")
@@ -110,6 +185,110 @@ def main():
         type=str,
         default="cpu",
     )
+    parser.add_argument(
+        "--policy",
+        type=str,
+        choices=sorted(InferencePolicy.presets),
+        default="default",
+        help="inference policy shared by all model-backed modules",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="number of torch intra-op threads",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="use dynamically INT8 quantized models (cpu only)",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["torch", "onnx"],
+        default="torch",
+        help="execution backend of the model-backed modules",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="wrap the models in torch.compile with a persistent compile cache",
+    )
+    parser.add_argument(
+        "--vqa-cascade-threshold",
+        type=float,
+        default=None,
+        help="answer VQA with a cheaper first stage unless its softmax margin is below this threshold",
+    )
+    parser.add_argument(
+        "--vqa-cascade-quantize",
+        action="store_true",
+        help="use a quantized model as the VQA cascade first stage",
+    )
+    parser.add_argument(
+        "--fast-preprocessing",
+        action="store_true",
+        help="preprocess images with vectorized torch ops instead of the Hugging Face processors",
+    )
+    parser.add_argument(
+        "--loc-crop-reuse",
+        action="store_true",
+        help="locate objects in crops from the cached patch features of the image they were cropped from",
+    )
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="use deterministic stub models that load no weights, to benchmark the rest of the pipeline",
+    )
+    parser.add_argument(
+        "--stub-latency",
+        type=float,
+        default=0.0,
+        help="synthetic latency in seconds of every stub model call",
+    )
+    parser.add_argument(
+        "--model-store",
+        type=str,
+        default=None,
+        help="load models offline from this local model store directory",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        default=None,
+        help="load the initialized modules from this file, creating it on the first run",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="persistent inference cache database shared across runs and processes",
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        type=int,
+        default=1024,
+        help="size limit of the persistent inference cache",
+    )
+    parser.add_argument(
+        "--near-duplicate-distance",
+        type=int,
+        default=None,
+        help="reuse LOC and VQA outputs for images whose perceptual hashes differ by at most this many bits",
+    )
+    parser.add_argument(
+        "--near-duplicate-verify-every",
+        type=int,
+        default=None,
+        help="also run every N-th reused LOC or VQA step exactly and report the agreement rate",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="only run the first LIMIT statements",
+    )
     parser.add_argument(
         "images_dir",
         type=str,
@@ -125,30 +304,28 @@ def main():
 
     args = parser.parse_args()
 
-    # Define modules based on what is given in the in-context examples for GQA
-    loc_module = Loc()
-    crop = Crop()
-    crop_right = CropRight()
-    crop_left = CropLeft()
-    crop_above = CropAbove()
-    crop_below = CropBelow()
-    count = Count()
-    _eval = Eval()
-    result = Result()
-    vqa = VQA(device=args.device, cast_from_string=True)
-
-    modules = [
-        loc_module,
-        crop,
-        crop_right,
-        crop_left,
-        crop_above,
-        crop_below,
-        count,
-        _eval,
-        result,
-        vqa,
-    ]
+    if args.snapshot is not None and (args.backend != "torch" or args.compile):
+        parser.error("--snapshot only supports the torch backend without --compile")
+    if args.backend == "onnx" and InferencePolicy.presets[args.policy].get("bfloat16"):
+        parser.error("the onnx backend runs in float32 and does not support bfloat16 policies")
+    if (args.quantize or args.vqa_cascade_quantize) and InferencePolicy.presets[args.policy].get("bfloat16"):
+        parser.error("quantized models run in float32 and do not support bfloat16 policies")
+
+    modules = None
+    if args.snapshot is not None and os.path.exists(args.snapshot):
+        modules = load_snapshot(args.snapshot, snapshot_args(args))
+        if modules is None:
+            print(f"Rebuilding the snapshot {args.snapshot}")
+    if modules is None:
+        modules = build_modules(args)
+        if args.snapshot is not None:
+            save_snapshot(modules, args.snapshot, snapshot_args(args))
+
+    if args.cache is not None:
+        InferenceCache(args.cache, max_size_bytes=args.cache_size_mb * 2 ** 20).attach(modules)
+    if args.near_duplicate_distance is not None:
+        near_duplicates = NearDuplicateCache(args.near_duplicate_distance, args.near_duplicate_verify_every)
+        near_duplicates.attach([module for module in modules if isinstance(module, (Loc, VQA))])
 
     # Pass modules to the program runner
     program_runner = ProgramRunner(modules)
@@ -156,6 +333,7 @@ def main():
     # Open the json file containing the chat-gpt generated programs
     with open(args.input_file, "r") as f:
         statement_details = yaml.safe_load(f)
+    statement_details = statement_details[:args.limit]
 
     # Make sure the output directory / file exists
     os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
@@ -186,6 +364,15 @@ def main():
             except:
                 continue
 
+    vqa = next(module for module in modules if isinstance(module, VQA))
+    if vqa.cascade_threshold is not None:
+        print(f"VQA cascade hit rates: {vqa.cascade_hit_rates()}")
+    loc_module = next(module for module in modules if isinstance(module, Loc))
+    if getattr(loc_module, "crop_reuse", False):
+        print(f"LOC crop reuse: {dict(loc_module.crop_stats)}")
+    if args.near_duplicate_distance is not None:
+        print(f"Near-duplicate reuse: {near_duplicates.report()}")
+
 
 if __name__ == "__main__":
     try:
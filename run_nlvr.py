@@ -5,14 +5,19 @@ import threading
 import time
 import traceback
 from queue import Queue
-from typing import Optional, Tuple, List, Any
+from typing import Optional, Tuple, List, Any, Dict
 
 import yaml
 from PIL import Image
 from tqdm import tqdm
 
-from modules import VQA, Eval, Result, ExecutionError
-from visprog import ProgramRunner
+from modules import VQA, Eval, Result, ExecutionError, InferencePolicy, VisProgModule
+from modules.caching import InferenceCache
+from modules.near_duplicates import NearDuplicateCache
+from modules.regions import encode_region
+from modules.model_store import ModelStore, load_snapshot, save_snapshot
+from modules.stubs import StubVQA
+from visprog import ProgramRunner, render_step_details
 
 
 object_lock = threading.Lock()
@@ -27,11 +32,12 @@ def do_nlvr(program_runner: ProgramRunner, program: str,
     try:
         steps, result = program_runner.execute_program(program, initial_state)
     except ExecutionError as e:
-        return None, [d.get('output', None) for d in e.previous_step_details], e.error
+        step_details = render_step_details(e.previous_step_details)
+        return None, [encode_region(d.get('output', None)) for d in step_details], e.error
     if not isinstance(result.output, dict):
         return None, [], f'Expected output to be a dictionary, got {type(result.output)} with value {result.output}'
     prediction = result.output.get('var', None)
-    step_details = [d.get('output', None) for d in result.step_details[:-1]]
+    step_details = [encode_region(d.get('output', None)) for d in result.rendered_details()[:-1]]
     return prediction, step_details, None
 
 
@@ -102,6 +108,30 @@ def read_nlvr(statement_details: Any, images_dir: str, run_queue: Queue, write_q
         print('Done reading NLVR')
 
 
+# the arguments build_modules reads, a snapshot built with other values is rebuilt
+SNAPSHOT_ARGS = ('device', 'policy', 'threads', 'quantize', 'backend', 'compile', 'vqa_cascade_threshold',
+                 'vqa_cascade_quantize', 'fast_preprocessing', 'stub', 'stub_latency', 'model_store')
+
+
+def snapshot_args(args: argparse.Namespace) -> Dict[str, Any]:
+    return {name: getattr(args, name) for name in SNAPSHOT_ARGS}
+
+
+def build_modules(args: argparse.Namespace) -> List[VisProgModule]:
+    if args.stub:
+        vqa = StubVQA(latency=args.stub_latency, cast_from_string=True)
+    else:
+        policy = InferencePolicy.from_name(args.policy, num_threads=args.threads)
+        store = ModelStore(args.model_store) if args.model_store is not None else None
+        vqa = VQA(device=args.device, cast_from_string=True, policy=policy, quantize=args.quantize,
+                  backend=args.backend, compile=args.compile, store=store,
+                  cascade_threshold=args.vqa_cascade_threshold, cascade_quantize=args.vqa_cascade_quantize,
+                  fast_preprocessing=args.fast_preprocessing)
+    eval_ = Eval()
+    result = Result()
+    return [vqa, eval_, result]
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Run all programs in a NLVR yaml file',
@@ -112,6 +142,105 @@ def main():
         type=str,
         default='cpu',
     )
+    parser.add_argument(
+        '--policy',
+        type=str,
+        choices=sorted(InferencePolicy.presets),
+        default='default',
+        help='inference policy shared by all model-backed modules',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='number of torch intra-op threads',
+    )
+    parser.add_argument(
+        '--quantize',
+        action='store_true',
+        help='use dynamically INT8 quantized models (cpu only)',
+    )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['torch', 'onnx'],
+        default='torch',
+        help='execution backend of the model-backed modules',
+    )
+    parser.add_argument(
+        '--compile',
+        action='store_true',
+        help='wrap the models in torch.compile with a persistent compile cache',
+    )
+    parser.add_argument(
+        '--vqa-cascade-threshold',
+        type=float,
+        default=None,
+        help='answer VQA with a cheaper first stage unless its softmax margin is below this threshold',
+    )
+    parser.add_argument(
+        '--vqa-cascade-quantize',
+        action='store_true',
+        help='use a quantized model as the VQA cascade first stage',
+    )
+    parser.add_argument(
+        '--fast-preprocessing',
+        action='store_true',
+        help='preprocess images with vectorized torch ops instead of the Hugging Face processors',
+    )
+    parser.add_argument(
+        '--stub',
+        action='store_true',
+        help='use deterministic stub models that load no weights, to benchmark the rest of the pipeline',
+    )
+    parser.add_argument(
+        '--stub-latency',
+        type=float,
+        default=0.0,
+        help='synthetic latency in seconds of every stub model call',
+    )
+    parser.add_argument(
+        '--model-store',
+        type=str,
+        default=None,
+        help='load models offline from this local model store directory',
+    )
+    parser.add_argument(
+        '--snapshot',
+        type=str,
+        default=None,
+        help='load the initialized modules from this file, creating it on the first run',
+    )
+    parser.add_argument(
+        '--cache',
+        type=str,
+        default=None,
+        help='persistent inference cache database shared across runs and processes',
+    )
+    parser.add_argument(
+        '--cache-size-mb',
+        type=int,
+        default=1024,
+        help='size limit of the persistent inference cache',
+    )
+    parser.add_argument(
+        '--near-duplicate-distance',
+        type=int,
+        default=None,
+        help='reuse VQA outputs for images whose perceptual hashes differ by at most this many bits',
+    )
+    parser.add_argument(
+        '--near-duplicate-verify-every',
+        type=int,
+        default=None,
+        help='also run every N-th reused VQA step exactly and report the agreement rate',
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='only run the first LIMIT statements',
+    )
     parser.add_argument(
         'images_dir',
         type=str,
@@ -127,14 +256,33 @@ def main():
 
     args = parser.parse_args()
 
-    vqa = VQA(device=args.device, cast_from_string=True)
-    eval_ = Eval()
-    result = Result()
-    modules = [vqa, eval_, result]
+    if args.snapshot is not None and (args.backend != 'torch' or args.compile):
+        parser.error('--snapshot only supports the torch backend without --compile')
+    if args.backend == 'onnx' and InferencePolicy.presets[args.policy].get('bfloat16'):
+        parser.error('the onnx backend runs in float32 and does not support bfloat16 policies')
+    if (args.quantize or args.vqa_cascade_quantize) and InferencePolicy.presets[args.policy].get('bfloat16'):
+        parser.error('quantized models run in float32 and do not support bfloat16 policies')
+
+    modules = None
+    if args.snapshot is not None and os.path.exists(args.snapshot):
+        modules = load_snapshot(args.snapshot, snapshot_args(args))
+        if modules is None:
+            print(f'Rebuilding the snapshot {args.snapshot}')
+    if modules is None:
+        modules = build_modules(args)
+        if args.snapshot is not None:
+            save_snapshot(modules, args.snapshot, snapshot_args(args))
+
+    if args.cache is not None:
+        InferenceCache(args.cache, max_size_bytes=args.cache_size_mb * 2 ** 20).attach(modules)
+    if args.near_duplicate_distance is not None:
+        near_duplicates = NearDuplicateCache(args.near_duplicate_distance, args.near_duplicate_verify_every)
+        near_duplicates.attach([module for module in modules if isinstance(module, VQA)])
     program_runner = ProgramRunner(modules)
 
     with open(args.input_file, 'r') as f:
         statement_details = yaml.safe_load(f)
+    statement_details = statement_details[:args.limit]
 
     os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
     write_queue = Queue(maxsize=-1)
@@ -160,6 +308,12 @@ def main():
     write_results_thread.join()
     read_thread.join()
 
+    vqa = next(module for module in modules if isinstance(module, VQA))
+    if vqa.cascade_threshold is not None:
+        print(f'VQA cascade hit rates: {vqa.cascade_hit_rates()}')
+    if args.near_duplicate_distance is not None:
+        print(f'Near-duplicate reuse: {near_duplicates.report()}')
+
 
 if __name__ == '__main__':
     main()
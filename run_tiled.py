@@ -0,0 +1,145 @@
+import argparse
+import os
+import resource
+import shutil
+from typing import List
+
+from modules import (BGBlur, ColorPop, Crop, CropAbove, CropBelow, CropLeft, CropRight, Emoji, FaceDet,
+                     InferencePolicy, Loc, ModelStore, Result, Seg, Select, TiledImage, VisProgModule)
+from modules.buffer_pool import BufferPool
+from modules.image_buffer import as_pil
+from modules.stubs import StubFaceDet, StubLoc, StubSeg, StubSelect
+from visprog import ProgramRunner
+
+
+def build_modules(args: argparse.Namespace) -> List[VisProgModule]:
+    if args.stub:
+        seg = StubSeg(latency=args.stub_latency)
+        labels = {i: str(i) for i in range(seg.num_labels)}
+        select = StubSelect(labels, {name: i for i, name in labels.items()}, latency=args.stub_latency,
+                            pack_masks=args.pack_masks)
+        facedet = StubFaceDet(latency=args.stub_latency)
+        loc = StubLoc(latency=args.stub_latency)
+    else:
+        policy = InferencePolicy.from_name(args.policy, num_threads=args.threads)
+        store = ModelStore(args.model_store) if args.model_store is not None else None
+        seg = Seg(device=args.device, policy=policy, store=store)
+        select = Select(seg.model.config.id2label, seg.model.config.label2id, device=args.device, policy=policy,
+                        store=store, pack_masks=args.pack_masks)
+        facedet = FaceDet(device=args.device, policy=policy)
+        loc = Loc(device=args.device, policy=policy, store=store)
+    # REPLACE edits pixels with a model and has no out of core path, so it is not available here
+    return [seg, select, facedet, loc, ColorPop(), BGBlur(), Emoji(), Crop(), CropLeft(), CropRight(), CropAbove(),
+            CropBelow(), Result()]
+
+
+def peak_rss_mb() -> float:
+    """ The peak resident set size of this process, ru_maxrss is in kilobytes on Linux """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run an image editing program out of core on an image too large to hold in memory',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-d', '--device',
+        type=str,
+        default='cpu',
+    )
+    parser.add_argument(
+        '--policy',
+        type=str,
+        choices=sorted(InferencePolicy.presets),
+        default='default',
+        help='inference policy shared by all model-backed modules',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='number of torch intra-op threads',
+    )
+    parser.add_argument(
+        '--strip-height',
+        type=int,
+        default=256,
+        help='number of image rows the editing steps process at a time',
+    )
+    parser.add_argument(
+        '--proxy-size',
+        type=int,
+        default=1024,
+        help='longest side of the downscaled proxy the model-backed steps run on',
+    )
+    parser.add_argument(
+        '--buffer-pool-mb',
+        type=float,
+        default=64,
+        help='maximum size of the scratch arrays kept for reuse',
+    )
+    parser.add_argument(
+        '--pack-masks',
+        action='store_true',
+        help='keep the masks selected by SELECT bit-packed in the program state',
+    )
+    parser.add_argument(
+        '--stub',
+        action='store_true',
+        help='use deterministic stub models that load no weights, to benchmark the rest of the pipeline',
+    )
+    parser.add_argument(
+        '--stub-latency',
+        type=float,
+        default=0.0,
+        help='synthetic latency in seconds of every stub model call',
+    )
+    parser.add_argument(
+        '--model-store',
+        type=str,
+        default=None,
+        help='load models offline from this local model store directory',
+    )
+    parser.add_argument(
+        'program_file',
+        type=str,
+        help='text file with the image editing program, the image is bound to IMAGE',
+    )
+    parser.add_argument(
+        'input_file',
+        type=str,
+        help='the image, .npy images written by an earlier run are read strip by strip without being decoded',
+    )
+    parser.add_argument(
+        'output_file',
+        type=str,
+        help='the edited image, written strip by strip as .png or kept as a tiled .npy image',
+    )
+
+    args = parser.parse_args()
+
+    with open(args.program_file, 'r') as f:
+        program = f.read()
+
+    modules = build_modules(args)
+    BufferPool(max_bytes=int(args.buffer_pool_mb * 2 ** 20)).attach(modules)
+    image = TiledImage.from_file(args.input_file, strip_height=args.strip_height, proxy_size=args.proxy_size)
+    _, result = ProgramRunner(modules).execute_program(program, {'IMAGE': image})
+    final_result = result.state.get('FINAL_RESULT', result.output)
+    output = final_result['var'] if isinstance(final_result, dict) else final_result
+
+    if not isinstance(output, TiledImage):
+        as_pil(output).save(args.output_file)
+    elif args.output_file.endswith('.npy'):
+        # keep the file of a temporary output instead of copying it
+        (os.replace if output.temporary else shutil.copyfile)(output.path, args.output_file)
+    else:
+        output.save_png(args.output_file)
+
+    print(f'Image size: {image.size}')
+    print(f'Peak RSS: {peak_rss_mb():.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import argparse
+import queue
+import threading
+import time
+import traceback
+from queue import Queue
+from typing import Iterator, List, Optional
+
+import imageio
+import numpy as np
+from PIL import Image
+
+from modules import (BGBlur, ColorPop, Emoji, FaceDet, InferencePolicy, ModelStore, Replace, Result, Seg, Select,
+                     VisProgModule)
+from modules.buffer_pool import BufferPool
+from modules.stubs import StubFaceDet, StubReplace, StubSeg, StubSelect
+from visprog.video import VideoProgramRunner
+
+
+def read_frames(input_file: str, frame_queue: Queue, finish_event: threading.Event):
+    try:
+        reader = imageio.get_reader(input_file)
+        for frame in reader:
+            while not finish_event.is_set():
+                try:
+                    frame_queue.put(Image.fromarray(np.asarray(frame)).convert('RGB'), timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if finish_event.is_set():
+                break
+        reader.close()
+    except:
+        traceback.print_exc()
+        time.sleep(1)
+    finally:
+        frame_queue.put(None)
+
+
+def write_frames(output_file: str, fps: float, write_queue: Queue):
+    writer = imageio.get_writer(output_file, fps=fps)
+    try:
+        while True:
+            frame = write_queue.get(block=True)
+            if frame is None:
+                break
+            writer.append_data(np.asarray(frame))
+    except:
+        traceback.print_exc()
+        time.sleep(1)
+    finally:
+        writer.close()
+        print('Done writing video')
+
+
+def iterate_queue(frame_queue: Queue) -> Iterator[Image.Image]:
+    while True:
+        frame = frame_queue.get(block=True)
+        if frame is None:
+            return
+        yield frame
+
+
+def build_modules(args: argparse.Namespace) -> List[VisProgModule]:
+    if args.stub:
+        seg = StubSeg(latency=args.stub_latency)
+        labels = {i: str(i) for i in range(seg.num_labels)}
+        select = StubSelect(labels, {name: i for i, name in labels.items()}, latency=args.stub_latency,
+                            pack_masks=args.pack_masks)
+        facedet = StubFaceDet(latency=args.stub_latency)
+        replace = StubReplace(latency=args.stub_latency)
+    else:
+        policy = InferencePolicy.from_name(args.policy, num_threads=args.threads)
+        store = ModelStore(args.model_store) if args.model_store is not None else None
+        seg = Seg(device=args.device, policy=policy, store=store)
+        select = Select(seg.model.config.id2label, seg.model.config.label2id, device=args.device, policy=policy,
+                        store=store, pack_masks=args.pack_masks)
+        facedet = FaceDet(device=args.device, policy=policy)
+        replace = Replace(device=args.device, roi=True, profile=args.replace_profile, store=store)
+    return [seg, select, facedet, ColorPop(), BGBlur(), Emoji(), replace, Result()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run an image editing program on every frame of a video',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '-d', '--device',
+        type=str,
+        default='cpu',
+    )
+    parser.add_argument(
+        '--policy',
+        type=str,
+        choices=sorted(InferencePolicy.presets),
+        default='default',
+        help='inference policy shared by all model-backed modules',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='number of torch intra-op threads',
+    )
+    parser.add_argument(
+        '--replace-profile',
+        type=str,
+        choices=sorted(Replace.schedule_profiles),
+        default='fast',
+        help='diffusion schedule profile of REPLACE',
+    )
+    parser.add_argument(
+        '--keyframe-interval',
+        type=int,
+        default=15,
+        help='maximum number of frames between two runs of the detection and segmentation steps',
+    )
+    parser.add_argument(
+        '--drift-threshold',
+        type=float,
+        default=0.08,
+        help='re-detect when the mean absolute difference of a tracked object exceeds this fraction',
+    )
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=None,
+        help='frame rate of the output video, the input frame rate if not given',
+    )
+    parser.add_argument(
+        '--buffer-pool-mb',
+        type=float,
+        default=256,
+        help='maximum size of the scratch arrays kept for reuse across frames',
+    )
+    parser.add_argument(
+        '--pack-masks',
+        action='store_true',
+        help='keep the masks selected by SELECT bit-packed in the program state',
+    )
+    parser.add_argument(
+        '--stub',
+        action='store_true',
+        help='use deterministic stub models that load no weights, to benchmark the rest of the pipeline',
+    )
+    parser.add_argument(
+        '--stub-latency',
+        type=float,
+        default=0.0,
+        help='synthetic latency in seconds of every stub model call',
+    )
+    parser.add_argument(
+        '--model-store',
+        type=str,
+        default=None,
+        help='load models offline from this local model store directory',
+    )
+    parser.add_argument(
+        'program_file',
+        type=str,
+        help='text file with the image editing program, the frame is bound to IMAGE',
+    )
+    parser.add_argument(
+        'input_file',
+        type=str,
+    )
+    parser.add_argument(
+        'output_file',
+        type=str,
+    )
+
+    args = parser.parse_args()
+
+    with open(args.program_file, 'r') as f:
+        program = f.read()
+    fps: Optional[float] = args.fps
+    if fps is None:
+        with imageio.get_reader(args.input_file) as reader:
+            fps = reader.get_meta_data().get('fps', 30)
+
+    modules = build_modules(args)
+    buffer_pool = BufferPool(max_bytes=int(args.buffer_pool_mb * 2 ** 20))
+    buffer_pool.attach(modules)
+    program_runner = VideoProgramRunner(modules, keyframe_interval=args.keyframe_interval,
+                                        drift_threshold=args.drift_threshold)
+
+    # decode, run and encode concurrently, the queues bound the number of frames in flight
+    frame_queue = Queue(maxsize=8)
+    write_queue = Queue(maxsize=8)
+    finish_event = threading.Event()
+    read_thread = threading.Thread(target=read_frames, args=(args.input_file, frame_queue, finish_event))
+    write_thread = threading.Thread(target=write_frames, args=(args.output_file, fps, write_queue))
+    read_thread.start()
+    write_thread.start()
+    try:
+        for output_frame in program_runner.run(program, iterate_queue(frame_queue)):
+            write_queue.put(output_frame)
+    finally:
+        finish_event.set()
+        write_queue.put(None)
+        write_thread.join()
+        while read_thread.is_alive():
+            try:
+                frame_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    print(f'Video stats: {program_runner.stats}')
+    print(f'Buffer pool: {buffer_pool.report()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import glob
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+from PIL import Image
+
+from modules.preprocessing import FastImagePreprocessor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROCESSORS = {
+    'vilt': (transformers.ViltProcessor, 'dandelin/vilt-b32-finetuned-vqa'),
+    'owlvit': (transformers.OwlViTProcessor, 'google/owlvit-base-patch32'),
+    'clip': (transformers.CLIPProcessor, 'openai/clip-vit-large-patch14'),
+}
+
+# bicubic resampling differs slightly from PIL, mostly at edges, so the bulk of the pixels must match closely and
+# only a few may differ more; a region that is badly off, like an off by one row of padding, fails the percentile
+MEAN_TOLERANCE = 2e-2
+PERCENTILE = 99.9
+PERCENTILE_TOLERANCE = 1e-1
+MAX_TOLERANCE = 5e-1
+
+# odd sizes and aspect ratios exercise the rounding of the resized size and the padding on every edge
+SYNTHETIC_SIZES = [(640, 480), (480, 640), (501, 37), (37, 501), (333, 1000), (1023, 767)]
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    """ Smooth random content, like photos rather than noise, whose resampling errors are not representative """
+    coarse = np.random.RandomState(seed).randint(0, 256, (8, 8, 3), dtype=np.uint8)
+    return Image.fromarray(coarse).resize((width, height), Image.BILINEAR)
+
+
+def parity_images():
+    paths = sorted(path for path in glob.glob(os.path.join(REPO_ROOT, 'assets', '**', '*'), recursive=True)
+                   if path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')))
+    images = [(os.path.relpath(path, REPO_ROOT), Image.open(path).convert('RGB')) for path in paths]
+    images += [(f'synthetic {width}x{height}', synthetic_image(width, height, seed))
+               for seed, (width, height) in enumerate(SYNTHETIC_SIZES)]
+    return images
+
+
+@pytest.fixture(scope='module', params=sorted(PROCESSORS))
+def image_processor(request):
+    processor_class, model_name = PROCESSORS[request.param]
+    try:
+        return processor_class.from_pretrained(model_name).image_processor
+    except OSError as error:
+        pytest.skip(f'{model_name} is not available: {error}')
+
+
+@pytest.mark.parametrize('name,image', parity_images(), ids=lambda value: value if isinstance(value, str) else '')
+def test_fast_preprocessing_matches_processor(image_processor, name, image):
+    expected = image_processor(image, return_tensors='pt')
+    actual = FastImagePreprocessor(image_processor)([image])
+
+    assert actual['pixel_values'].shape == expected['pixel_values'].shape
+    if 'pixel_mask' in expected:
+        assert actual['pixel_mask'].shape == expected['pixel_mask'].shape
+        assert torch.equal(actual['pixel_mask'], expected['pixel_mask'])
+
+    error = (actual['pixel_values'] - expected['pixel_values']).abs().flatten().double()
+    assert error.mean().item() <= MEAN_TOLERANCE
+    assert torch.quantile(error, PERCENTILE / 100).item() <= PERCENTILE_TOLERANCE
+    assert error.max().item() <= MAX_TOLERANCE
@@ -0,0 +1,57 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROGRAM = """OBJ0=SEG(image=IMAGE)
+OBJ1=SELECT(image=IMAGE,object=OBJ0,query='person',category=None)
+IMAGE0=COLORPOP(image=IMAGE,object=OBJ1)
+OBJ2=FACEDET(image=IMAGE0)
+IMAGE1=BGBLUR(image=IMAGE0,object=OBJ2)
+FINAL_RESULT=RESULT(var=IMAGE1)
+"""
+
+
+def write_npy_image(path: str, width: int, height: int, strip_height: int = 256):
+    """ Write a gradient image as an .npy file strip by strip, without holding it in memory """
+    image = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+    columns = (np.arange(width) * 255 // max(width - 1, 1)).astype(np.uint8)
+    for y1 in range(0, height, strip_height):
+        y2 = min(y1 + strip_height, height)
+        image[y1:y2, :, 0] = columns
+        image[y1:y2, :, 1] = (np.arange(y1, y2) * 255 // max(height - 1, 1)).astype(np.uint8)[:, None]
+        image[y1:y2, :, 2] = 128
+    image.flush()
+    del image
+
+
+def run_tiled_peak_rss(tmp_path, width: int, height: int) -> float:
+    input_file = str(tmp_path / f'input-{width}x{height}.npy')
+    output_file = str(tmp_path / f'output-{width}x{height}.npy')
+    program_file = str(tmp_path / 'program.txt')
+    write_npy_image(input_file, width, height)
+    with open(program_file, 'w') as f:
+        f.write(PROGRAM)
+    completed = subprocess.run([sys.executable, 'run_tiled.py', '--stub', program_file, input_file, output_file],
+                               cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    output = np.load(output_file, mmap_mode='r')
+    assert output.shape == (height, width, 3)
+    return float(re.search(r'Peak RSS: (\d+) MB', completed.stdout).group(1))
+
+
+def test_peak_rss_does_not_grow_with_image_size(tmp_path):
+    small_width, small_height = 2048, 1536
+    large_width, large_height = 8192, 6144
+    small_rss = run_tiled_peak_rss(tmp_path, small_width, small_height)
+    large_rss = run_tiled_peak_rss(tmp_path, large_width, large_height)
+    image_growth_mb = (large_width * large_height - small_width * small_height) * 3 / 2 ** 20
+    # strips grow with the image width, so allow a few strips' worth of growth but far less than the image
+    assert large_rss - small_rss < image_growth_mb / 4, \
+        f'peak RSS grew from {small_rss} MB to {large_rss} MB for {image_growth_mb:.0f} MB more pixels'
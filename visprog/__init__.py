@@ -1,2 +1,3 @@
-from .program_runner import ProgramRunner, ProgramResult
+from .program_runner import ProgramRunner, ProgramResult, render_step_details
 from .visprog import VisProg
+from .video import VideoProgramRunner
@@ -3,7 +3,16 @@ import re
 from dataclasses import dataclass
 from typing import List, Dict, Any, Tuple, Optional
 
+from PIL import Image
+
 from modules import VisProgModule, ExecutionError
+from modules.image_buffer import ImageBuffer
+from modules.tiled import displayable
+
+
+def render_step_details(step_details: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ The step details with image buffers and deferred images converted to PIL images for display """
+    return [{name: displayable(value) for name, value in details.items()} for details in step_details]
 
 
 @dataclass
@@ -12,6 +21,10 @@ class ProgramResult:
     output: Any
     step_details: List[Dict[str, Any]]
 
+    def rendered_details(self) -> List[Dict[str, Any]]:
+        """ The step details with every image as a PIL image, or a TiledImage for out of core images """
+        return render_step_details(self.step_details)
+
 
 class ProgramRunner:
 
@@ -29,8 +42,14 @@ class ProgramRunner:
                        None)
         return matched
 
+    @staticmethod
+    def wrap_images(initial_state: Dict[str, Any]) -> Dict[str, Any]:
+        """ Copy the state, wrapping its images in ImageBuffers so that modules share their conversions """
+        return {name: ImageBuffer(value) if isinstance(value, Image.Image) else value
+                for name, value in initial_state.items()}
+
     def execute_steps(self, steps: List[str], initial_state: Dict[str, Any]) -> Tuple[List[str], ProgramResult]:
-        state = initial_state.copy()
+        state = self.wrap_images(initial_state)
         step_details = []
         output = None
         executed_steps = []
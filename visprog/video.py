@@ -0,0 +1,227 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from modules import FaceDet, Loc, Seg, Select, VisProgModule
+from modules.regions import Boxes, Mask, PackedMask, mask_box
+from visprog.program_runner import ProgramRunner, ProgramResult
+
+
+class ObjectTracker:
+    """ Propagates the masks, label maps and boxes of one frame to the next by translation.
+
+    The translation of every box, and of the bounding box of every mask, is estimated by phase correlation of the
+    grayscale frames in a padded window around the object. Label maps move with the translation of the whole frame.
+    The drift of an estimate is the mean absolute difference of the window and its translated counterpart in the
+    next frame, as a fraction of the intensity range.
+    """
+
+    def __init__(self, search_padding: int = 32):
+        self.search_padding = search_padding
+
+    @staticmethod
+    def grayscale(frame: Image.Image) -> np.ndarray:
+        return np.asarray(frame.convert('L'), dtype=np.float32)
+
+    def estimate_shift(self, previous: np.ndarray, current: np.ndarray, box: Tuple[float, ...]
+                       ) -> Tuple[int, int, float]:
+        """ Estimate the translation (dx, dy) of the content of box from previous to current and its drift """
+        height, width = previous.shape
+        x1 = int(np.clip(np.floor(box[0]) - self.search_padding, 0, width - 1))
+        y1 = int(np.clip(np.floor(box[1]) - self.search_padding, 0, height - 1))
+        x2 = int(np.clip(np.ceil(box[2]) + self.search_padding, x1 + 1, width))
+        y2 = int(np.clip(np.ceil(box[3]) + self.search_padding, y1 + 1, height))
+        window = previous[y1:y2, x1:x2]
+        # taper the windows so that their borders do not dominate the correlation
+        taper = np.outer(np.hanning(y2 - y1), np.hanning(x2 - x1))
+        spectrum = np.fft.fft2((current[y1:y2, x1:x2] - current[y1:y2, x1:x2].mean()) * taper) * \
+            np.conj(np.fft.fft2((window - window.mean()) * taper))
+        correlation = np.fft.ifft2(spectrum / (np.abs(spectrum) + 1e-6)).real
+        dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+        window_height, window_width = correlation.shape
+        dy = int(dy - window_height if dy > window_height // 2 else dy)
+        dx = int(dx - window_width if dx > window_width // 2 else dx)
+
+        # compare the part of the window that stays inside the frame after the translation
+        overlap_x1, overlap_y1 = max(x1, -dx), max(y1, -dy)
+        overlap_x2, overlap_y2 = min(x2, width - dx), min(y2, height - dy)
+        if overlap_x2 <= overlap_x1 or overlap_y2 <= overlap_y1:
+            return dx, dy, 1.
+        source = previous[overlap_y1:overlap_y2, overlap_x1:overlap_x2]
+        target = current[overlap_y1 + dy:overlap_y2 + dy, overlap_x1 + dx:overlap_x2 + dx]
+        return dx, dy, float(np.abs(target - source).mean() / 255)
+
+    @staticmethod
+    def shift_array(array: np.ndarray, dx: int, dy: int, fill_edges: bool) -> np.ndarray:
+        """ Translate a 2D array, filling the uncovered border with zeros or with the nearest edge values """
+        height, width = array.shape
+        padding = ((max(dy, 0), max(-dy, 0)), (max(dx, 0), max(-dx, 0)))
+        padded = np.pad(array, padding, mode='edge' if fill_edges else 'constant')
+        top, left = max(-dy, 0), max(-dx, 0)
+        return padded[top:top + height, left:left + width]
+
+    def propagate(self, value: Any, previous: np.ndarray, current: np.ndarray) -> Tuple[Any, float]:
+        """ Move a step output from the previous frame to the current one
+
+        Parameters
+        ----------
+        value : Any
+            A boolean mask, a PackedMask, an integer label map, Boxes, a sequence of boxes (x1, y1, x2, y2) or any
+            other value, which is returned unchanged
+
+        previous : np.ndarray
+            The grayscale previous frame
+
+        current : np.ndarray
+            The grayscale current frame
+
+        Returns
+        -------
+        Tuple[Any, float]
+            The propagated value and the largest drift of its objects
+        """
+        height, width = previous.shape
+        if isinstance(value, PackedMask) and value.shape == (height, width):
+            mask, drift = self.propagate(value.to_mask(), previous, current)
+            return PackedMask.from_mask(mask), drift
+
+        if isinstance(value, np.ndarray) and value.shape == (height, width):
+            if value.dtype == bool:
+                box = mask_box(value)
+                if box is None:
+                    return value, 0.
+            else:
+                box = (0, 0, width, height)
+            dx, dy, drift = self.estimate_shift(previous, current, box)
+            shifted = self.shift_array(np.asarray(value), dx, dy, fill_edges=value.dtype != bool)
+            return Mask(shifted) if isinstance(value, Mask) else shifted, drift
+
+        if isinstance(value, Boxes):
+            shifts = np.zeros((len(value), 4), dtype=np.float32)
+            max_drift = 0.
+            for i, box in enumerate(value):
+                dx, dy, drift = self.estimate_shift(previous, current, box)
+                shifts[i] = dx, dy, dx, dy
+                max_drift = max(max_drift, drift)
+            return Boxes(value.array + shifts, value.scores), max_drift
+
+        if isinstance(value, (tuple, list)) and all(isinstance(box, (tuple, list)) and len(box) == 4
+                                                    for box in value):
+            boxes, max_drift = [], 0.
+            for box in value:
+                dx, dy, drift = self.estimate_shift(previous, current, box)
+                boxes.append((box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy))
+                max_drift = max(max_drift, drift)
+            return type(value)(boxes), max_drift
+
+        return value, 0.
+
+
+@dataclass
+class VideoStats:
+    keyframes: int = 0
+    propagated_frames: int = 0
+    redetections: Dict[str, int] = field(default_factory=dict)
+
+
+class VideoProgramRunner(ProgramRunner):
+    """ Runs an image editing program on every frame of a video.
+
+    The perception steps (SEG, FACEDET, LOC and SELECT) only run on keyframes. On the frames in between, their
+    outputs are propagated from the previous frame by the ObjectTracker and the editing steps run on the
+    propagated masks and boxes. A frame becomes a keyframe when it is the first one, when keyframe_interval frames
+    have passed since the last keyframe, or when the drift of a propagated output exceeds drift_threshold.
+    """
+    perception_modules = (Seg, FaceDet, Loc, Select)
+
+    def __init__(self, modules: List[VisProgModule], keyframe_interval: int = 15, drift_threshold: float = 0.08,
+                 tracker: Optional[ObjectTracker] = None):
+        super().__init__(modules)
+        self.keyframe_interval = keyframe_interval
+        self.drift_threshold = drift_threshold
+        self.tracker = tracker or ObjectTracker()
+        self.stats = VideoStats()
+
+    def perception_outputs(self, steps: List[str]) -> List[str]:
+        """ The output variable names of the perception steps of the program """
+        names = []
+        for step in steps:
+            matched = self.match_step(step)
+            if matched is not None and isinstance(matched[0], self.perception_modules):
+                names.append(matched[0].parse(matched[1], step).output_var_name)
+        return names
+
+    def execute_with_outputs(self, steps: List[str], initial_state: Dict[str, Any],
+                             fixed_outputs: Dict[str, Any]) -> ProgramResult:
+        """ Execute the steps, taking the outputs of the steps that assign to fixed_outputs from there """
+        state = self.wrap_images(initial_state)
+        output = None
+        for step in steps:
+            matched = self.match_step(step)
+            if matched is None:
+                continue
+            module, match = matched
+            output_var_name = module.parse(match, step).output_var_name
+            if output_var_name in fixed_outputs:
+                output = state[output_var_name] = fixed_outputs[output_var_name]
+            else:
+                output, _ = module.execute(step, state, match=match)
+        return ProgramResult(state, output, [])
+
+    def run(self, program: str, frames: Iterable[Image.Image], image_var_name: str = 'IMAGE'
+            ) -> Iterator[Image.Image]:
+        """ Run the program on each frame and yield the output frames as they are computed
+
+        Parameters
+        ----------
+        program : str
+            The image editing program, one step per line
+
+        frames : Iterable[Image.Image]
+            The RGB frames of the video
+
+        image_var_name : str
+            The program variable the frame is assigned to
+
+        Returns
+        -------
+        Iterator[Image.Image]
+            The FINAL_RESULT of the program for each frame
+        """
+        steps = [step.strip() for step in program.split('\n') if step.strip()]
+        perception_outputs = self.perception_outputs(steps)
+        tracked: Dict[str, Any] = {}
+        previous_gray = None
+        frames_since_keyframe = 0
+        for frame in frames:
+            gray = self.tracker.grayscale(frame)
+            redetect = None
+            if previous_gray is None or gray.shape != previous_gray.shape:
+                redetect = 'first'
+            elif frames_since_keyframe >= self.keyframe_interval:
+                redetect = 'interval'
+            else:
+                propagated = {}
+                for name, value in tracked.items():
+                    propagated[name], drift = self.tracker.propagate(value, previous_gray, gray)
+                    if drift > self.drift_threshold:
+                        redetect = 'drift'
+                        break
+                tracked = propagated
+
+            if redetect is not None:
+                self.stats.keyframes += 1
+                self.stats.redetections[redetect] = self.stats.redetections.get(redetect, 0) + 1
+                _, result = self.execute_steps(steps, {image_var_name: frame})
+                tracked = {name: result.state[name] for name in perception_outputs if name in result.state}
+                frames_since_keyframe = 0
+            else:
+                self.stats.propagated_frames += 1
+                result = self.execute_with_outputs(steps, {image_var_name: frame}, tracked)
+                frames_since_keyframe += 1
+
+            previous_gray = gray
+            final_result = result.state.get('FINAL_RESULT', result.output)
+            yield final_result['var'] if isinstance(final_result, dict) else final_result